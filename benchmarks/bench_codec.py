@@ -0,0 +1,96 @@
+"""
+Encode/decode cost and size per task of the RedisBackend wire format.
+It compares the task name + struct header format with the pickled (fn, args, kwargs, created_at) used before.
+Redis is not needed, only the encoding is measured.
+
+    python -m benchmarks.bench_codec --tasks 100000
+"""
+
+import argparse
+import pickle
+import time
+from typing import Callable
+from uuid import uuid4
+
+from coro_runner.backend import RedisBackend
+from coro_runner.codec import TASK_ID_LENGTH
+from coro_runner.schema import RedisConfig, TaskRecord
+
+
+async def send_mail(email: str, subject: str):
+    pass
+
+
+def dump_pickle(task: TaskRecord) -> bytes:
+    return task.id.encode("ascii") + pickle.dumps(
+        (task.fn, task.args, task.kwargs, task.created_at)
+    )
+
+
+def load_pickle(payload: bytes) -> TaskRecord:
+    fn, args, kwargs, created_at = pickle.loads(payload[TASK_ID_LENGTH:])
+    return TaskRecord(
+        id=payload[:TASK_ID_LENGTH].decode("ascii"),
+        fn=fn,
+        args=args,
+        kwargs=kwargs,
+        queue_name="default",
+        created_at=created_at,
+    )
+
+
+def measure(
+    dump: Callable[[TaskRecord], bytes],
+    load: Callable[[bytes], TaskRecord],
+    tasks: list[TaskRecord],
+) -> tuple[float, float, float]:
+    """
+    Microseconds to encode and decode a task and the bytes per task.
+    """
+    started_at = time.perf_counter()
+    payloads = [dump(task) for task in tasks]
+    encoded_at = time.perf_counter()
+    for payload in payloads:
+        load(payload)
+    decoded_at = time.perf_counter()
+    return (
+        (encoded_at - started_at) / len(tasks) * 1e6,
+        (decoded_at - encoded_at) / len(tasks) * 1e6,
+        sum(len(payload) for payload in payloads) / len(tasks),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=100_000)
+    options = parser.parse_args()
+
+    backend = RedisBackend(conf=RedisConfig(host="localhost", port=6379, db=0))
+    backend.registry.register(send_mail, name="send_mail")
+    tasks = [
+        TaskRecord(
+            id=uuid4().hex,
+            fn=send_mail,
+            args=[f"user{i}@example.com"],
+            kwargs={"subject": "Welcome"},
+            queue_name="default",
+            created_at=time.time(),
+        )
+        for i in range(options.tasks)
+    ]
+    formats = {
+        "pickle": (dump_pickle, load_pickle),
+        "registry": (
+            backend._RedisBackend__dump_task,
+            lambda payload: backend._RedisBackend__load_task("default", payload),
+        ),
+    }
+    for name, (dump, load) in formats.items():
+        encode, decode, size = measure(dump, load, tasks)
+        print(
+            f"{name:<9} encode: {encode:.2f} us/task  decode: {decode:.2f} us/task  size: {size:.1f} bytes/task"
+        )
+
+
+if __name__ == "__main__":
+    main()
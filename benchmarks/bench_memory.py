@@ -0,0 +1,67 @@
+"""
+Bytes per queued task of the InMemoryBackend.
+It compares the TaskRecord with the dict based task ({"fn", "args", "kwargs"}) used before.
+
+    python -m benchmarks.bench_memory --tasks 100000
+"""
+
+import argparse
+import asyncio
+import tracemalloc
+from collections import deque
+from typing import Callable
+from uuid import uuid4
+
+from coro_runner.backend import InMemoryBackend
+from coro_runner.schema import TaskRecord
+from coro_runner.utils import prepare_queue
+
+
+async def noop():
+    pass
+
+
+def measure(fill: Callable[[int], object], tasks: int) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    keep = fill(tasks)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return (after - before) / tasks
+
+
+def fill_dicts(tasks: int) -> deque:
+    # Task ids are excluded from the both, only the container of the task is compared.
+    queue: deque = deque()
+    for _ in range(tasks):
+        queue.append({"fn": noop, "args": [], "kwargs": {}})
+    return queue
+
+
+async def add_records(tasks: int) -> InMemoryBackend:
+    backend = InMemoryBackend()
+    await backend.set_waiting(prepare_queue([], default_name="default"))
+    task_id = uuid4().hex
+    for _ in range(tasks):
+        await backend.add_task_to_waiting_queue(
+            TaskRecord(id=task_id, fn=noop, args=[], kwargs={}, queue_name="default")
+        )
+    return backend
+
+
+def fill_records(tasks: int) -> InMemoryBackend:
+    return asyncio.run(add_records(tasks))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=100_000)
+    options = parser.parse_args()
+
+    print(f"dict task:   {measure(fill_dicts, options.tasks):.1f} bytes/task")
+    print(f"TaskRecord:  {measure(fill_records, options.tasks):.1f} bytes/task")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Throughput and latency of the runner and the backends.
+
+    python -m benchmarks.bench_runner --backend all --json results.json
+
+Every benchmark runs for every selected backend:
+    - throughput: No-op tasks per second, added with add_tasks and run to the end.
+    - queue_ops: Microseconds to add a task to and pop a task from the waiting queue by the size of the backlog.
+    - latency: p50/p99 milliseconds from add_task to the start of the task, adding one task at a time.
+    - memory: Bytes per queued task. Traced python memory for InMemoryBackend, MEMORY USAGE of the queue for
+      RedisBackend (None if the server doesn't support it).
+RedisBackend needs a redis at --redis-host/--redis-port, a local redis-server or a fakeredis TCP server. The keys of
+the runner are removed after every benchmark, so use a database not used by anything else.
+The results are printed and written as JSON with --json, so they can be compared between the commits.
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from typing import Any, Callable
+from uuid import uuid4
+
+from redis.exceptions import ResponseError
+
+from coro_runner import CoroRunner
+from coro_runner.backend import BaseBackend, InMemoryBackend, RedisBackend
+from coro_runner.schema import RedisConfig, TaskRecord
+from coro_runner.utils import prepare_queue
+
+BackendFactory = Callable[[], BaseBackend]
+
+# Tasks added to the backend by a single call while filling a backlog.
+FILL_CHUNK_SIZE = 10_000
+
+
+async def noop():
+    pass
+
+
+def make_task() -> TaskRecord:
+    return TaskRecord(
+        id=uuid4().hex,
+        fn=noop,
+        args=[],
+        kwargs={},
+        queue_name="default",
+        created_at=time.time(),
+    )
+
+
+async def prepare_backend(make_backend: BackendFactory) -> BaseBackend:
+    backend = make_backend()
+    backend.registry.register(noop, name="noop")
+    await backend.set_concurrency(1)
+    await backend.set_waiting(prepare_queue([], default_name="default"))
+    return backend
+
+
+async def fill_backlog(backend: BaseBackend, tasks: int) -> None:
+    for start in range(0, tasks, FILL_CHUNK_SIZE):
+        await backend.add_tasks_to_waiting_queue(
+            [make_task() for _ in range(min(FILL_CHUNK_SIZE, tasks - start))]
+        )
+
+
+async def bench_throughput(
+    make_backend: BackendFactory, tasks: int, concurrency: int
+) -> dict[str, Any]:
+    runner = CoroRunner(concurrency=concurrency, backend=make_backend())
+    runner.register(noop, name="noop")
+    started_at = time.perf_counter()
+    await runner.add_tasks((noop, [], {}, None) for _ in range(tasks))
+    await runner.join()
+    elapsed = time.perf_counter() - started_at
+    await runner.cleanup()
+    return {
+        "params": {"tasks": tasks, "concurrency": concurrency},
+        "metrics": {"tasks_per_second": tasks / elapsed, "seconds": elapsed},
+    }
+
+
+async def bench_queue_ops(
+    make_backend: BackendFactory, backlog: int, samples: int
+) -> dict[str, Any]:
+    backend = await prepare_backend(make_backend)
+    await fill_backlog(backend, backlog)
+    tasks = [make_task() for _ in range(samples)]
+    started_at = time.perf_counter()
+    for task in tasks:
+        await backend.add_task_to_waiting_queue(task)
+    added_at = time.perf_counter()
+    for _ in range(samples):
+        await backend.pop_task_from_waiting_queue()
+    popped_at = time.perf_counter()
+    await backend.cleanup()
+    return {
+        "params": {"backlog": backlog, "samples": samples},
+        "metrics": {
+            "enqueue_us": (added_at - started_at) / samples * 1e6,
+            "dequeue_us": (popped_at - added_at) / samples * 1e6,
+        },
+    }
+
+
+async def bench_latency(
+    make_backend: BackendFactory, tasks: int, concurrency: int
+) -> dict[str, Any]:
+    runner = CoroRunner(concurrency=concurrency, backend=make_backend())
+    latencies: list[float] = []
+
+    @runner.register(name="record_latency")
+    async def record_latency(added_at: float):
+        latencies.append(time.perf_counter() - added_at)
+
+    for _ in range(tasks):
+        await runner.add_task(record_latency, args=[time.perf_counter()])
+        # Let the loop start the task, like a producer adding the tasks one at a time.
+        await asyncio.sleep(0)
+    await runner.join()
+    await runner.cleanup()
+    # Inclusive, the latencies are the whole population of the run. The p99 is not extrapolated over the max.
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "params": {"tasks": tasks, "concurrency": concurrency},
+        "metrics": {
+            "p50_ms": percentiles[49] * 1e3,
+            "p99_ms": percentiles[98] * 1e3,
+            "max_ms": max(latencies) * 1e3,
+        },
+    }
+
+
+async def bench_memory(make_backend: BackendFactory, tasks: int) -> dict[str, Any]:
+    backend = await prepare_backend(make_backend)
+    if isinstance(backend, RedisBackend):
+        await fill_backlog(backend, tasks)
+        try:
+            used = await backend.r_client.memory_usage(
+                backend.get_queue_key("default"), samples=0
+            )
+        except ResponseError:
+            used = None
+    else:
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        await fill_backlog(backend, tasks)
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        used = after - before
+    await backend.cleanup()
+    return {
+        "params": {"tasks": tasks},
+        "metrics": {"bytes_per_task": used / tasks if used is not None else None},
+    }
+
+
+async def run_suite(
+    name: str, make_backend: BackendFactory, options: argparse.Namespace
+) -> list[dict[str, Any]]:
+    results = [
+        ("throughput", await bench_throughput(make_backend, options.tasks, options.concurrency))
+    ]
+    for backlog in options.backlogs:
+        results.append(
+            ("queue_ops", await bench_queue_ops(make_backend, backlog, options.samples))
+        )
+    results.append(
+        ("latency", await bench_latency(make_backend, options.samples, options.concurrency))
+    )
+    results.append(("memory", await bench_memory(make_backend, options.tasks)))
+    return [
+        {"backend": name, "benchmark": benchmark, **result}
+        for benchmark, result in results
+    ]
+
+
+def format_result(result: dict[str, Any]) -> str:
+    params = " ".join(f"{key}={value}" for key, value in result["params"].items())
+    metrics = "  ".join(
+        f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}"
+        for key, value in result["metrics"].items()
+    )
+    return f"{result['backend']:<7} {result['benchmark']:<11} {params:<30} {metrics}"
+
+
+def environment() -> dict[str, Any]:
+    try:
+        package_version = version("coro-runner")
+    except PackageNotFoundError:
+        package_version = None
+    return {
+        "coro_runner": package_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--backend", choices=["memory", "redis", "all"], default="memory")
+    parser.add_argument("--tasks", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--samples", type=int, default=1_000)
+    parser.add_argument(
+        "--backlogs", type=int, nargs="+", default=[0, 10_000, 100_000]
+    )
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=0)
+    # Every running task may hold a connection to acknowledge, redis-py caps the pool at 100 by default.
+    parser.add_argument("--redis-max-connections", type=int, default=1_000)
+    parser.add_argument("--json", help="Write the results to this file as JSON")
+    options = parser.parse_args()
+
+    backends: dict[str, BackendFactory] = dict()
+    if options.backend in ("memory", "all"):
+        backends["memory"] = InMemoryBackend
+    if options.backend in ("redis", "all"):
+        conf = RedisConfig(
+            host=options.redis_host,
+            port=options.redis_port,
+            db=options.redis_db,
+            max_connections=options.redis_max_connections,
+        )
+        backends["redis"] = lambda: RedisBackend(conf=conf)
+
+    results: list[dict[str, Any]] = []
+    for name, make_backend in backends.items():
+        for result in asyncio.run(run_suite(name, make_backend, options)):
+            print(format_result(result))
+            results.append(result)
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump({"environment": environment(), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,29 @@
 from .runner import CoroRunner
+from .handle import GroupHandle, TaskHandle
 from .logging import logger
-from .schema import Queue, QueueConfig
+from .schema import Queue, QueueConfig, Step
+from .enums import ExecutorTypeEnum, OverflowPolicyEnum, TaskStatusEnum
+from .exceptions import QueueFullError, RunnerClosedError, ShardDiedError
+from .scheduler import BaseScheduler, DeficitRoundRobinScheduler, PriorityScheduler
+from .sharded import ShardedRunner, uvloop_factory
 
 __all__ = [
     "CoroRunner",
+    "TaskHandle",
+    "GroupHandle",
     "logger",
     "Queue",
     "QueueConfig",
+    "Step",
+    "ExecutorTypeEnum",
+    "OverflowPolicyEnum",
+    "TaskStatusEnum",
+    "QueueFullError",
+    "RunnerClosedError",
+    "ShardDiedError",
+    "BaseScheduler",
+    "DeficitRoundRobinScheduler",
+    "PriorityScheduler",
+    "ShardedRunner",
+    "uvloop_factory",
 ]
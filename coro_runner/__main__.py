@@ -0,0 +1,60 @@
+"""
+Command line entry point of the runner.
+
+    python -m coro_runner worker myapp.tasks:runner
+
+The worker imports the runner (with its backend, queues and registered tasks) and serves the waiting queue
+until SIGINT or SIGTERM. Then the runner is drained: the running tasks are let finish for --drain-timeout seconds
+and the rest of them are handed back to the backend.
+"""
+
+import argparse
+import asyncio
+import signal
+
+from .logging import logger
+from .runner import CoroRunner, load_runner
+
+
+async def worker(runner: CoroRunner, wait_timeout: float, drain_timeout: float) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    serving = asyncio.create_task(runner.serve(wait_timeout=wait_timeout))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait([serving, stopping], return_when=asyncio.FIRST_COMPLETED)
+    stopping.cancel()
+    logger.info("Stopping the worker")
+    await runner.cleanup(drain=True, timeout=drain_timeout)
+    # Raises the exception of serve if it's failed.
+    await serving
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m coro_runner")
+    commands = parser.add_subparsers(dest="command", required=True)
+    worker_parser = commands.add_parser(
+        "worker", help="Serve the waiting queue of a runner"
+    )
+    worker_parser.add_argument("runner", help="Import path of the runner, module:attribute")
+    worker_parser.add_argument(
+        "--wait-timeout",
+        type=float,
+        default=1.0,
+        help="Maximum seconds to block on the backend before checking the waiting queue again",
+    )
+    worker_parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=30.0,
+        help="Maximum seconds to let the running tasks finish on shutdown before handing them back",
+    )
+    options = parser.parse_args(argv)
+    asyncio.run(
+        worker(load_runner(options.runner), options.wait_timeout, options.drain_timeout)
+    )
+
+
+if __name__ == "__main__":
+    main()
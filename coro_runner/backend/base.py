@@ -1,26 +1,65 @@
 import abc
-from collections import deque
-from typing import Any
+import asyncio
+from collections import OrderedDict, defaultdict, deque
+import heapq
+from itertools import count
+import time
+from typing import Any, Awaitable, Callable, Iterable
 
 from ..logging import logger
-from ..types import FutureFuncType
+from ..rate_limit import TokenBucket
+from ..registry import TaskRegistry
+from ..schema import TaskRecord
 
 
 class BaseBackend(abc.ABC):
     """
     Base class for all backends. All backends must inherit from this class.
+    The API is async, so the backends talking to the network don't block the event loop. The in memory
+    implementation never awaits anything.
     Features:
         - Add a task to memory. O(1)
         - Get a task from memory. O(1)
         - List of tasks in memory. O(1)
         - Task persistence. O(1)
+        - Pop the highest priority task. O(log n) where n is the number of queues. If the candidate queues are given, e.g. by DeficitRoundRobinScheduler, it's O(1) unless the first ones
+          are skipped.
+        - Pause and resume a queue, e.g. at its concurrency limit. O(log n)
+        - A rate limited queue out of tokens is kept out of the heap until its next token is due. O(log n)
+        - Schedule a task to run later. O(log n) where n is the number of scheduled tasks.
+        - Cache the result of a task by its dedup key. O(1), the least recently used one is evicted.
     Datastructure
-        - Task: Dict[str, Any]
+        - Task: TaskRecord
+        - Queues are ranked by the score once. A heap keeps the ranks of the non-empty queues not paused. A queue
+          getting empty or paused is left in the heap and dropped when it reaches the top, so the top of the heap is
+          always the highest score queue having a task once the stale ones are dropped.
+        - Scheduled tasks are kept in a heap by their run time until they are due.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, result_cache_size: int = 1024) -> None:
         super(BaseBackend).__init__()
         self._has_persistence: bool = False
+        # Task name -> function. The runner replaces it with its own registry.
+        self.registry = TaskRegistry()
+        # It's set when a task is added to the waiting queue. A serving runner waits on it.
+        self._task_added = asyncio.Event()
+        # Queue name -> Tasks failed after all the retries.
+        self._dead_letter: dict[str, deque[TaskRecord]] = defaultdict(deque)
+        # (Unix timestamp to run at, sequence, task) of the scheduled tasks. The sequence keeps the order of the tasks
+        # scheduled at the same time.
+        self._scheduled: list[tuple[float, int, TaskRecord]] = []
+        self._schedule_sequence = count()
+        # Dedup key -> (monotonic expiry time, result) of the cached results. The least recently used first.
+        self._results: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._result_cache_size = result_cache_size
+        # Queue name -> Token bucket of the rate limited queues.
+        self._buckets: dict[str, TokenBucket] = dict()
+        # Seconds until the first throttled queue gets a token, set when the last pop got nothing. None if none is
+        # throttled.
+        self.throttled_for: float | None = None
+        # It's called with the queue name and True when a queue gets its first waiting task or its next token, False
+        # when it loses the last one or runs out of tokens. The runner sets it to tell the scheduler.
+        self.queue_listener: Callable[[str, bool], None] | None = None
 
         # These are the keys used in the data dictionary.
         self._dk__concurrency = "concurrency"
@@ -32,56 +71,360 @@ class BaseBackend(abc.ABC):
             self._dk__waiting: dict(),
             self._dk__running: set(),
         }
+        self.__build_queue_index()
 
-    def set_concurrency(self, concurrency: int) -> None:
+    def __build_queue_index(self) -> None:
+        """
+        Rank the queues by score (highest score gets rank 0) and index the non-empty ones.
+        """
+        self._queue_ranks: dict[str, int] = dict()
+        self._ranked_queues: list[deque] = []
+        self._ranked_names: list[str] = []
+        for rank, (name, queue) in enumerate(
+            sorted(
+                self.__data[self._dk__waiting].items(),
+                key=lambda x: x[1]["score"],
+                reverse=True,
+            )
+        ):
+            self._queue_ranks[name] = rank
+            self._ranked_queues.append(queue["queue"])
+            self._ranked_names.append(name)
+        self._non_empty_ranks: list[int] = [
+            rank for rank, queue in enumerate(self._ranked_queues) if queue
+        ]
+        heapq.heapify(self._non_empty_ranks)
+        # Rank -> If the rank is in the heap, including the stale ones.
+        self._in_heap: list[bool] = [bool(queue) for queue in self._ranked_queues]
+        # Ranks of the paused queues.
+        self._paused_ranks: set[int] = set()
+        # Heap of (monotonic time of the next token, rank) of the throttled queues, and their ranks.
+        self._throttled: list[tuple[float, int]] = []
+        self._throttled_ranks: set[int] = set()
+        self._waiting_count: int = sum(len(queue) for queue in self._ranked_queues)
+
+    async def set_concurrency(self, concurrency: int) -> None:
         """
         Set the concurrency of the backend.
         """
         self.__data[self._dk__concurrency] = concurrency
 
-    def set_waiting(self, waitings: dict[str, dict[str, deque]]) -> None:
+    async def get_concurrency(self) -> int:
+        """
+        Get the concurrency of the backend.
+        """
+        return self._concurrency
+
+    async def set_waiting(self, waitings: dict[str, dict[str, Any]]) -> None:
         """
         Set the queue configuration.
         """
         self.__data[self._dk__waiting] = waitings
+        self.__build_queue_index()
+        self._buckets = {
+            name: TokenBucket(value["rate_limit"], value["burst"])
+            for name, value in waitings.items()
+            if value.get("rate_limit") is not None
+        }
+        if self.queue_listener is not None:
+            for name, queue in zip(self._ranked_names, self._ranked_queues):
+                self.queue_listener(name, bool(queue))
+
+    def __filled(self, queue_name: str, filled: bool) -> None:
+        if self.queue_listener is not None:
+            self.queue_listener(queue_name, filled)
+
+    def __schedule(self, rank: int) -> None:
+        """
+        Put the queue of the rank in the heap if it's ready to be popped and not in the heap yet.
+        """
+        if (
+            not self._in_heap[rank]
+            and rank not in self._paused_ranks
+            and rank not in self._throttled_ranks
+            and self._ranked_queues[rank]
+        ):
+            self._in_heap[rank] = True
+            heapq.heappush(self._non_empty_ranks, rank)
+
+    def __top(self) -> int | None:
+        """
+        Rank of the highest score queue having a task and not paused or throttled. The stale ranks are dropped from
+        the top.
+        """
+        heap = self._non_empty_ranks
+        while heap and (
+            not self._ranked_queues[heap[0]]
+            or heap[0] in self._paused_ranks
+            or heap[0] in self._throttled_ranks
+        ):
+            self._in_heap[heapq.heappop(heap)] = False
+        return heap[0] if heap else None
+
+    def __throttle(self, rank: int, delay: float) -> None:
+        """
+        Keep the queue out of the pops until its next token, delay seconds later.
+        """
+        heapq.heappush(self._throttled, (time.monotonic() + delay, rank))
+        self._throttled_ranks.add(rank)
+        self.__filled(self._ranked_names[rank], False)
+
+    def __release_throttled(self) -> None:
+        """
+        Put the throttled queues having their next token due back to the pops.
+        """
+        now = time.monotonic()
+        while self._throttled and self._throttled[0][0] <= now:
+            rank = heapq.heappop(self._throttled)[1]
+            self._throttled_ranks.discard(rank)
+            self.__schedule(rank)
+            if self._ranked_queues[rank]:
+                self.__filled(self._ranked_names[rank], True)
+
+    def __take_token(self, rank: int) -> bool:
+        """
+        Take a token of the queue if it's rate limited. The queue is throttled if there is none.
+        """
+        bucket = self._buckets.get(self._ranked_names[rank])
+        if bucket is None:
+            return True
+        delay = bucket.acquire()
+        if delay:
+            self.__throttle(rank, delay)
+            return False
+        return True
+
+    def pause_queue(self, queue_name: str) -> None:
+        """
+        Don't pop from the queue until it's resumed. Its tasks are kept, they can still be popped by its name.
+        """
+        self._paused_ranks.add(self._queue_ranks[queue_name])
+
+    def resume_queue(self, queue_name: str) -> None:
+        """
+        Pop from the paused queue again.
+        """
+        rank = self._queue_ranks[queue_name]
+        self._paused_ranks.discard(rank)
+        self.__schedule(rank)
+
+    def __push(self, task: TaskRecord) -> None:
+        queue: deque = self._waiting[task.queue_name]["queue"]
+        queue.append(task)
+        if len(queue) == 1:
+            rank = self._queue_ranks[task.queue_name]
+            self.__schedule(rank)
+            if rank not in self._throttled_ranks:
+                self.__filled(task.queue_name, True)
+        self._waiting_count += 1
+        self._task_added.set()
+
+    async def add_task_to_waiting_queue(self, task: TaskRecord) -> None:
+        """
+        Add a task to the waiting queue of the task.
+        """
+        self.__push(task)
+
+    async def add_tasks_to_waiting_queue(self, tasks: list[TaskRecord]) -> None:
+        """
+        Add many tasks to the waiting queue at once.
+        """
+        for task in tasks:
+            self.__push(task)
+
+    async def wait_for_task(self, timeout: float) -> None:
+        """
+        Wait until a task is added to the waiting queue or the timeout. It returns right away if there is any.
+        """
+        if self._waiting_count:
+            return
+        self._task_added.clear()
+        try:
+            await asyncio.wait_for(self._task_added.wait(), timeout)
+        except TimeoutError:
+            pass
+
+    async def pop_task_from_queue(self, queue_name: str) -> TaskRecord | None:
+        """
+        Pop the oldest task of a specific queue. If the queue is empty, return None.
+        """
+        queue: deque = self._waiting[queue_name]["queue"]
+        if not queue:
+            return None
+        task = queue.popleft()
+        self._waiting_count -= 1
+        if not queue:
+            self.__filled(queue_name, False)
+        return task
+
+    async def get_queue_size(self, queue_name: str) -> int:
+        """
+        Get the number of waiting tasks of a queue.
+        """
+        return len(self._waiting[queue_name]["queue"])
+
+    async def remove_task_from_waiting_queue(
+        self, queue_name: str, task_id: str
+    ) -> bool:
+        """
+        Remove a task from the waiting queue by its id. It's O(n) of the queue size.
+        Returns False if the task is not in the queue.
+        """
+        queue: deque = self._waiting[queue_name]["queue"]
+        for task in queue:
+            if task.id == task_id:
+                queue.remove(task)
+                break
+        else:
+            return False
+        self._waiting_count -= 1
+        if not queue:
+            self.__filled(queue_name, False)
+        return True
 
-    def add_task_to_waiting_queue(
-        self, queue_name: str, task: FutureFuncType, args: list = [], kwargs: dict = {}
-    ) -> None:
+    def accept_task(self, task: TaskRecord) -> Awaitable | None:
         """
-        Add a task to the waiting queue.
+        A task is started right away without going through the waiting queue. A durable backend logs it and returns
+        the awaitable of the record being stored, the task runs after it. Otherwise None.
         """
-        self._waiting[queue_name]["queue"].append(
-            {
-                "fn": task,
-                "args": args,
-                "kwargs": kwargs,
-            }
-        )
+        return None
 
-    def add_task_to_running(self, task: FutureFuncType) -> None:
+    def add_task_to_running(self, task: TaskRecord) -> None:
         """
         Add a task to the running set.
         """
         self._running.add(task)
 
-    def remove_task_from_running(self, task: FutureFuncType) -> None:
+    def remove_task_from_running(self, task: TaskRecord) -> None:
         """
         Remove a task from the running set.
         """
         self._running.remove(task)
 
-    def pop_task_from_waiting_queue(self) -> dict[str, FutureFuncType | Any] | None:
+    async def acknowledge_task(self, task_id: str) -> None:
+        """
+        Acknowledge that a task popped from the waiting queue is finished. Backends shared between processes use it
+        to forget the in-flight task. Nothing to do for the in memory backend.
+        """
+
+    async def requeue_task(self, task: TaskRecord, run_at: float | None = None) -> None:
+        """
+        Acknowledge a popped task and add it back to the end of its waiting queue to be retried. If run_at is given,
+        it's scheduled instead.
+        The backends shared between processes do it atomically, so the task is never lost in between.
+        """
+        if run_at is None:
+            self.__push(task)
+        else:
+            await self.add_task_to_scheduled(task, run_at)
+
+    async def add_task_to_scheduled(self, task: TaskRecord, run_at: float) -> None:
+        """
+        Schedule a task to be moved to its waiting queue at run_at, a unix timestamp.
+        """
+        heapq.heappush(self._scheduled, (run_at, next(self._schedule_sequence), task))
+
+    async def move_due_tasks(self) -> float | None:
+        """
+        Move the due scheduled tasks to their waiting queues in bulk.
+        Returns the run time of the next scheduled task, None if there is nothing scheduled.
+        """
+        now = time.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            self.__push(heapq.heappop(self._scheduled)[2])
+        return self._scheduled[0][0] if self._scheduled else None
+
+    async def remove_scheduled_task(self, queue_name: str, task_id: str) -> bool:
+        """
+        Remove a scheduled task by its id. It's O(n) of the scheduled tasks.
+        Returns False if the task is not scheduled.
+        """
+        for index, (_, _, task) in enumerate(self._scheduled):
+            if task.id == task_id:
+                self._scheduled[index] = self._scheduled[-1]
+                self._scheduled.pop()
+                heapq.heapify(self._scheduled)
+                return True
+        return False
+
+    async def add_task_to_dead_letter(self, task: TaskRecord) -> None:
+        """
+        Move a task failed after all the retries to the dead letter queue of its queue.
+        """
+        self._dead_letter[task.queue_name].append(task)
+
+    async def get_cached_result(self, key: str) -> Any:
+        """
+        The cached result of the dedup key. Raises KeyError if it's not cached or expired.
+        """
+        expires_at, result = self._results[key]
+        if expires_at <= time.monotonic():
+            del self._results[key]
+            raise KeyError(key)
+        self._results.move_to_end(key)
+        return result
+
+    async def set_cached_result(self, key: str, result: Any, ttl: float) -> None:
+        """
+        Cache the result of the dedup key for ttl seconds. The least recently used results are evicted over the
+        result_cache_size.
+        """
+        self._results[key] = (time.monotonic() + ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self._result_cache_size:
+            self._results.popitem(last=False)
+
+    async def get_dead_letter_tasks(self, queue_name: str) -> list[TaskRecord]:
+        """
+        Tasks in the dead letter queue of the queue, the oldest first.
+        """
+        return list(self._dead_letter.get(queue_name, ()))
+
+    async def pop_task_from_waiting_queue(
+        self, queue_names: Iterable[str] | None = None
+    ) -> TaskRecord | None:
         """
         Pop and single task from the waiting queue. If no task is available, return None.
         It'll return the task based on the queue's score. The hightest score queue's task will be returned. 0 means low priority.
+        If the queue names are given, the task is popped from the first non-empty one of them instead. It's used by
+        the schedulers. The paused queues are skipped.
+        A rate limited queue without a token is throttled, it's kept out of the pops until its next token is due. If
+        no task is popped, the runner retries after throttled_for seconds.
         """
-        for queue in sorted(
-            self._waiting.values(), key=lambda x: x["score"], reverse=True
-        ):
-            if queue["queue"]:
-                return queue["queue"].popleft()
-        return None
+        self.throttled_for = None
+        if self._throttled:
+            self.__release_throttled()
+        if queue_names is not None:
+            for queue_name in queue_names:
+                rank = self._queue_ranks[queue_name]
+                if (
+                    not self._ranked_queues[rank]
+                    or rank in self._paused_ranks
+                    or rank in self._throttled_ranks
+                    or not self.__take_token(rank)
+                ):
+                    continue
+                return await self.pop_task_from_queue(queue_name)
+            self.__set_throttled_for()
+            return None
+        while True:
+            rank = self.__top()
+            if rank is None:
+                self.__set_throttled_for()
+                return None
+            if self.__take_token(rank):
+                break
+        queue = self._ranked_queues[rank]
+        task = queue.popleft()
+        self._waiting_count -= 1
+        if not queue:
+            self._in_heap[heapq.heappop(self._non_empty_ranks)] = False
+            self.__filled(self._ranked_names[rank], False)
+        return task
+
+    def __set_throttled_for(self) -> None:
+        if self._throttled:
+            self.throttled_for = max(self._throttled[0][0] - time.monotonic(), 0.0)
 
     @property
     def _concurrency(self) -> int:
@@ -91,14 +434,14 @@ class BaseBackend(abc.ABC):
         return self.__data[self._dk__concurrency]
 
     @property
-    def _waiting(self) -> dict[str, dict[str, deque]]:
+    def _waiting(self) -> dict[str, dict[str, Any]]:
         """
         Get the queue configuration.
         """
         return self.__data[self._dk__waiting]
 
     @property
-    def _running(self) -> set:
+    def _running(self) -> set[TaskRecord]:
         """
         Get the running tasks.
         """
@@ -112,11 +455,24 @@ class BaseBackend(abc.ABC):
         return len(self._running)
 
     @property
-    def any_waiting_task(self):
+    def waiting_task_count(self) -> int:
+        """
+        Get the number of waiting tasks of all the queues.
+        """
+        return self._waiting_count
+
+    async def get_waiting_task_count(self) -> int:
+        """
+        Get the number of waiting tasks of all the queues.
+        """
+        return self._waiting_count
+
+    @property
+    def any_waiting_task(self) -> bool:
         """
         Check if there is any task in the waiting queue.
         """
-        return any([len(queue["queue"]) for queue in self._waiting.values()])
+        return self._waiting_count > 0
 
     def is_valid_queue_name(self, queue_name: str) -> bool:
         """
@@ -124,9 +480,11 @@ class BaseBackend(abc.ABC):
         """
         return queue_name in self._waiting
 
-    async def cleanup(self) -> None:
+    async def cleanup(self, drain: bool = False) -> None:
         """
         Cleanup the runner. It'll remove all the running and waiting tasks.
+        :param drain: Hand the waiting and the unacknowledged tasks back for another process instead of removing
+        them. Nothing is shared by the memory of a process, so they are removed anyway.
         """
         logger.debug("Cleaning up the runner")
         self.__data = {
@@ -134,3 +492,8 @@ class BaseBackend(abc.ABC):
             self._dk__waiting: dict(),
             self._dk__running: set(),
         }
+        self._dead_letter.clear()
+        self._scheduled.clear()
+        self._results.clear()
+        self._buckets.clear()
+        self.__build_queue_index()
@@ -1,5 +1,137 @@
+import asyncio
+from typing import Any
+
 from .base import BaseBackend
+from .journal import Journal
+
+from ..codec import TASK_ID_LENGTH, dump_task, load_task
+from ..logging import logger
+from ..schema import TaskRecord
 
 
 class InMemoryBackend(BaseBackend):
-    pass
+    """
+    The tasks are kept in the memory of the process.
+    If the journal_path is given, every accepted task is logged to the append-only journal before it's queued or
+    started, so it survives a restart. Adding a task returns when it's on the disk. On startup the pending tasks, including the ones
+    running at the time of a crash, are added back to their queues. The task functions must be importable or
+    registered, like RedisBackend.
+    """
+
+    def __init__(
+        self, journal_path: str | None = None, result_cache_size: int = 1024
+    ) -> None:
+        super().__init__(result_cache_size=result_cache_size)
+        self._journal: Journal | None = (
+            Journal(journal_path) if journal_path is not None else None
+        )
+        self._has_persistence = self._journal is not None
+
+    async def set_waiting(self, waitings: dict[str, dict[str, Any]]) -> None:
+        """
+        Set the queue configuration and add the pending tasks of the journal back to their queues.
+        """
+        await super().set_waiting(waitings)
+        if self._journal is None or self._journal.is_open:
+            return
+        pending = await asyncio.to_thread(self._journal.open)
+        for queue_name, run_at, payload in pending:
+            if not self.is_valid_queue_name(queue_name):
+                task_id = payload[:TASK_ID_LENGTH].decode("ascii")
+                logger.warning("Dropped the task %s of the unknown queue: %s", task_id, queue_name)
+                self._journal.done(task_id)
+                continue
+            try:
+                task = load_task(self.registry, queue_name, payload)
+            except Exception:
+                # e.g. the task function is renamed or removed since.
+                task_id = payload[:TASK_ID_LENGTH].decode("ascii")
+                logger.exception("Dropped the task %s of the journal, it can't be loaded", task_id)
+                self._journal.done(task_id)
+                continue
+            if run_at is None:
+                await super().add_task_to_waiting_queue(task)
+            else:
+                await super().add_task_to_scheduled(task, run_at)
+        if pending:
+            logger.info("Recovered %s tasks from the journal", len(pending))
+
+    async def __log(self, task: TaskRecord, run_at: float | None = None) -> None:
+        # Shielded, so a cancelled producer doesn't cancel the commit of the whole batch.
+        await asyncio.shield(
+            self._journal.add(task.queue_name, run_at, dump_task(self.registry, task))
+        )
+
+    async def add_task_to_waiting_queue(self, task: TaskRecord) -> None:
+        if self._journal is not None:
+            await self.__log(task)
+        await super().add_task_to_waiting_queue(task)
+
+    async def add_tasks_to_waiting_queue(self, tasks: list[TaskRecord]) -> None:
+        """
+        Add many tasks to the waiting queue at once. They are committed to the journal together.
+        """
+        if self._journal is not None and tasks:
+            commit = None
+            for task in tasks:
+                commit = self._journal.add(
+                    task.queue_name, None, dump_task(self.registry, task)
+                )
+            await asyncio.shield(commit)
+        await super().add_tasks_to_waiting_queue(tasks)
+
+    async def add_task_to_scheduled(self, task: TaskRecord, run_at: float) -> None:
+        if self._journal is not None:
+            await self.__log(task, run_at)
+        await super().add_task_to_scheduled(task, run_at)
+
+    async def requeue_task(self, task: TaskRecord, run_at: float | None = None) -> None:
+        """
+        Add the task back to its waiting queue or schedule it. The journal replaces the task, with its attempts.
+        """
+        if self._journal is not None:
+            await self.__log(task, run_at)
+        if run_at is None:
+            await super().add_task_to_waiting_queue(task)
+        else:
+            await super().add_task_to_scheduled(task, run_at)
+
+    def accept_task(self, task: TaskRecord) -> asyncio.Future | None:
+        """
+        Log the task started right away, it's added back to its queue if the process crashes before it's done.
+        """
+        if self._journal is None:
+            return None
+        return self._journal.add(task.queue_name, None, dump_task(self.registry, task))
+
+    async def acknowledge_task(self, task_id: str) -> None:
+        if self._journal is not None:
+            self._journal.done(task_id)
+
+    async def remove_task_from_waiting_queue(
+        self, queue_name: str, task_id: str
+    ) -> bool:
+        removed = await super().remove_task_from_waiting_queue(queue_name, task_id)
+        if removed and self._journal is not None:
+            self._journal.done(task_id)
+        return removed
+
+    async def remove_scheduled_task(self, queue_name: str, task_id: str) -> bool:
+        removed = await super().remove_scheduled_task(queue_name, task_id)
+        if removed and self._journal is not None:
+            self._journal.done(task_id)
+        return removed
+
+    async def cleanup(self, drain: bool = False) -> None:
+        """
+        Cleanup the runner. The journal is flushed and closed, its pending tasks are kept for the next start with or
+        without drain. So the waiting tasks and the running ones cancelled by the cleanup run again.
+        Without the journal the waiting tasks are lost even with drain.
+        """
+        if self._journal is not None:
+            await self._journal.close()
+        elif drain:
+            waiting = await self.get_waiting_task_count()
+            if waiting:
+                logger.warning("Dropped %s waiting tasks, they are kept only with a journal", waiting)
+        await super().cleanup(drain=drain)
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import os
+import struct
+import zlib
+
+from ..codec import TASK_ID_LENGTH
+from ..logging import logger
+
+# Header of every record: type, length of the body and crc32 of the body.
+RECORD_HEADER = struct.Struct("!BII")
+# Header of the body of an added task: the length of the queue name and the unix timestamp to run at (NaN if it's not
+# scheduled). The queue name and the task follow it.
+ADD_HEADER = struct.Struct("!Hd")
+RECORD_ADD = 1
+RECORD_DONE = 2
+# The log is compacted when it has more records than this and twice the pending tasks.
+COMPACT_MIN_RECORDS = 10_000
+
+
+class Journal:
+    """
+    Append-only log of the pending tasks of a backend, so they survive a restart.
+    An added task is logged with its queue and the task, a finished or removed one with its id. Adding a task again
+    (e.g. a retry) replaces it. So the pending tasks are the added ones not finished yet, including the ones running at
+    the time of a crash. They are delivered at least once.
+    Group commit: The records are buffered and a single writer writes and fsyncs them in a thread. The records added
+    while a batch is being written go to the next batch, so the fsync cost is shared by all the tasks of the batch.
+    Compaction: When the log grows over COMPACT_MIN_RECORDS and twice the pending tasks, it's rewritten with only the
+    pending tasks and atomically replaced. So replaying the log on startup is bounded by the backlog, not the history.
+    A torn record at the end of the log (a crash while writing) is detected by its crc and truncated.
+    """
+
+    def __init__(self, path: str, compact_min_records: int = COMPACT_MIN_RECORDS) -> None:
+        self.path = path
+        self._compact_min_records = compact_min_records
+        # Task id -> Body of the add record of the pending tasks, in the order they are added.
+        self._pending: dict[str, bytes] = dict()
+        self._records: int = 0
+        self._buffer: list[bytes] = []
+        # Resolved when the buffered records are on the disk.
+        self._commit: asyncio.Future | None = None
+        self._writer: asyncio.Task | None = None
+        self._file = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def open(self) -> list[tuple[str, float | None, bytes]]:
+        """
+        Replay the log and open it to append. Returns the pending tasks as (queue name, run at, task) in order.
+        """
+        self._pending.clear()
+        self._records = 0
+        if os.path.exists(self.path):
+            self._replay()
+        self._file = open(self.path, "ab")
+        pending = []
+        for body in self._pending.values():
+            name_length, run_at = ADD_HEADER.unpack_from(body)
+            queue_name_end = ADD_HEADER.size + name_length
+            pending.append(
+                (
+                    body[ADD_HEADER.size : queue_name_end].decode(),
+                    None if math.isnan(run_at) else run_at,
+                    body[queue_name_end:],
+                )
+            )
+        logger.debug("Replayed %s records, %s pending tasks", self._records, len(pending))
+        return pending
+
+    def _replay(self) -> None:
+        with open(self.path, "rb") as file:
+            data = file.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            body = data[start : start + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            if kind == RECORD_ADD:
+                task_id = self._task_id(body)
+                # Added again, it's moved to the end.
+                self._pending.pop(task_id, None)
+                self._pending[task_id] = body
+            else:
+                self._pending.pop(body.decode("ascii"), None)
+            self._records += 1
+            offset = start + length
+        if offset < len(data):
+            logger.warning("Truncating the torn end of the task log: %s", self.path)
+            with open(self.path, "r+b") as file:
+                file.truncate(offset)
+
+    @staticmethod
+    def _task_id(body: bytes) -> str:
+        name_length, _ = ADD_HEADER.unpack_from(body)
+        start = ADD_HEADER.size + name_length
+        return body[start : start + TASK_ID_LENGTH].decode("ascii")
+
+    @staticmethod
+    def _encode(kind: int, body: bytes) -> bytes:
+        return RECORD_HEADER.pack(kind, len(body), zlib.crc32(body)) + body
+
+    def add(self, queue_name: str, run_at: float | None, task: bytes) -> asyncio.Future:
+        """
+        Log an added task. Await the returned future to wait until it's on the disk.
+        """
+        name = queue_name.encode()
+        body = (
+            ADD_HEADER.pack(len(name), math.nan if run_at is None else run_at)
+            + name
+            + task
+        )
+        task_id = task[:TASK_ID_LENGTH].decode("ascii")
+        self._pending.pop(task_id, None)
+        self._pending[task_id] = body
+        return self._append(self._encode(RECORD_ADD, body))
+
+    def done(self, task_id: str) -> None:
+        """
+        Log a finished or removed task. It's not waited, losing it only runs the task again after a crash.
+        It's ignored after closing the log, the task is still pending for the next start.
+        """
+        if self._file is not None and self._pending.pop(task_id, None) is not None:
+            self._append(self._encode(RECORD_DONE, task_id.encode("ascii")))
+
+    def _append(self, record: bytes) -> asyncio.Future:
+        if self._file is None:
+            raise RuntimeError(f"Task log is not open: {self.path}")
+        self._buffer.append(record)
+        if self._commit is None:
+            self._commit = asyncio.get_running_loop().create_future()
+        commit = self._commit
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_batches())
+        return commit
+
+    async def _write_batches(self) -> None:
+        """
+        Write and fsync the buffered records until the buffer is empty.
+        """
+        try:
+            while self._buffer:
+                batch, self._buffer = self._buffer, []
+                commit, self._commit = self._commit, None
+                try:
+                    await asyncio.to_thread(self._write, b"".join(batch))
+                except OSError as err:
+                    logger.exception("Failed to write the task log: %s", self.path)
+                    if not commit.done():
+                        commit.set_exception(err)
+                    continue
+                if not commit.done():
+                    commit.set_result(None)
+                self._records += len(batch)
+                if self._records > max(self._compact_min_records, 2 * len(self._pending)):
+                    try:
+                        await self._compact()
+                    except OSError:
+                        logger.exception("Failed to compact the task log: %s", self.path)
+        finally:
+            self._writer = None
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _compact(self) -> None:
+        # The pending tasks are taken now. The records buffered meanwhile are written after, replaying them again
+        # is harmless.
+        data = b"".join(self._encode(RECORD_ADD, body) for body in self._pending.values())
+        await asyncio.to_thread(self._rewrite, data)
+        self._records = len(self._pending)
+        logger.debug("Compacted the task log to %s pending tasks", self._records)
+
+    def _rewrite(self, data: bytes) -> None:
+        compacted_path = f"{self.path}.compact"
+        with open(compacted_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(compacted_path, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+
+    async def close(self) -> None:
+        """
+        Write the buffered records and close the log. The pending tasks are kept for the next start.
+        """
+        if self._writer is not None:
+            await asyncio.shield(self._writer)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
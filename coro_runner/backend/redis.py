@@ -1,126 +1,720 @@
-from base64 import b64decode, b64encode
-from collections import deque
-import json
+import asyncio
 import pickle
-from typing import Any
-from redis import ConnectionPool, Redis
+import time
+from typing import Any, Iterable
+from uuid import uuid4
+from redis.asyncio import ConnectionPool, Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
+
+from .base import BaseBackend
+
+from ..codec import TASK_ID_LENGTH, dump_task, load_task
 from ..logging import logger
+from ..schema import RedisConfig, TaskRecord
 
-from coro_runner.types import FutureFuncType
+# Maximum number of the wake-up tokens kept. Idle workers block on the wake-up list, a token per added task wakes one.
+WAKEUP_MAX_TOKENS = 1024
+# Maximum number of the expired leases requeued by a single script call.
+REAP_BATCH_SIZE = 100
+# Maximum number of the due tasks moved per queue by a single script call.
+MOVE_DUE_BATCH_SIZE = 1000
 
-from .base import BaseBackend
+# Pops a task from the highest score non-empty queue and marks it as in-flight for the worker with a lease. It runs
+# atomically in redis, so two processes can never pop the same task. The lease deadline is taken from the redis clock,
+# so the clocks of the workers don't matter. The lease member is "<worker id>:<queue name>:<task id>".
+# A rate limited queue takes a token from its bucket, a hash of the tokens and the last update time. It's refilled
+# lazily by the redis clock, so the limit is shared by all the processes. A queue without a token is skipped and the
+# bucket expires once it would be full again. If no task is popped because of the limits, the seconds until the first
+# token are returned as a string.
+# If every queue is empty, the wake-up tokens are removed. They are left over by the tasks popped without waiting, and
+# an idle worker would pop them one by one for nothing.
+# KEYS[1]: Queue score index, KEYS[2]: In-flight hash of the worker, KEYS[3]: Leases, KEYS[4]: Wake-up tokens
+# KEYS[5]: Optional hash of the rate limits (queue name -> "<rate> <burst>")
+# ARGV[1]: Queue key prefix, ARGV[2]: Worker id, ARGV[3]: Lease timeout in seconds, ARGV[4]: Bucket key prefix
+# ARGV[5...]: Optional queue names to pop from in order instead of the score order
+POP_TASK_SCRIPT = f"""
+local names
+if #ARGV > 4 then
+    names = {{unpack(ARGV, 5)}}
+else
+    names = redis.call('ZREVRANGE', KEYS[1], 0, -1)
+end
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local limits = {{}}
+if KEYS[5] then
+    local fields = redis.call('HGETALL', KEYS[5])
+    for i = 1, #fields, 2 do
+        limits[fields[i]] = fields[i + 1]
+    end
+end
+local throttled_for
+for _, name in ipairs(names) do
+    local key = ARGV[1] .. name
+    local limit = limits[name]
+    local payload
+    if limit == nil then
+        payload = redis.call('LPOP', key)
+    elseif redis.call('LLEN', key) > 0 then
+        local rate, burst = string.match(limit, '(%S+) (%S+)')
+        rate = tonumber(rate)
+        burst = tonumber(burst)
+        local bucket = ARGV[4] .. name
+        local state = redis.call('HMGET', bucket, 'tokens', 'updated_at')
+        local tokens = burst
+        if state[1] then
+            tokens = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+        end
+        if tokens >= 1 then
+            tokens = tokens - 1
+            payload = redis.call('LPOP', key)
+        else
+            local delay = (1 - tokens) / rate
+            if throttled_for == nil or delay < throttled_for then
+                throttled_for = delay
+            end
+        end
+        redis.call('HSET', bucket, 'tokens', string.format('%.6f', tokens), 'updated_at', string.format('%.6f', now))
+        redis.call('PEXPIRE', bucket, math.ceil((burst - tokens) / rate * 1000) + 1)
+    end
+    if payload then
+        local task_id = string.sub(payload, 1, {TASK_ID_LENGTH})
+        redis.call('HSET', KEYS[2], task_id, payload)
+        redis.call('ZADD', KEYS[3], now + tonumber(ARGV[3]), ARGV[2] .. ':' .. name .. ':' .. task_id)
+        return {{name, payload}}
+    end
+end
+if throttled_for then
+    return string.format('%.6f', throttled_for)
+end
+if #ARGV > 4 then
+    -- Only some of the queues are tried, the rest may have tasks for the other workers.
+    for _, name in ipairs(redis.call('ZREVRANGE', KEYS[1], 0, -1)) do
+        if redis.call('LLEN', ARGV[1] .. name) > 0 then
+            return nil
+        end
+    end
+end
+redis.call('DEL', KEYS[4])
+return nil
+"""
+
+# Extends the leases of the in-flight tasks of a worker. The leases already reaped are not added back.
+# KEYS[1]: Leases
+# ARGV[1]: Lease timeout in seconds, ARGV[2...]: Lease members
+RENEW_LEASES_SCRIPT = """
+local now = redis.call('TIME')
+local deadline = tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[1])
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', deadline, ARGV[i])
+end
+return #ARGV - 1
+"""
+
+# Requeues the in-flight tasks of the expired leases to the front of their queues. Only the expired leases are read
+# from the sorted set, the backlog is never scanned.
+# The lease member is split on the first ':' for the worker id, which has none, and the task id is the fixed length
+# tail. The queue name in between may have ':' in it.
+# KEYS[1]: Leases
+# ARGV[1]: Key prefix, ARGV[2]: Maximum number of the leases to reap
+REAP_LEASES_SCRIPT = f"""
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+local requeued = 0
+for _, member in ipairs(members) do
+    local separator = string.find(member, ':', 1, true)
+    local inflight_key = ARGV[1] .. 'inflight:' .. string.sub(member, 1, separator - 1)
+    local task_id = string.sub(member, -{TASK_ID_LENGTH})
+    local payload = redis.call('HGET', inflight_key, task_id)
+    if payload then
+        local name = string.sub(member, separator + 1, -{TASK_ID_LENGTH + 2})
+        redis.call('HDEL', inflight_key, task_id)
+        redis.call('LPUSH', ARGV[1] .. 'queue:' .. name, payload)
+        redis.call('RPUSH', ARGV[1] .. 'wakeup', 1)
+        requeued = requeued + 1
+    end
+    redis.call('ZREM', KEYS[1], member)
+end
+return {{#members, requeued}}
+"""
+
+# Moves the due scheduled tasks of every queue to the end of the queue in the order of their run time, along with a
+# wake-up token per task. Returns the number of the moved tasks and the run time of the next scheduled task.
+# KEYS[1]: Queue score index
+# ARGV[1]: Key prefix, ARGV[2]: Now as unix timestamp, ARGV[3]: Maximum number of the tasks moved per queue
+MOVE_DUE_TASKS_SCRIPT = f"""
+local moved = 0
+local next_run_at
+for _, name in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    local scheduled = ARGV[1] .. 'scheduled:' .. name
+    local due = redis.call('ZRANGEBYSCORE', scheduled, '-inf', ARGV[2], 'LIMIT', 0, tonumber(ARGV[3]))
+    if #due > 0 then
+        redis.call('RPUSH', ARGV[1] .. 'queue:' .. name, unpack(due))
+        redis.call('ZREM', scheduled, unpack(due))
+        moved = moved + #due
+    end
+    local first = redis.call('ZRANGE', scheduled, 0, 0, 'WITHSCORES')
+    if first[2] then
+        local run_at = tonumber(first[2])
+        if next_run_at == nil or run_at < next_run_at then
+            next_run_at = run_at
+        end
+    end
+end
+for i = 1, math.min(moved, {WAKEUP_MAX_TOKENS}) do
+    redis.call('RPUSH', ARGV[1] .. 'wakeup', 1)
+end
+if moved > 0 then
+    redis.call('LTRIM', ARGV[1] .. 'wakeup', -{WAKEUP_MAX_TOKENS}, -1)
+end
+if next_run_at then
+    return {{moved, string.format('%.6f', next_run_at)}}
+end
+return {{moved}}
+"""
 
-from ..schema import RedisConfig
+# Removes a scheduled task of a queue by its id.
+# KEYS[1]: Scheduled tasks of the queue
+# ARGV[1]: Task id
+REMOVE_SCHEDULED_TASK_SCRIPT = f"""
+for _, payload in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    if string.sub(payload, 1, {TASK_ID_LENGTH}) == ARGV[1] then
+        return redis.call('ZREM', KEYS[1], payload)
+    end
+end
+return 0
+"""
+
+# Removes a task from a queue by its id. It scans the queue in redis, so the tasks are not sent over the network.
+# KEYS[1]: Queue key
+# ARGV[1]: Task id
+REMOVE_TASK_SCRIPT = f"""
+for _, payload in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if string.sub(payload, 1, {TASK_ID_LENGTH}) == ARGV[1] then
+        return redis.call('LREM', KEYS[1], 1, payload)
+    end
+end
+return 0
+"""
 
 
 class RedisBackend(BaseBackend):
-    def __init__(self, conf: RedisConfig) -> None:
+    """
+    Redis based backend. Every queue is stored as its own Redis list and the queue scores are kept in a sorted set.
+    Keys:
+        - coro_runner:concurrency -> String
+        - coro_runner:queues -> Sorted Set (queue name -> score)
+        - coro_runner:queue:<name> -> List of tasks. Every task is a struct packed header (task id, created_at and the
+          length of the task name), the task name and the pickled (args, kwargs) if there is any.
+        - coro_runner:inflight:<worker id> -> Hash (task id -> task) of the popped but not yet finished tasks.
+        - coro_runner:leases -> Sorted Set (<worker id>:<queue name>:<task id> -> lease deadline) of the in-flight
+          tasks. The workers renew the leases of their tasks, the expired ones are requeued by any worker.
+        - coro_runner:dead:<name> -> List of the tasks failed after all the retries.
+        - coro_runner:scheduled:<name> -> Sorted Set (task -> unix timestamp to run at) of the delayed tasks and the
+          retries waiting for the backoff. Any process moves the due ones to the queue.
+        - coro_runner:result:<dedup key> -> Pickled result of a task, it expires by the ttl of the cache. The LRU
+          eviction is left to the maxmemory-policy of redis.
+        - coro_runner:rate_limits -> Hash (queue name -> "<rate> <burst>") of the rate limited queues.
+        - coro_runner:bucket:<name> -> Hash (tokens, updated_at) of the token bucket of a rate limited queue. It's
+          shared by all the processes and expires when it would be full.
+        - coro_runner:wakeup -> List of wake-up tokens. A token is pushed for every added task and the idle workers
+          block on it with BLPOP. It's trimmed to WAKEUP_MAX_TOKENS, so it doesn't grow without the workers, and it's
+          removed when a pop finds every queue empty, so an idle worker doesn't wake up for the tasks already popped.
+    Channels:
+        - coro_runner:config -> The new concurrency is published here, so every process updates its local copy.
+    Enqueue is a single RPUSH and dequeue is a single lua script call. So the cost doesn't grow with the size of
+    the backlog and many processes can share the same queues.
+    It uses the asyncio client of redis with a connection pool, so a round trip never blocks the event loop.
+    Multi-command operations are pipelined.
+    Delivery is at least once. A popped task is leased for lease_timeout seconds and the lease is renewed while the
+    task is in-flight. If the worker dies, its tasks are requeued when their leases expire. On a graceful shutdown
+    (cleanup with drain) the runner requeues them right away and the shared keys are kept.
+    """
+
+    def __init__(self, conf: RedisConfig, lease_timeout: float = 60.0) -> None:
         super().__init__()
         self.r_client = self.__connect(conf)
         self._cache_prefix = "coro_runner"
+        self._dk__queues = "queues"
+        self._dk__config_channel = "config"
+        self._dk__wakeup = "wakeup"
+        self._dk__leases = "leases"
+        self._dk__rate_limits = "rate_limits"
+        self._lease_timeout = lease_timeout
+        # Renews the leases and requeues the expired ones periodically.
+        self._lease_keeper: asyncio.Task | None = None
+        # Local copy of the concurrency. It's kept up to date by the config channel, so reading it is not a round trip.
+        self._concurrency_cache: int | None = None
+        self._config_listener: asyncio.Task | None = None
+        # Queue name -> score. It's the local copy of the score index.
+        self._scores: dict[str, float] = dict()
+        # Queue name -> "<rate> <burst>" of the rate limited queues.
+        self._rate_limits: dict[str, str] = dict()
+        # Queue keys ordered by the score. Highest score first.
+        self._ordered_queue_keys: list[str] = []
+        # Queue names ordered by the score. Highest score first.
+        self._ordered_names: list[str] = []
+        # Names of the queues paused in this process.
+        self._paused: set[str] = set()
+        self._worker_id = uuid4().hex
+        # Task id -> Lease member of the tasks popped by this backend and not acknowledged yet.
+        self._inflight_ids: dict[str, str] = dict()
+        self._pop_task_script = self.r_client.register_script(POP_TASK_SCRIPT)
+        self._remove_task_script = self.r_client.register_script(REMOVE_TASK_SCRIPT)
+        self._renew_leases_script = self.r_client.register_script(RENEW_LEASES_SCRIPT)
+        self._reap_leases_script = self.r_client.register_script(REAP_LEASES_SCRIPT)
+        self._move_due_tasks_script = self.r_client.register_script(MOVE_DUE_TASKS_SCRIPT)
+        self._remove_scheduled_task_script = self.r_client.register_script(
+            REMOVE_SCHEDULED_TASK_SCRIPT
+        )
 
     def __connect(self, conf: RedisConfig) -> Redis:
         pool = ConnectionPool(
             host=conf.host,
             port=conf.port,
             db=conf.db,
+            username=conf.username,
             password=conf.password,
+            max_connections=conf.max_connections,
         )
         return Redis(connection_pool=pool)
 
-    def __close(self) -> None:
-        self.r_client.close()
+    async def __close(self) -> None:
+        for task in (self._config_listener, self._lease_keeper):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._config_listener = self._lease_keeper = None
+        await self.r_client.aclose(close_connection_pool=True)
+
+    async def __keep_leases(self) -> None:
+        """
+        Renew the leases of this worker and requeue the expired leases of the dead workers, three times per lease.
+        """
+        while True:
+            await asyncio.sleep(self._lease_timeout / 3)
+            try:
+                await self.renew_leases()
+                await self.requeue_expired_tasks()
+            except RedisError:
+                logger.exception("Failed to keep the leases")
+
+    async def __listen_config(self, subscribed: asyncio.Future) -> None:
+        """
+        Keep the local concurrency up to date with the changes published by any process.
+        """
+        async with self.r_client.pubsub() as pubsub:
+            await pubsub.subscribe(self.get_cache_key(self._dk__config_channel))
+            subscribed.set_result(None)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self._concurrency_cache = int(message["data"])
+                    logger.debug("Concurrency is changed to: %s", self._concurrency_cache)
+
+    async def __ensure_config_listener(self) -> None:
+        if self._config_listener is None:
+            subscribed = asyncio.get_running_loop().create_future()
+            self._config_listener = asyncio.create_task(
+                self.__listen_config(subscribed)
+            )
+            # Wait for the subscription, so a change published right after isn't missed.
+            await asyncio.wait(
+                [subscribed, self._config_listener],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
 
     def get_cache_key(self, key: str) -> str:
         return f"{self._cache_prefix}:{key}"
 
-    def set_concurrency(self, concurrency: int) -> None:
-        self.r_client.set(self.get_cache_key("concurrency"), concurrency)
+    def get_queue_key(self, queue_name: str) -> str:
+        return self.get_cache_key(f"queue:{queue_name}")
+
+    def get_inflight_key(self) -> str:
+        return self.get_cache_key(f"inflight:{self._worker_id}")
 
-    def __get_existing_queue(self) -> dict[str, dict[str, deque]]:
-        try:
-            data: dict = json.loads(
-                self.r_client.get(self.get_cache_key(self._dk__waiting))
+    def get_dead_letter_key(self, queue_name: str) -> str:
+        return self.get_cache_key(f"dead:{queue_name}")
+
+    def get_scheduled_key(self, queue_name: str) -> str:
+        return self.get_cache_key(f"scheduled:{queue_name}")
+
+    def get_result_key(self, key: str) -> str:
+        return self.get_cache_key(f"result:{key}")
+
+    def get_bucket_key(self, queue_name: str) -> str:
+        return self.get_cache_key(f"bucket:{queue_name}")
+
+    async def set_concurrency(self, concurrency: int) -> None:
+        """
+        Store the concurrency and publish it to the other processes in one round trip.
+        """
+        await self.__ensure_config_listener()
+        async with self.r_client.pipeline(transaction=True) as pipe:
+            pipe.set(self.get_cache_key(self._dk__concurrency), concurrency)
+            pipe.publish(self.get_cache_key(self._dk__config_channel), concurrency)
+            await pipe.execute()
+        self._concurrency_cache = concurrency
+
+    async def get_concurrency(self) -> int:
+        """
+        The local copy of the concurrency. Redis is read only once, after that the changes come by the config channel.
+        """
+        if self._concurrency_cache is None:
+            await self.__ensure_config_listener()
+            value = await self.r_client.get(self.get_cache_key(self._dk__concurrency))
+            self._concurrency_cache = int(value) if value is not None else 1
+        return self._concurrency_cache
+
+    async def set_waiting(self, waitings: dict[str, dict[str, Any]]) -> None:
+        """
+        Register the queues along with their score. The score index is stored as a sorted set and the rate limits as
+        a hash, in one round trip.
+        Existing tasks of the queues are kept as it is, so the other processes sharing the same redis don't lose them.
+        """
+        self._scores = {name: value["score"] for name, value in waitings.items()}
+        self._rate_limits = {
+            name: f"{value['rate_limit']} {value['burst']}"
+            for name, value in waitings.items()
+            if value.get("rate_limit") is not None
+        }
+        self._ordered_names = [
+            name
+            for name, _ in sorted(
+                self._scores.items(), key=lambda x: x[1], reverse=True
+            )
+        ]
+        self._ordered_queue_keys = [self.get_queue_key(name) for name in self._ordered_names]
+        async with self.r_client.pipeline(transaction=False) as pipe:
+            if self._scores:
+                pipe.zadd(self.get_cache_key(self._dk__queues), self._scores)
+            if self._rate_limits:
+                pipe.hset(
+                    self.get_cache_key(self._dk__rate_limits), mapping=self._rate_limits
+                )
+            await pipe.execute()
+        if self._lease_keeper is None:
+            self._lease_keeper = asyncio.create_task(self.__keep_leases())
+
+    async def add_task_to_waiting_queue(self, task: TaskRecord) -> None:
+        """
+        Adding a task to the waiting queue. It's a RPUSH to the queue's list along with a wake-up token in one
+        pipeline.
+        """
+        async with self.r_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.get_queue_key(task.queue_name), self.__dump_task(task))
+            self.__wake_up(pipe, 1)
+            await pipe.execute()
+
+    async def add_tasks_to_waiting_queue(self, tasks: list[TaskRecord]) -> None:
+        """
+        Adding many tasks to the waiting queue. It's a single RPUSH per queue, all of them sent in one pipeline.
+        """
+        payloads: dict[str, list[bytes]] = dict()
+        for task in tasks:
+            payloads.setdefault(self.get_queue_key(task.queue_name), []).append(
+                self.__dump_task(task)
             )
-            for key, value in data.items():
-                data[key]["queue"] = pickle.loads(b64decode(value["queue"]))
-            return data
-        except Exception:
-            logger.error("Error parsing the queue. Probably no queue.")
-            import traceback
-
-            print(traceback.format_exc())
-            return {}
-
-    def set_waiting(self, waitings: dict[str, dict[str, deque]]) -> None:
-        """
-        Set the waiting queue in the cache.
-        We are going to store the waiting queue as pickled data in the cache. Because we have functions in the queue. Without
-        the pickling, we can't store the functions in the cache.
-        """
-        jsonable_data = dict()
-        for key, value in waitings.items():
-            jsonable_data[key] = {
-                "score": value["score"],
-                "queue": b64encode(pickle.dumps(value["queue"])).decode("ascii"),
-            }
-        self.r_client.set(self.get_cache_key("waiting"), json.dumps(jsonable_data))
-
-    def add_task_to_waiting_queue(
-        self, queue_name: str, task: FutureFuncType, args: list = [], kwargs: dict = {}
-    ) -> None:
-        """ "
-        Adding a task to the waiting queue. Once again read from cache append and pickle dump again.
-        """
-        data: dict = json.loads(
-            self.r_client.get(self.get_cache_key(self._dk__waiting))
+        async with self.r_client.pipeline(transaction=False) as pipe:
+            for key, items in payloads.items():
+                pipe.rpush(key, *items)
+            self.__wake_up(pipe, len(tasks))
+            await pipe.execute()
+
+    def __wake_up(self, pipe: Pipeline, tasks: int) -> None:
+        """
+        Push a wake-up token per task, up to WAKEUP_MAX_TOKENS.
+        """
+        key = self.get_cache_key(self._dk__wakeup)
+        pipe.rpush(key, *([1] * min(tasks, WAKEUP_MAX_TOKENS)))
+        pipe.ltrim(key, -WAKEUP_MAX_TOKENS, -1)
+
+    async def wait_for_task(self, timeout: float) -> None:
+        """
+        Block until a wake-up token is pushed or the timeout. The connection is blocked, not the event loop.
+        """
+        await self.r_client.blpop([self.get_cache_key(self._dk__wakeup)], timeout)
+
+    async def pop_task_from_waiting_queue(
+        self, queue_names: Iterable[str] | None = None
+    ) -> TaskRecord | None:
+        """
+        Pop a single task from the highest score non-empty queue and mark it as in-flight. It's done by a lua script,
+        so it's atomic across all the processes sharing the redis.
+        If the queue names are given, it's popped from the first non-empty one of them instead. The queues paused in
+        this process are left out of the names given to the script, it's O(n) of the queues as the script is.
+        The rate limited queues without a token are skipped by the script. The runner retries after throttled_for.
+        A task which can't be loaded, e.g. its name is not registered in this process, is moved to the dead letter
+        queue and the next one is popped.
+        """
+        self.throttled_for = None
+        if queue_names is None and self._paused:
+            queue_names = self._ordered_names
+        if queue_names is not None:
+            queue_names = [name for name in queue_names if name not in self._paused]
+            if not queue_names:
+                return None
+        while True:
+            popped = await self.__pop_payload(queue_names)
+            if popped is None:
+                return None
+            queue_name, payload = popped
+            try:
+                task = self.__load_task(queue_name, payload)
+            except Exception:
+                # The raw id, as the script took it.
+                task_id = payload[:TASK_ID_LENGTH]
+                logger.exception(
+                    "Moved the task %r of the queue %s to the dead letter queue, it can't be loaded",
+                    task_id,
+                    queue_name,
+                )
+                async with self.r_client.pipeline(transaction=True) as pipe:
+                    pipe.hdel(self.get_inflight_key(), task_id)
+                    pipe.zrem(
+                        self.get_cache_key(self._dk__leases),
+                        f"{self._worker_id}:{queue_name}:".encode() + task_id,
+                    )
+                    pipe.rpush(self.get_dead_letter_key(queue_name), payload)
+                    await pipe.execute()
+                continue
+            self._inflight_ids[task.id] = f"{self._worker_id}:{task.queue_name}:{task.id}"
+            return task
+
+    async def __pop_payload(
+        self, queue_names: list[str] | None
+    ) -> tuple[str, bytes] | None:
+        """
+        Pop the payload of a task along with its queue name by the lua script. It's None if there is no task.
+        """
+        keys = [
+            self.get_cache_key(self._dk__queues),
+            self.get_inflight_key(),
+            self.get_cache_key(self._dk__leases),
+            self.get_cache_key(self._dk__wakeup),
+        ]
+        if self._rate_limits:
+            keys.append(self.get_cache_key(self._dk__rate_limits))
+        data = await self._pop_task_script(
+            keys=keys,
+            args=[
+                self.get_queue_key(""),
+                self._worker_id,
+                self._lease_timeout,
+                self.get_bucket_key(""),
+                *(queue_names or ()),
+            ],
         )
-        # Append is same for deque and list. We can use it directly.
-        _data = pickle.loads(b64decode(data[queue_name]["queue"]))
-        _data.append(
-            {
-                "fn": task,
-                "args": args,
-                "kwargs": kwargs,
-            }
+        if data is None:
+            return None
+        if isinstance(data, bytes):
+            self.throttled_for = float(data)
+            return None
+        queue_name, payload = data
+        return queue_name.decode(), payload
+
+    def pause_queue(self, queue_name: str) -> None:
+        """
+        Don't pop from the queue in this process until it's resumed. The other processes still pop from it.
+        """
+        self._paused.add(queue_name)
+
+    def resume_queue(self, queue_name: str) -> None:
+        """
+        Pop from the paused queue again.
+        """
+        self._paused.discard(queue_name)
+
+    async def pop_task_from_queue(self, queue_name: str) -> TaskRecord | None:
+        """
+        Pop the oldest task of a specific queue. It's not marked as in-flight because it's not going to run.
+        """
+        payload = await self.r_client.lpop(self.get_queue_key(queue_name))
+        if payload is None:
+            return None
+        return self.__load_task(queue_name, payload)
+
+    async def get_queue_size(self, queue_name: str) -> int:
+        return await self.r_client.llen(self.get_queue_key(queue_name))
+
+    async def get_waiting_task_count(self) -> int:
+        """
+        Sum of the length of all the queues in one round trip.
+        """
+        async with self.r_client.pipeline(transaction=False) as pipe:
+            for key in self._ordered_queue_keys:
+                pipe.llen(key)
+            return sum(await pipe.execute())
+
+    async def remove_task_from_waiting_queue(
+        self, queue_name: str, task_id: str
+    ) -> bool:
+        """
+        Remove a task from the waiting queue by its id. It's a single lua script call.
+        """
+        return bool(
+            await self._remove_task_script(
+                keys=[self.get_queue_key(queue_name)], args=[task_id]
+            )
+        )
+
+    async def acknowledge_task(self, task_id: str) -> None:
+        """
+        The task is finished. Remove it from the in-flight tasks along with its lease if it was popped by this backend.
+        """
+        lease = self._inflight_ids.pop(task_id, None)
+        if lease is not None:
+            async with self.r_client.pipeline(transaction=True) as pipe:
+                pipe.hdel(self.get_inflight_key(), task_id)
+                pipe.zrem(self.get_cache_key(self._dk__leases), lease)
+                await pipe.execute()
+
+    async def requeue_task(self, task: TaskRecord, run_at: float | None = None) -> None:
+        """
+        Acknowledge the task and add it back to its queue or schedule it in one transaction.
+        """
+        lease = self._inflight_ids.pop(task.id, None)
+        async with self.r_client.pipeline(transaction=True) as pipe:
+            if lease is not None:
+                pipe.hdel(self.get_inflight_key(), task.id)
+                pipe.zrem(self.get_cache_key(self._dk__leases), lease)
+            if run_at is None:
+                pipe.rpush(self.get_queue_key(task.queue_name), self.__dump_task(task))
+                self.__wake_up(pipe, 1)
+            else:
+                pipe.zadd(
+                    self.get_scheduled_key(task.queue_name),
+                    {self.__dump_task(task): run_at},
+                )
+            await pipe.execute()
+
+    async def add_task_to_scheduled(self, task: TaskRecord, run_at: float) -> None:
+        """
+        Schedule a task by a ZADD to the scheduled set of its queue. The run time is taken from the clock of the
+        process adding the task, so the clocks of the processes should be in sync.
+        """
+        await self.r_client.zadd(
+            self.get_scheduled_key(task.queue_name), {self.__dump_task(task): run_at}
         )
-        data[queue_name]["queue"] = b64encode(pickle.dumps(_data)).decode("ascii")
-        self.r_client.set(self.get_cache_key(self._dk__waiting), json.dumps(data))
 
-    def pop_task_from_waiting_queue(self) -> dict[str, FutureFuncType | Any] | None:
+    async def move_due_tasks(self) -> float | None:
         """
-        Pop Left is the hard task sometimes because we need to pickle and unpickle the data along with the queue score.
+        Move the due scheduled tasks of all the queues to their queues by a single lua script call. Only the due
+        tasks are read from the sorted sets. If there are more than MOVE_DUE_BATCH_SIZE due tasks in a queue, the
+        next run time is in the past, so the runner calls it again right away.
         """
-        current_waitings = self._waiting
-        for q_name, queue in sorted(
-            current_waitings.items(), key=lambda x: x[1]["score"], reverse=True
-        ):
-            if queue["queue"]:
-                q = queue["queue"].popleft()
+        moved, *next_run_at = await self._move_due_tasks_script(
+            keys=[self.get_cache_key(self._dk__queues)],
+            args=[self.get_cache_key(""), time.time(), MOVE_DUE_BATCH_SIZE],
+        )
+        if moved:
+            logger.debug("Moved %s due tasks to the queues", moved)
+        return float(next_run_at[0]) if next_run_at else None
 
-                # Set the new queue
-                current_waitings[q_name] = queue
-                self.set_waiting(current_waitings)
-                return q
-        return None
+    async def remove_scheduled_task(self, queue_name: str, task_id: str) -> bool:
+        return bool(
+            await self._remove_scheduled_task_script(
+                keys=[self.get_scheduled_key(queue_name)], args=[task_id]
+            )
+        )
+
+    async def add_task_to_dead_letter(self, task: TaskRecord) -> None:
+        await self.r_client.rpush(
+            self.get_dead_letter_key(task.queue_name), self.__dump_task(task)
+        )
 
-    @property
-    def _concurrency(self) -> int:
-        return int(self.r_client.get(self.get_cache_key(self._dk__concurrency)))
+    async def get_cached_result(self, key: str) -> Any:
+        payload = await self.r_client.get(self.get_result_key(key))
+        if payload is None:
+            raise KeyError(key)
+        return pickle.loads(payload)
 
-    @property
-    def _waiting(self) -> dict[str, dict[str, deque]]:
+    async def set_cached_result(self, key: str, result: Any, ttl: float) -> None:
         """
-        Get the waiting tasks from the cache. We are storing the queue as pickled data in the cache. We need to unpickle it.
+        Cache the pickled result with an expiry, so every process sharing the redis gets it.
         """
-        data: dict = json.loads(
-            self.r_client.get(self.get_cache_key(self._dk__waiting))
+        await self.r_client.set(
+            self.get_result_key(key),
+            pickle.dumps(result, pickle.HIGHEST_PROTOCOL),
+            px=max(int(ttl * 1000), 1),
         )
-        for key, value in data.items():
-            data[key]["queue"] = pickle.loads(b64decode(value["queue"]))
-        return data
-
-    async def cleanup(self):
-        self.r_client.delete(self.get_cache_key(self._dk__concurrency))
-        self.r_client.delete(self.get_cache_key(self._dk__waiting))
-        self.__close()
+
+    async def get_dead_letter_tasks(self, queue_name: str) -> list[TaskRecord]:
+        """
+        The tasks of the dead letter queue. The ones which can't be loaded in this process are skipped.
+        """
+        payloads = await self.r_client.lrange(self.get_dead_letter_key(queue_name), 0, -1)
+        tasks = []
+        for payload in payloads:
+            try:
+                tasks.append(self.__load_task(queue_name, payload))
+            except Exception:
+                logger.warning("Skipped a dead letter task of %s, it can't be loaded", queue_name)
+        return tasks
+
+    async def renew_leases(self) -> None:
+        """
+        Extend the leases of the in-flight tasks of this backend by lease_timeout from now.
+        """
+        if self._inflight_ids:
+            await self._renew_leases_script(
+                keys=[self.get_cache_key(self._dk__leases)],
+                args=[self._lease_timeout, *self._inflight_ids.values()],
+            )
+
+    async def requeue_expired_tasks(self) -> int:
+        """
+        Requeue the in-flight tasks of the expired leases, e.g. the tasks of a dead worker. They are pushed to the
+        front of their queues. It's done in batches of REAP_BATCH_SIZE leases.
+        Returns the number of the requeued tasks.
+        """
+        requeued = 0
+        while True:
+            reaped, batch_requeued = await self._reap_leases_script(
+                keys=[self.get_cache_key(self._dk__leases)],
+                args=[self.get_cache_key(""), REAP_BATCH_SIZE],
+            )
+            requeued += batch_requeued
+            if reaped < REAP_BATCH_SIZE:
+                break
+        if requeued:
+            logger.warning("Requeued %s tasks of the expired leases", requeued)
+        return requeued
+
+    def __dump_task(self, task: TaskRecord) -> bytes:
+        return dump_task(self.registry, task)
+
+    def __load_task(self, queue_name: str, payload: bytes) -> TaskRecord:
+        return load_task(self.registry, queue_name, payload)
+
+    def is_valid_queue_name(self, queue_name: str) -> bool:
+        return queue_name in self._scores
+
+    async def cleanup(self, drain: bool = False) -> None:
+        """
+        Cleanup the backend. It removes all the keys of the queues, shared with the other processes.
+        With drain, the keys are kept for the other workers. The runner has requeued its interrupted tasks already.
+        """
+        if drain:
+            await self.__close()
+            return
+        async with self.r_client.pipeline(transaction=False) as pipe:
+            pipe.delete(
+                self.get_cache_key(self._dk__concurrency),
+                self.get_cache_key(self._dk__queues),
+                self.get_cache_key(self._dk__wakeup),
+                self.get_cache_key(self._dk__rate_limits),
+                self.get_inflight_key(),
+                *self._ordered_queue_keys,
+                *[self.get_dead_letter_key(name) for name in self._scores],
+                *[self.get_scheduled_key(name) for name in self._scores],
+                *[self.get_bucket_key(name) for name in self._rate_limits],
+            )
+            if self._inflight_ids:
+                pipe.zrem(
+                    self.get_cache_key(self._dk__leases), *self._inflight_ids.values()
+                )
+            await pipe.execute()
+        self._inflight_ids.clear()
+        await self.__close()
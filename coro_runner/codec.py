@@ -0,0 +1,47 @@
+import pickle
+import struct
+
+from .registry import TaskRegistry
+from .schema import TaskRecord
+
+# Length of the task id prefix of every stored task. It's an uuid4 hex.
+TASK_ID_LENGTH = 32
+# Header of every stored task: task id, created_at, attempts and the length of the task name.
+TASK_HEADER = struct.Struct(f"!{TASK_ID_LENGTH}sdHH")
+
+
+def dump_task(registry: TaskRegistry, task: TaskRecord) -> bytes:
+    """
+    Binary form of a task stored by the backends. Only the registered name of the function is stored, not the
+    function itself. The task id comes first, so it can be read without decoding the task. The queue name is not
+    stored, it's known from the queue.
+    """
+    name = registry.name_of(task.fn).encode()
+    payload = TASK_HEADER.pack(
+        task.id.encode("ascii"), task.created_at, task.attempts, len(name)
+    )
+    if task.args or task.kwargs:
+        return (
+            payload
+            + name
+            + pickle.dumps((task.args, task.kwargs), pickle.HIGHEST_PROTOCOL)
+        )
+    return payload + name
+
+
+def load_task(registry: TaskRegistry, queue_name: str, payload: bytes) -> TaskRecord:
+    task_id, created_at, attempts, name_length = TASK_HEADER.unpack_from(payload)
+    body_start = TASK_HEADER.size + name_length
+    name = payload[TASK_HEADER.size : body_start].decode()
+    args, kwargs = (
+        pickle.loads(payload[body_start:]) if len(payload) > body_start else ([], {})
+    )
+    return TaskRecord(
+        id=task_id.decode("ascii"),
+        fn=registry.resolve(name),
+        args=args,
+        kwargs=kwargs,
+        queue_name=queue_name,
+        created_at=created_at,
+        attempts=attempts,
+    )
@@ -7,3 +7,23 @@ class TaskStatusEnum(Enum):
     FINISHED = 2
     FAILED = 3
     CANCELLED = 4
+
+
+class OverflowPolicyEnum(Enum):
+    """
+    What to do when a task is added to a full waiting queue.
+    """
+
+    RAISE = 0
+    DROP_OLDEST = 1
+    DROP_NEWEST = 2
+    WAIT = 3
+
+
+class ExecutorTypeEnum(Enum):
+    """
+    Executor of a queue's tasks. The tasks of a queue without an executor run on the event loop.
+    """
+
+    THREAD = 0
+    PROCESS = 1
@@ -0,0 +1,16 @@
+class QueueFullError(Exception):
+    """
+    Raised when a task is added to a full queue having the RAISE overflow policy.
+    """
+
+
+class RunnerClosedError(Exception):
+    """
+    Raised when a task is added to a runner being cleaned up or already cleaned up.
+    """
+
+
+class ShardDiedError(Exception):
+    """
+    Raised for a task taken by a shard of ShardedRunner which died before finishing it.
+    """
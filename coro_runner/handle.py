@@ -0,0 +1,139 @@
+import asyncio
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Generator
+
+from .enums import TaskStatusEnum
+
+if TYPE_CHECKING:
+    from .runner import CoroRunner
+
+
+class TaskHandle:
+    """
+    Handle of a task added to the runner. It's returned by CoroRunner.add_task.
+    Await the handle to get the result of the task. The result is only available if the task is run by the same runner.
+    """
+
+    __slots__ = ("id", "queue_name", "_future", "_runner")
+
+    def __init__(
+        self,
+        task_id: str,
+        queue_name: str,
+        future: asyncio.Future,
+        runner: "CoroRunner",
+    ) -> None:
+        self.id = task_id
+        self.queue_name = queue_name
+        self._future = future
+        self._runner = runner
+
+    def __await__(self) -> Generator[Any, None, Any]:
+        # Shielded, so cancelling the awaiting coroutine doesn't cancel the task.
+        return asyncio.shield(self._future).__await__()
+
+    def __repr__(self) -> str:
+        return f"<TaskHandle id={self.id} queue={self.queue_name} status={self.status.name}>"
+
+    @property
+    def status(self) -> TaskStatusEnum:
+        """
+        Current status of the task.
+        """
+        if self._future.cancelled():
+            return TaskStatusEnum.CANCELLED
+        if self._future.done():
+            if self._future.exception() is not None:
+                return TaskStatusEnum.FAILED
+            return TaskStatusEnum.FINISHED
+        if self._runner.is_running(self.id):
+            return TaskStatusEnum.RUNNING
+        return TaskStatusEnum.PENDING
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self) -> Any:
+        """
+        Result of the finished task. Raises the exception of the task if it's failed.
+        """
+        return self._future.result()
+
+    def cancel(self) -> bool:
+        """
+        Cancel the task. A running task is cancelled and a waiting task is removed from the waiting queue.
+        Returns False if the task is already finished or not found.
+        """
+        return self._runner.cancel_task(self)
+
+
+def collect(handles: list[TaskHandle], done: Callable[[Any], None]) -> None:
+    """
+    Call done with the results of the handles in their order when all of them are finished, or with the exception of
+    the first failed or cancelled one (CancelledError if it's cancelled). It's a callback per handle and a counter, so
+    it's O(handles) however big the fan-in is.
+    """
+    results: list[Any] = [None] * len(handles)
+    # Number of the handles not finished yet, -1 after a failure.
+    remaining = len(handles)
+
+    def handle_done(index: int, future: asyncio.Future) -> None:
+        nonlocal remaining
+        if remaining < 0:
+            return
+        if future.cancelled() or future.exception() is not None:
+            remaining = -1
+            done(asyncio.CancelledError() if future.cancelled() else future.exception())
+            return
+        results[index] = future.result()
+        remaining -= 1
+        if remaining == 0:
+            done(results)
+
+    if not handles:
+        done(results)
+    for index, handle in enumerate(handles):
+        handle._future.add_done_callback(partial(handle_done, index))
+
+
+class GroupHandle:
+    """
+    Handle of a group of tasks. It's returned by CoroRunner.group.
+    Await it to get the results of the tasks in their order. It raises the exception of the first failed task.
+    """
+
+    __slots__ = ("handles", "_future")
+
+    def __init__(self, handles: list[TaskHandle]) -> None:
+        self.handles = handles
+        self._future: asyncio.Future = asyncio.get_running_loop().create_future()
+        collect(handles, self._set_outcome)
+
+    def _set_outcome(self, outcome: Any) -> None:
+        if self._future.done():
+            return
+        if isinstance(outcome, asyncio.CancelledError):
+            self._future.cancel()
+        elif isinstance(outcome, BaseException):
+            self._future.set_exception(outcome)
+        else:
+            self._future.set_result(outcome)
+
+    def __await__(self) -> Generator[Any, None, list[Any]]:
+        return asyncio.shield(self._future).__await__()
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+    def __repr__(self) -> str:
+        return f"<GroupHandle tasks={len(self.handles)} done={self.done()}>"
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def cancel(self) -> bool:
+        """
+        Cancel the tasks of the group not finished yet. Returns False if all of them are finished.
+        """
+        cancelled = [handle.cancel() for handle in self.handles]
+        return any(cancelled)
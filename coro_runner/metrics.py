@@ -0,0 +1,146 @@
+from bisect import bisect_left
+import time
+from typing import Any, Iterable
+
+# Upper bounds (seconds) of the latency histogram buckets.
+DEFAULT_LATENCY_BUCKETS: tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram. Observing a value is a binary search over the buckets. O(log n)
+    """
+
+    __slots__ = ("_bounds", "_counts", "_sum", "_count")
+
+    def __init__(self, bounds: Iterable[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self._bounds: tuple[float, ...] = tuple(sorted(bounds))
+        # The last one is for the values bigger than the last bound.
+        self._counts: list[int] = [0] * (len(self._bounds) + 1)
+        self._sum: float = 0.0
+        self._count: int = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Cumulative bucket counts keyed by the upper bound like prometheus. "+Inf" has all of the values.
+        """
+        buckets: dict[str, int] = dict()
+        cumulative = 0
+        for bound, count in zip(self._bounds, self._counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets["+Inf"] = self._count
+        return {"buckets": buckets, "sum": self._sum, "count": self._count}
+
+
+class QueueMetrics:
+    """
+    Counters, gauges and latency histograms of a single queue.
+    failed counts every failed run, retried counts the retries and dead counts the tasks moved to the dead letter queue.
+    timed_out counts the runs cancelled by their timeout, they are counted as failed too.
+    deduplicated counts the additions collapsed into a pending or running task and cache_hits the additions answered
+    by the result cache.
+    wait_time: Seconds from adding the task to starting it.
+    run_time: Seconds from starting the task to finishing it.
+    """
+
+    __slots__ = (
+        "enqueued",
+        "started",
+        "finished",
+        "failed",
+        "cancelled",
+        "retried",
+        "dead",
+        "timed_out",
+        "deduplicated",
+        "cache_hits",
+        "waiting",
+        "running",
+        "wait_time",
+        "run_time",
+    )
+
+    def __init__(self) -> None:
+        self.enqueued: int = 0
+        self.started: int = 0
+        self.finished: int = 0
+        self.failed: int = 0
+        self.cancelled: int = 0
+        self.retried: int = 0
+        self.dead: int = 0
+        self.timed_out: int = 0
+        self.deduplicated: int = 0
+        self.cache_hits: int = 0
+        self.waiting: int = 0
+        self.running: int = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "enqueued": self.enqueued,
+            "started": self.started,
+            "finished": self.finished,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "retried": self.retried,
+            "dead": self.dead,
+            "timed_out": self.timed_out,
+            "deduplicated": self.deduplicated,
+            "cache_hits": self.cache_hits,
+            "waiting": self.waiting,
+            "running": self.running,
+            "wait_time": self.wait_time.snapshot(),
+            "run_time": self.run_time.snapshot(),
+        }
+
+
+class RunnerMetrics:
+    """
+    Metrics of a runner. Everything is kept in the process, so taking a snapshot doesn't talk to the backend.
+    The gauges are the view of this runner. The waiting gauge counts the tasks added by this runner until it starts
+    or removes them. With a shared backend, the ones popped by other processes stay counted. The tasks added by other
+    processes and the ones recovered from the journal are not counted, so the gauge never goes negative.
+    """
+
+    def __init__(self, queue_names: Iterable[str]) -> None:
+        self._started_at: float = time.monotonic()
+        self.queues: dict[str, QueueMetrics] = {
+            name: QueueMetrics() for name in queue_names
+        }
+
+    def __getitem__(self, queue_name: str) -> QueueMetrics:
+        return self.queues[queue_name]
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Snapshot of all the metrics as a JSON serializable dict.
+        """
+        uptime = time.monotonic() - self._started_at
+        queues = {name: metrics.snapshot() for name, metrics in self.queues.items()}
+        finished = sum(q["finished"] + q["failed"] for q in queues.values())
+        return {
+            "uptime": uptime,
+            "running": sum(q["running"] for q in queues.values()),
+            "waiting": sum(q["waiting"] for q in queues.values()),
+            "throughput": finished / uptime if uptime else 0.0,
+            "queues": queues,
+        }
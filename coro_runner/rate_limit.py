@@ -0,0 +1,30 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket of a rate limited queue. It's refilled by rate tokens per second up to burst tokens and it starts
+    full. Starting a task takes a token. The refill is computed lazily on every take, so there is no timer per bucket.
+    """
+
+    __slots__ = ("rate", "burst", "_tokens", "_updated_at")
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens: float = burst
+        self._updated_at: float = time.monotonic()
+
+    def acquire(self) -> float:
+        """
+        Take a token. Returns 0 if it's taken, otherwise the seconds until a token is available.
+        """
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
@@ -0,0 +1,77 @@
+from importlib import import_module
+from inspect import ismethod
+from typing import Callable
+
+from .types import FutureFuncType, SyncFuncType
+
+
+class TaskRegistry:
+    """
+    Name -> task function map. Only the name of the function is sent to the backend, so the producers and the
+    consumers don't need the same code objects, only the same names.
+    The functions not registered are named by their import path (module:qualname) and imported back by it.
+    """
+
+    __slots__ = ("_functions", "_names")
+
+    def __init__(self) -> None:
+        self._functions: dict[str, FutureFuncType | SyncFuncType] = dict()
+        self._names: dict[FutureFuncType | SyncFuncType, str] = dict()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._functions
+
+    def register(
+        self, fn: FutureFuncType | SyncFuncType, name: str | None = None
+    ) -> FutureFuncType | SyncFuncType:
+        """
+        Register a task function. The name defaults to the import path of the function.
+        """
+        name = name or self.import_path(fn)
+        registered = self._functions.get(name)
+        if registered is not None and registered is not fn:
+            raise ValueError(f"Task name is already registered: {name}")
+        self._functions[name] = fn
+        self._names[fn] = name
+        return fn
+
+    def name_of(self, fn: FutureFuncType | SyncFuncType) -> str:
+        """
+        Name of the task function. Raises ValueError if it's not registered and can't be imported by its name.
+        """
+        name = self._names.get(fn)
+        if name is None:
+            name = self.import_path(fn)
+            if "<" in name or ismethod(fn):
+                raise ValueError(
+                    f"Lambdas, nested functions and methods must be registered: {name}"
+                )
+            # Cached, so the import path is built once per function.
+            self._names[fn] = name
+        return name
+
+    def resolve(self, name: str) -> FutureFuncType | SyncFuncType:
+        """
+        Function of the task name. If it's not registered, it's imported by the import path and cached.
+        """
+        fn = self._functions.get(name)
+        if fn is None:
+            fn = self._functions[name] = self.import_function(name)
+        return fn
+
+    @staticmethod
+    def import_path(fn: Callable) -> str:
+        return f"{fn.__module__}:{fn.__qualname__}"
+
+    @staticmethod
+    def import_function(name: str) -> FutureFuncType | SyncFuncType:
+        module_name, _, qualname = name.partition(":")
+        if not qualname or "<locals>" in qualname:
+            raise LookupError(f"Task is not registered: {name}")
+        try:
+            fn = import_module(module_name)
+            for attr in qualname.split("."):
+                fn = getattr(fn, attr)
+        except (ImportError, AttributeError) as err:
+            raise LookupError(f"Task is not registered: {name}") from err
+        return fn
@@ -1,13 +1,34 @@
 import asyncio
-from typing import Any
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+import heapq
+from importlib import import_module
+from inspect import iscoroutinefunction, isroutine
+from itertools import count
+import multiprocessing
+import time
+from typing import Any, AsyncIterator, Awaitable, Coroutine, Iterable
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
 from .backend import BaseBackend, InMemoryBackend
 
+from .enums import ExecutorTypeEnum, OverflowPolicyEnum
+from .exceptions import QueueFullError, RunnerClosedError
+from .handle import GroupHandle, TaskHandle, collect
 from .utils import prepare_queue
 from .logging import logger
+from .metrics import RunnerMetrics
+from .registry import TaskRegistry
+from .scheduler import BaseScheduler, PriorityScheduler
 
-from .schema import QueueConfig
-from .types import FutureFuncType
+from .schema import Queue, QueueConfig, Step, TaskRecord
+from .types import FutureFuncType, HookType, SyncFuncType, TaskSpec
+
+# Seconds after a producer waiting for room in a bounded queue checks the queue again.
+BOUNDED_QUEUE_RECHECK_INTERVAL = 1.0
 
 
 class CoroRunner:
@@ -41,87 +62,1181 @@ class CoroRunner:
         self,
         concurrency: int,
         queue_conf: QueueConfig | None = None,
-        backend: BaseBackend = InMemoryBackend(),
+        backend: BaseBackend | None = None,
+        scheduler: BaseScheduler | None = None,
     ) -> None:
         self._default_queue: str = "default"
         if queue_conf is None:
             queue_conf = QueueConfig(queues=[])
-        self._backend = backend
-        # Update the backend
-        self._backend.set_concurrency(concurrency)
-        self._backend.set_waiting(
-            waitings=prepare_queue(queue_conf.queues, default_name=self._default_queue)
-        )
-        self._loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        # Queue name -> Queue. Having the default queue too.
+        self._queues: dict[str, Queue] = {
+            self._default_queue: Queue(name=self._default_queue, score=0)
+        }
+        self._queues.update({queue.name: queue for queue in queue_conf.queues})
+        # The queues having their own concurrency limit.
+        self._limited_queues: list[Queue] = [
+            queue for queue in self._queues.values() if queue.max_concurrency is not None
+        ]
+        # Names of the rate limited queues. Their tasks are always started through the waiting queue, so every start
+        # takes a token of the queue's bucket in the backend.
+        self._rate_limited: set[str] = {
+            queue.name for queue in self._queues.values() if queue.rate_limit is not None
+        }
+        # Decides the queue of the next waiting task. Strict priority by the score by default.
+        self._scheduler: BaseScheduler = scheduler or PriorityScheduler()
+        self._scheduler.setup(self._queues.values())
+        # Queue name -> Executor of the executor lanes.
+        self._executors: dict[str, Executor] = {
+            queue.name: self._create_executor(queue)
+            for queue in queue_conf.queues
+            if queue.executor is not None
+        }
+        self._registry = TaskRegistry()
+        self._backend = backend if backend is not None else InMemoryBackend()
+        # Only the names of the task functions are sent to the backend, it resolves them with the runner's registry.
+        self._backend.registry = self._registry
+        # The scheduler follows the queues getting filled or empty, if the backend tells it.
+        self._backend.queue_listener = self._scheduler.queue_filled
+        self._concurrency = concurrency
+        self._waitings = prepare_queue(queue_conf.queues, default_name=self._default_queue)
+        # The backend is set up on the first use, because the backend API is async.
+        self._setup_future: asyncio.Future | None = None
+        # It's set when there is no running task and nothing left in the waiting queue.
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # It's set when the runner is cleaned up.
+        self._exit = asyncio.Event()
+        # It's set by cleanup. The runner doesn't accept or start any task after that.
+        self._closing = False
+        # It's set when a running task is finished. A serving runner waits on it while the concurrency is full.
+        self._task_finished = asyncio.Event()
+        # The task running serve, it's cancelled by cleanup.
+        self._serving: asyncio.Task | None = None
+        # Task id -> Future of the task's handle. It's weak, so a dropped handle doesn't keep the future alive.
+        self._futures: WeakValueDictionary[str, asyncio.Future] = WeakValueDictionary()
+        # Task id -> asyncio task of the running tasks.
+        self._running_tasks: dict[str, asyncio.Task] = dict()
+        # Queue name -> Futures of the producers waiting for room in the bounded queue.
+        self._putters: dict[str, deque[asyncio.Future]] = defaultdict(deque)
+        # Ids of the waiting tasks cancelled but may not be removed from the backend yet.
+        self._cancelled_ids: set[str] = set()
+        # Ids of the waiting tasks counted by the waiting gauge. The tasks added by other processes sharing the backend
+        # and the ones recovered from the journal are not counted, so they are not uncounted when popped either.
+        self._waiting_ids: set[str] = set()
+        # Dedup key -> Handle of the pending or running task added with the key.
+        self._dedup_handles: dict[str, TaskHandle] = dict()
+        # Task id -> (dedup key, ttl) of the tasks to cache the result of.
+        self._result_ttls: dict[str, tuple[str, float]] = dict()
+        # Task id -> (handle, input handles) of the pipeline tasks waiting for their inputs. They are not in the
+        # backend yet. It keeps the inputs alive until they are finished.
+        self._held: dict[str, tuple[TaskHandle, list[TaskHandle]]] = dict()
+        # Number of the held tasks being added after their inputs are finished. The runner isn't idle meanwhile.
+        self._releasing = 0
+        # Task id -> Timeout given to add_task. The rest of the tasks get the timeout of their queue.
+        self._timeouts: dict[str, float] = dict()
+        # Heap of [deadline by the loop's clock, sequence, task id] of the running tasks having a timeout. The task id
+        # of a finished task is set to None, the heap is rebuilt when such entries are more than the live ones.
+        self._deadlines: list[list] = []
+        self._deadline_sequence = count()
+        # Task id -> Its entry in the heap of the deadlines.
+        self._deadline_entries: dict[str, list] = dict()
+        self._dead_deadlines = 0
+        # Ids of the running tasks cancelled by their timeout.
+        self._timed_out: set[str] = set()
+        # Strong references of the fire and forget tasks. e.g. removing a cancelled task from the backend
+        self._background_tasks: set[asyncio.Task] = set()
+        # Number of the tasks being popped from the backend to be started. They count against the concurrency.
+        self._popping: int = 0
+        # A queue is paused when it reaches its own concurrency limit, so the pops are serialized while it's checked.
+        self._pop_lock: asyncio.Lock | None = asyncio.Lock() if self._limited_queues else None
+        # A single timer starting the waiting tasks when the first throttled queue gets a token.
+        self._throttle_timer: asyncio.TimerHandle | None = None
+        # A single timer moving the scheduled tasks to the waiting queue when the first of them is due.
+        self._schedule_timer: asyncio.TimerHandle | None = None
+        # A single timer cancelling the running tasks when the first deadline is reached.
+        self._timeout_timer: asyncio.TimerHandle | None = None
+        self._metrics = RunnerMetrics(self._queues)
+        # Instrumentation hooks. They are called only if registered.
+        self._on_enqueue: list[HookType] = []
+        self._on_start: list[HookType] = []
+        self._on_finish: list[HookType] = []
+        self._on_error: list[HookType] = []
+
+    def on_enqueue(self, hook: HookType) -> HookType:
+        """
+        Register a hook called with the TaskRecord when a task is added. It can be used as a decorator.
+        """
+        self._on_enqueue.append(hook)
+        return hook
+
+    def on_start(self, hook: HookType) -> HookType:
+        """
+        Register a hook called with the TaskRecord when a task is started. It can be used as a decorator.
+        """
+        self._on_start.append(hook)
+        return hook
+
+    def on_finish(self, hook: HookType) -> HookType:
+        """
+        Register a hook called with the TaskRecord and the result when a task is finished successfully.
+        It can be used as a decorator.
+        """
+        self._on_finish.append(hook)
+        return hook
+
+    def on_error(self, hook: HookType) -> HookType:
+        """
+        Register a hook called with the TaskRecord and the exception when a task is failed. It can be used as a decorator.
+        """
+        self._on_error.append(hook)
+        return hook
+
+    def register(
+        self,
+        fn: FutureFuncType | SyncFuncType | None = None,
+        *,
+        name: str | None = None,
+    ) -> Any:
+        """
+        Register a task function by a name. The tasks can be added by the name and only the name is stored in the
+        backend, so every process sharing the backend must register the same names. It can be used as a decorator,
+        with or without the name. The name defaults to the import path of the function (module:qualname).
+        """
+        if fn is None:
+            return partial(self.register, name=name)
+        return self._registry.register(fn, name=name)
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    @property
+    def registry(self) -> TaskRegistry:
+        """
+        Registry of the task functions, it names the functions sent to the backend.
+        """
+        return self._registry
+
+    def metrics_snapshot(self) -> dict[str, Any]:
+        """
+        Snapshot of the runner metrics: per queue counters, running/waiting gauges, wait time (adding to start) and run
+        time (start to finish) histograms and the throughput. It doesn't talk to the backend.
+        """
+        return self._metrics.snapshot()
 
-    def add_task(
+    async def add_task(
         self,
-        coro: FutureFuncType,
+        coro: FutureFuncType | SyncFuncType | str,
         args: list = [],
         kwargs: dict = {},
         queue_name: str | None = None,
-    ) -> None:
+        delay: float | None = None,
+        eta: datetime | None = None,
+        dedup_key: str | None = None,
+        cache_ttl: float | None = None,
+        timeout: float | None = None,
+    ) -> TaskHandle:
         """
         Adding will add the coroutine to the default OR defined queue queue. If the concurrency is full, it'll be added to the waiting queue.
         Otherwise, it'll be started immediately.
-        :param coro: The coroutine to be run.
+        :param coro: The coroutine to be run or its registered name. It can be a plain function for the executor lanes.
         :param args: The arguments will be passed the function directly.
         :param kwargs: The arguments will be passed the function directly.
+        :param delay: Seconds to wait before the task is added to the waiting queue.
+        :param eta: The time to add the task to the waiting queue. Only one of delay and eta can be given.
+        :param dedup_key: While a task added with the same key is pending or running, its handle is returned instead
+        of adding a new task. So the same idempotent task added many times runs once.
+        :param cache_ttl: Cache the result by the dedup key for that many seconds. A task added with the key meanwhile
+        gets the cached result without running.
+        :param timeout: Seconds the task may run, it overrides the timeout of the queue. The task running longer is
+        cancelled and fails with TimeoutError. It's kept by this runner, the workers of a shared backend apply the
+        timeout of the queue.
+        :return: Handle of the task. Await it for the result or cancel the task with it.
+        If the queue is bounded and full, it raises QueueFullError, drops a task or waits for room based on the queue's
+        overflow policy. The scheduled tasks don't count against the bound until they are due.
+        """
+        if delay is not None and eta is not None:
+            raise ValueError("Only one of delay and eta can be given")
+        if cache_ttl is not None and dedup_key is None:
+            raise ValueError("cache_ttl needs a dedup_key")
+        if timeout is not None and timeout <= 0:
+            raise ValueError(f"Timeout must be positive, got {timeout}")
+        await self._ensure_setup()
+        queue_name = self._validate_queue_name(queue_name)
+        if dedup_key is not None:
+            duplicate = await self._find_duplicate(dedup_key, queue_name, cache_ttl)
+            if duplicate is not None:
+                return duplicate
+        task = self._create_task_record(coro, args, kwargs, queue_name)
+        logger.debug("Adding %s to queue: %s", task.fn.__name__, queue_name)
+        handle = self._create_handle(task)
+        if dedup_key is not None:
+            self._track_duplicates(dedup_key, handle, cache_ttl)
+        if timeout is not None:
+            self._timeouts[task.id] = timeout
+        self._task_enqueued(task)
+        try:
+            if delay is not None or eta is not None:
+                run_at = eta.timestamp() if eta is not None else task.created_at + delay
+                await self._backend.add_task_to_scheduled(task, run_at)
+                self._task_waiting(task)
+                self._move_due_tasks_at(run_at)
+            else:
+                await self._enqueue(task)
+        except QueueFullError:
+            # The handle is not returned, so a duplicate must not get it.
+            self._cancel_future(task.id)
+            self._result_ttls.pop(task.id, None)
+            raise
+        return handle
+
+    async def _enqueue(self, task: TaskRecord) -> None:
+        """
+        Start the task if there is free capacity, otherwise add it to the waiting queue. The tasks of the rate limited
+        queues always go through the waiting queue.
+        """
+        if task.queue_name in self._rate_limited:
+            await self._add_to_bounded_queue(task)
+            await self._start_waiting_tasks()
+        elif (
+            self._backend.running_task_count >= await self._backend.get_concurrency()
+            or self._is_capped(task.queue_name)
+        ):
+            await self._add_to_bounded_queue(task)
+        else:
+            await self._start_new_task(task)
+
+    async def _find_duplicate(
+        self, dedup_key: str, queue_name: str, cache_ttl: float | None
+    ) -> TaskHandle | None:
+        """
+        Handle of the pending or running task of the dedup key, or a finished handle of the cached result if the
+        cache is used.
+        """
+        handle = self._dedup_handles.get(dedup_key)
+        if handle is None and cache_ttl is not None:
+            try:
+                result = await self._backend.get_cached_result(dedup_key)
+            except KeyError:
+                # The same key may be added while waiting for the backend.
+                handle = self._dedup_handles.get(dedup_key)
+            else:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(result)
+                self._metrics[queue_name].cache_hits += 1
+                return TaskHandle(uuid4().hex, queue_name, future, self)
+        if handle is not None:
+            self._metrics[handle.queue_name].deduplicated += 1
+        return handle
+
+    def _track_duplicates(
+        self, dedup_key: str, handle: TaskHandle, cache_ttl: float | None
+    ) -> None:
+        self._dedup_handles[dedup_key] = handle
+        handle._future.add_done_callback(
+            lambda _: self._dedup_handles.pop(dedup_key, None)
+        )
+        if cache_ttl is not None:
+            self._result_ttls[handle.id] = (dedup_key, cache_ttl)
+
+    async def _cache_result(self, task_id: str, result: Any) -> None:
+        """
+        Cache the result of the task if it's added with a cache ttl. A failure is logged and doesn't fail the task.
+        """
+        dedup_key, ttl = self._result_ttls.pop(task_id)
+        try:
+            await self._backend.set_cached_result(dedup_key, result, ttl)
+        except Exception:
+            logger.exception("Failed to cache the result of %s", dedup_key)
+
+    async def add_tasks(self, tasks: Iterable[TaskSpec]) -> list[TaskHandle]:
+        """
+        Adding many tasks at once. The tasks are started as long as there is free concurrency and the rest of them
+        are added to the waiting queue with a single backend call.
+        :param tasks: Iterable of (coro, args, kwargs, queue_name). queue_name can be None for the default queue.
+        :return: Handles of the tasks in the same order.
+        Every task is validated before any of them is started, so an unknown queue or task name adds nothing.
+        If a bounded queue is full and raises QueueFullError, the tasks before it are kept and the rest are not added.
+        """
+        await self._ensure_setup()
+        valid_queue_names: set[str | None] = set()
+        records: list[TaskRecord] = []
+        for coro, args, kwargs, queue_name in tasks:
+            if queue_name not in valid_queue_names:
+                self._validate_queue_name(queue_name)
+                valid_queue_names.add(queue_name)
+            records.append(
+                self._create_task_record(
+                    coro, args, kwargs, queue_name or self._default_queue
+                )
+            )
+        free = await self._backend.get_concurrency() - self._backend.running_task_count
+        handles: list[TaskHandle] = []
+        waitings: list[TaskRecord] = []
+        full: QueueFullError | None = None
+        # The started tasks are logged by a durable backend together, the last commit covers all of them.
+        commit: Awaitable | None = None
+        for index, task in enumerate(records):
+            handles.append(self._create_handle(task))
+            self._task_enqueued(task)
+            if (
+                free > 0
+                and not self._is_capped(task.queue_name)
+                and task.queue_name not in self._rate_limited
+            ):
+                free -= 1
+                logged = self._backend.accept_task(task)
+                self._start_task(task, logged)
+                commit = logged or commit
+            elif self._queues[task.queue_name].max_size is not None:
+                try:
+                    await self._add_to_bounded_queue(task)
+                except QueueFullError as err:
+                    # The handles are not returned. The tasks collected so far are still added below.
+                    for rest in records[index:]:
+                        self._cancel_future(rest.id)
+                    full = err
+                    break
+            else:
+                waitings.append(task)
+        if waitings:
+            await self._backend.add_tasks_to_waiting_queue(waitings)
+            for task in waitings:
+                self._task_waiting(task)
+        if commit is not None:
+            await asyncio.shield(commit)
+        if self._rate_limited.intersection(valid_queue_names):
+            await self._start_waiting_tasks()
+        logger.debug("Added %s tasks to the waiting queue in bulk", len(waitings))
+        if full is not None:
+            raise full
+        return handles
+
+    async def map(
+        self, coro: FutureFuncType, *iterables: Iterable, queue_name: str | None = None
+    ) -> AsyncIterator[Any]:
+        """
+        Run the coroutine for every item of the iterables like the builtin map and yield the results as they
+        complete. So the order of the results is not the order of the arguments.
+        Results are only available for the tasks run by this runner.
+        :param coro: The coroutine to be run.
+        :param iterables: The arguments of every task are taken from the iterables, one from each.
+        :param queue_name: The queue of the tasks.
+        """
+        handles = await self.add_tasks(
+            (coro, list(args), {}, queue_name) for args in zip(*iterables)
+        )
+        for future in asyncio.as_completed([handle._future for handle in handles]):
+            yield await future
+
+    async def group(self, steps: Iterable[Step]) -> GroupHandle:
+        """
+        Add the tasks of a fan-out group at once, like add_tasks.
+        :return: Handle of the group. Await it for the results of the tasks in their order.
+        """
+        handles = await self.add_tasks(
+            (step.coro, step.args, step.kwargs, step.queue_name) for step in steps
+        )
+        return GroupHandle(handles)
+
+    async def chord(self, header: Iterable[Step], body: Step) -> TaskHandle:
+        """
+        Fan-in: Add the header tasks as a group and the body task to run with the list of their results, when all of
+        them are finished. If any of them fails, the body fails with its exception without running.
+        :return: Handle of the body task.
+        """
+        group = await self.group(header)
+        return self._add_when_done(body, group.handles, fan_in=True)
+
+    async def chain(self, *steps: Step) -> TaskHandle:
+        """
+        Run the steps one after the other. The result of a step is passed to the next one as its first argument.
+        If a step fails or is cancelled, the rest of the steps fail or are cancelled without running.
+        :return: Handle of the last step.
+        """
+        if not steps:
+            raise ValueError("Chain needs at least one step")
+        first = steps[0]
+        handle = await self.add_task(first.coro, first.args, first.kwargs, first.queue_name)
+        for step in steps[1:]:
+            handle = self._add_when_done(step, [handle], fan_in=False)
+        return handle
+
+    def _add_when_done(
+        self, step: Step, inputs: list[TaskHandle], fan_in: bool
+    ) -> TaskHandle:
+        """
+        Hold the task of the step in the runner until its inputs are finished, then add it with their results. The
+        results are passed in the memory, a task waiting in a shared backend has them in its arguments.
+        The dependency is a callback per input, so it's O(edges).
+        :param fan_in: Pass the list of the results instead of the only result.
+        """
+        queue_name = self._validate_queue_name(step.queue_name)
+        task = self._create_task_record(step.coro, step.args, step.kwargs, queue_name)
+        handle = self._create_handle(task)
+        self._held[task.id] = (handle, inputs)
+        self._idle.clear()
+
+        def inputs_done(outcome: Any) -> None:
+            # It's cancelled meanwhile.
+            if self._held.pop(task.id, None) is None or handle.done():
+                return
+            if isinstance(outcome, asyncio.CancelledError):
+                handle._future.cancel()
+            elif isinstance(outcome, BaseException):
+                handle._future.set_exception(outcome)
+            else:
+                task.args = [outcome if fan_in else outcome[0], *task.args]
+                self._releasing += 1
+                self._create_background_task(self._release(task))
+                return
+            self._set_idle_if_done()
+
+        collect(inputs, inputs_done)
+        return handle
+
+    async def _release(self, task: TaskRecord) -> None:
+        """
+        Add a pipeline task whose inputs are finished.
+        """
+        try:
+            if self._closing:
+                self._cancel_future(task.id)
+                return
+            task.created_at = time.time()
+            self._task_enqueued(task)
+            await self._enqueue(task)
+        except Exception as err:
+            future = self._futures.pop(task.id, None)
+            if future is not None and not future.done():
+                future.set_exception(err)
+        finally:
+            self._releasing -= 1
+            self._set_idle_if_done()
+
+    async def set_concurrency(self, concurrency: int) -> None:
+        """
+        Change the concurrency at runtime. If it's raised, the waiting tasks are started right away.
+        If it's lowered, the running tasks are kept and new ones are not started until the running count is below it.
+        """
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+        self._concurrency = concurrency
+        await self._ensure_setup()
+        await self._backend.set_concurrency(concurrency)
+        await self._start_waiting_tasks()
+        logger.debug("Concurrency is set to: %s", concurrency)
+
+    async def _ensure_setup(self) -> None:
+        """
+        Set up the backend with the concurrency and the queues once. Awaiting the done future doesn't yield.
+        It raises RunnerClosedError after the cleanup, so no task is added to a closed backend.
+        """
+        if self._closing:
+            raise RunnerClosedError("The runner is cleaned up, it doesn't accept tasks")
+        if self._setup_future is None:
+            self._setup_future = asyncio.ensure_future(self._setup())
+        await self._setup_future
+
+    async def _setup(self) -> None:
+        await self._backend.set_concurrency(self._concurrency)
+        await self._backend.set_waiting(waitings=self._waitings)
+        # The tasks already in the backend, e.g. recovered from the journal, are started.
+        await self._move_due_tasks()
+
+    def _validate_queue_name(self, queue_name: str | None) -> str:
+        """
+        Get the queue name or the default one. Raises ValueError for an unknown queue.
         """
         if queue_name is None:
             queue_name = self._default_queue
         if self._backend.is_valid_queue_name(queue_name) is False:
             raise ValueError(f"Unknown queue name: {queue_name}")
-        logger.debug(f"Adding {coro.__name__} to queue: {queue_name}")
-        if len(self._backend._running) >= self._backend._concurrency:
-            self._backend.add_task_to_waiting_queue(queue_name, coro, args, kwargs)
+        return queue_name
+
+    def is_running(self, task_id: str) -> bool:
+        """
+        Check if the task is running by this runner.
+        """
+        return task_id in self._running_tasks
+
+    def cancel_task(self, handle: TaskHandle) -> bool:
+        """
+        Cancel a task. A running task is cancelled and a waiting task is removed from the waiting queue in the
+        background, so it never runs. Returns False if the task is already finished.
+        """
+        if handle.done():
+            return False
+        if self._held.pop(handle.id, None) is not None:
+            # Not added to the backend yet.
+            cancelled = handle._future.cancel()
+            self._set_idle_if_done()
+            return cancelled
+        running_task = self._running_tasks.get(handle.id)
+        if running_task is not None:
+            return running_task.cancel()
+        handle._future.cancel()
+        self._timeouts.pop(handle.id, None)
+        self._cancelled_ids.add(handle.id)
+        self._task_dropped(handle.id, handle.queue_name)
+        self._create_background_task(
+            self._remove_cancelled_task(handle.queue_name, handle.id)
+        )
+        logger.debug("Cancelled waiting task: %s", handle.id)
+        return True
+
+    async def _remove_cancelled_task(self, queue_name: str, task_id: str) -> None:
+        """
+        Remove a cancelled task from the waiting queue or the scheduled tasks. If it's popped meanwhile, the runner
+        skips it.
+        """
+        try:
+            if await self._backend.remove_task_from_waiting_queue(queue_name, task_id):
+                self._wake_up_putter(queue_name)
+            else:
+                await self._backend.remove_scheduled_task(queue_name, task_id)
+        finally:
+            self._cancelled_ids.discard(task_id)
+
+    def _is_capped(self, queue_name: str) -> bool:
+        """
+        Check if the queue is at its own concurrency limit. The tasks being popped are counted, their queue is not
+        known yet.
+        """
+        max_concurrency = self._queues[queue_name].max_concurrency
+        return (
+            max_concurrency is not None
+            and self._metrics[queue_name].running + self._popping >= max_concurrency
+        )
+
+    def _set_capped(self, queue_name: str, capped: bool) -> None:
+        """
+        Take the queue out of the pops when it reaches its own concurrency limit and put it back when it gets below.
+        It's done when the running count crosses the limit, so a pop doesn't check every queue.
+        """
+        if capped:
+            self._backend.pause_queue(queue_name)
         else:
-            self._start_task(coro(*args, **kwargs))
+            self._backend.resume_queue(queue_name)
+        self._scheduler.queue_capped(queue_name, capped)
+
+    async def _pop_next_task(self) -> TaskRecord | None:
+        """
+        Pop the next task from the waiting queue in the scheduler's order. The tasks cancelled while they were waiting
+        are skipped.
+        """
+        while True:
+            task = await self._backend.pop_task_from_waiting_queue(
+                self._scheduler.candidates()
+            )
+            if task is None:
+                return None
+            future = self._futures.get(task.id)
+            if task.id not in self._cancelled_ids and not (
+                future is not None and future.cancelled()
+            ):
+                return task
+            self._cancelled_ids.discard(task.id)
+            await self._backend.acknowledge_task(task.id)
+            logger.debug("Skipped the cancelled task: %s", task.id)
+
+    def _create_background_task(self, coro: Coroutine) -> None:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _add_to_bounded_queue(self, task: TaskRecord) -> None:
+        """
+        Add the task to the waiting queue. If the queue is bounded and full, the overflow policy of the queue is
+        applied. A producer waiting for room starts the task right away if the concurrency is freed meanwhile.
+        """
+        queue = self._queues[task.queue_name]
+        while (
+            queue.max_size is not None
+            and await self._backend.get_queue_size(queue.name) >= queue.max_size
+        ):
+            if queue.overflow is OverflowPolicyEnum.RAISE:
+                raise QueueFullError(f"Queue is full: {queue.name}")
+            elif queue.overflow is OverflowPolicyEnum.DROP_NEWEST:
+                self._cancel_future(task.id)
+                self._metrics[queue.name].cancelled += 1
+                logger.debug("Dropped the new task of the full queue: %s", queue.name)
+                return
+            elif queue.overflow is OverflowPolicyEnum.DROP_OLDEST:
+                dropped = await self._backend.pop_task_from_queue(queue.name)
+                if dropped is not None:
+                    await self._backend.acknowledge_task(dropped.id)
+                    self._cancel_future(dropped.id)
+                    self._task_dropped(dropped.id, queue.name)
+                    logger.debug(
+                        "Dropped the oldest task of the full queue: %s", queue.name
+                    )
+            else:
+                await self._wait_for_room(queue.name)
+                if self._closing:
+                    raise RunnerClosedError("The runner is cleaned up, it doesn't accept tasks")
+                if (
+                    self._backend.running_task_count
+                    < await self._backend.get_concurrency()
+                    and not self._is_capped(queue.name)
+                    and queue.name not in self._rate_limited
+                ):
+                    await self._start_new_task(task)
+                    return
+        await self._backend.add_task_to_waiting_queue(task)
+        self._task_waiting(task)
+
+    async def _wait_for_room(self, queue_name: str) -> None:
+        """
+        Wait until a task leaves the queue. Tasks popped by other processes sharing the backend don't wake up the
+        producer, so the room is checked again after a while anyway.
+        """
+        putter = asyncio.get_running_loop().create_future()
+        self._putters[queue_name].append(putter)
+        try:
+            await asyncio.wait([putter], timeout=BOUNDED_QUEUE_RECHECK_INTERVAL)
+        finally:
+            if not putter.done():
+                putter.cancel()
+                self._putters[queue_name].remove(putter)
+
+    def _wake_up_putter(self, queue_name: str) -> None:
+        """
+        A task left the queue. Wake up the first producer waiting for room in it.
+        """
+        putters = self._putters.get(queue_name)
+        while putters:
+            putter = putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+    def _task_enqueued(self, task: TaskRecord) -> None:
+        self._metrics[task.queue_name].enqueued += 1
+        if self._on_enqueue:
+            self._call_hooks(self._on_enqueue, task)
+
+    def _task_waiting(self, task: TaskRecord) -> None:
+        self._waiting_ids.add(task.id)
+        self._metrics[task.queue_name].waiting += 1
+
+    def _task_not_waiting(self, task_id: str, queue_name: str) -> None:
+        """
+        A waiting task is popped or removed. It's uncounted only if this runner counted it.
+        """
+        if task_id in self._waiting_ids:
+            self._waiting_ids.remove(task_id)
+            self._metrics[queue_name].waiting -= 1
+
+    def _task_dropped(self, task_id: str, queue_name: str) -> None:
+        """
+        A waiting task is removed from the queue without running.
+        """
+        self._task_not_waiting(task_id, queue_name)
+        self._metrics[queue_name].cancelled += 1
 
-    def _start_task(self, coro: FutureFuncType):
+    def _call_hooks(self, hooks: list[HookType], *args: Any) -> None:
+        """
+        Call the hooks. A failing hook is logged and doesn't break the runner.
+        """
+        for hook in hooks:
+            try:
+                hook(*args)
+            except Exception:
+                logger.exception("Hook %s failed", hook)
+
+    def _cancel_future(self, task_id: str) -> None:
+        self._timeouts.pop(task_id, None)
+        future = self._futures.pop(task_id, None)
+        if future is not None:
+            future.cancel()
+
+    def _create_executor(self, queue: Queue) -> Executor:
+        if queue.executor is ExecutorTypeEnum.PROCESS:
+            # Forking a process running the event loop and the threads of the backend is not safe, the workers are
+            # spawned instead.
+            return ProcessPoolExecutor(
+                max_workers=queue.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return ThreadPoolExecutor(
+            max_workers=queue.max_workers, thread_name_prefix=f"coro_runner_{queue.name}"
+        )
+
+    def _create_task_record(
+        self,
+        coro: FutureFuncType | SyncFuncType | str,
+        args: list,
+        kwargs: dict,
+        queue_name: str,
+    ) -> TaskRecord:
+        """
+        Raises ValueError for a plain function out of the executor lanes, it can't be awaited.
+        """
+        fn = self._registry.resolve(coro) if isinstance(coro, str) else coro
+        if (
+            queue_name not in self._executors
+            and isroutine(fn)
+            and not iscoroutinefunction(fn)
+        ):
+            raise ValueError(
+                f"{fn.__name__} is not a coroutine function, only the queues with an executor run plain functions: "
+                f"{queue_name}"
+            )
+        return TaskRecord(
+            id=uuid4().hex,
+            fn=fn,
+            args=args,
+            kwargs=kwargs,
+            queue_name=queue_name,
+            created_at=time.time(),
+        )
+
+    def _create_handle(self, task: TaskRecord) -> TaskHandle:
+        future = asyncio.get_running_loop().create_future()
+        self._futures[task.id] = future
+        return TaskHandle(task.id, task.queue_name, future, self)
+
+    async def _start_new_task(self, task: TaskRecord) -> None:
+        """
+        Start a task which is not in the waiting queue. A durable backend logs it first, it returns when the task is
+        stored.
+        """
+        logged = self._backend.accept_task(task)
+        self._start_task(task, logged)
+        if logged is not None:
+            await asyncio.shield(logged)
+
+    def _start_task(self, task: TaskRecord, logged: Awaitable | None = None):
         """
         Stat the task and add it to the running set.
+        :param logged: The task waits for it to be stored by the backend before running.
+        """
+        self._backend.add_task_to_running(task)
+        metrics = self._metrics[task.queue_name]
+        metrics.running += 1
+        if metrics.running == self._queues[task.queue_name].max_concurrency:
+            self._set_capped(task.queue_name, True)
+        self._idle.clear()
+        running = asyncio.create_task(self._task(task, logged))
+        self._running_tasks[task.id] = running
+        timeout = self._timeouts.get(task.id, self._queues[task.queue_name].timeout)
+        if timeout is not None:
+            self._add_deadline(task.id, timeout)
+        logger.debug("Started task: %s", task.fn.__name__)
+
+    def _add_deadline(self, task_id: str, timeout: float) -> None:
+        """
+        Cancel the running task after timeout seconds. The deadlines are kept in a heap and a single timer is set for
+        the earliest one, there is no watchdog per task.
         """
-        self._backend.add_task_to_running(coro)
-        asyncio.create_task(self._task(coro))
-        logger.debug(f"Started task: {coro.__name__}")
+        entry = [
+            asyncio.get_running_loop().time() + timeout,
+            next(self._deadline_sequence),
+            task_id,
+        ]
+        self._deadline_entries[task_id] = entry
+        heapq.heappush(self._deadlines, entry)
+        self._timeout_timer = self._set_timer(
+            self._timeout_timer, timeout, self._deadline_reached
+        )
+
+    def _remove_deadline(self, task_id: str) -> None:
+        """
+        Mark the deadline of a finished task as removed. The heap is rebuilt when the removed entries are more than
+        the live ones, so the finished tasks don't pile up until their deadlines.
+        """
+        entry = self._deadline_entries.pop(task_id, None)
+        if entry is None:
+            return
+        entry[2] = None
+        self._dead_deadlines += 1
+        if self._dead_deadlines * 2 > len(self._deadlines):
+            self._deadlines = [entry for entry in self._deadlines if entry[2] is not None]
+            heapq.heapify(self._deadlines)
+            self._dead_deadlines = 0
 
-    async def _task(self, coro: FutureFuncType):
+    def _deadline_reached(self) -> None:
+        """
+        Cancel the running tasks past their deadline. Their slots are freed as they finish. The timer is set again for
+        the next deadline.
+        """
+        self._timeout_timer = None
+        now = asyncio.get_running_loop().time()
+        while self._deadlines and (
+            self._deadlines[0][0] <= now or self._deadlines[0][2] is None
+        ):
+            _, _, task_id = heapq.heappop(self._deadlines)
+            if task_id is None:
+                self._dead_deadlines -= 1
+                continue
+            del self._deadline_entries[task_id]
+            logger.warning("Task timed out: %s", task_id)
+            self._timed_out.add(task_id)
+            self._running_tasks[task_id].cancel()
+        if self._deadlines:
+            self._timeout_timer = self._set_timer(
+                None, self._deadlines[0][0] - now, self._deadline_reached
+            )
+
+    async def _call(self, task: TaskRecord) -> Any:
+        """
+        Call the function of the task. Plain functions of the executor lanes run in the executor and awaited.
+        A task cancelled by its timeout raises TimeoutError, so it fails like any other error.
+        """
+        executor = self._executors.get(task.queue_name)
+        try:
+            if executor is None or iscoroutinefunction(task.fn):
+                return await task.fn(*task.args, **task.kwargs)
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, partial(task.fn, *task.args, **task.kwargs)
+            )
+        except asyncio.CancelledError:
+            if task.id not in self._timed_out:
+                raise
+            self._timed_out.discard(task.id)
+            self._metrics[task.queue_name].timed_out += 1
+            # It's not cancelled anymore, it's failed.
+            asyncio.current_task().uncancel()
+            raise TimeoutError(f"Task timed out: {task.id}") from None
+
+    async def _task(self, task: TaskRecord, logged: Awaitable | None = None):
         """
         The main task runner. It'll run the coroutine and remove it from the running set after completion.
+        Plain functions of the executor lanes run in the executor and awaited.
+        The result or the exception of the task is set to the future of its handle.
+        If the task came from the waiting queue, it'll be acknowledged to the backend.
+        A failed task is retried after the backoff if the queue allows, otherwise moved to the dead letter queue if
+        it's enabled. A task past its timeout fails with TimeoutError.
         If there is any task in the waiting queue, it'll start the task.
         """
+        future = self._futures.pop(task.id, None)
+        retrying = False
+        interrupted = False
+        metrics = self._metrics[task.queue_name]
+        metrics.started += 1
+        metrics.wait_time.observe(time.time() - task.created_at)
+        if self._on_start:
+            self._call_hooks(self._on_start, task)
+        started_at = time.monotonic()
         try:
-            return await coro
+            if logged is not None:
+                # Shielded, the commit is shared by the other tasks of the batch.
+                await asyncio.shield(logged)
+            result = await self._call(task)
+        except BaseException as err:
+            metrics.run_time.observe(time.monotonic() - started_at)
+            if isinstance(err, asyncio.CancelledError):
+                metrics.cancelled += 1
+                # Cancelled by the cleanup, it's handed back to the backend.
+                interrupted = self._closing
+            else:
+                metrics.failed += 1
+                if self._on_error:
+                    self._call_hooks(self._on_error, task, err)
+                queue = self._queues[task.queue_name]
+                if task.attempts < queue.max_retries:
+                    retrying = True
+                    await self._retry_task(task, future)
+                    return None
+                if queue.dead_letter:
+                    await self._backend.add_task_to_dead_letter(task)
+                    metrics.dead += 1
+            if future is None:
+                raise
+            if isinstance(err, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(err)
+        else:
+            metrics.run_time.observe(time.monotonic() - started_at)
+            metrics.finished += 1
+            if self._on_finish:
+                self._call_hooks(self._on_finish, task, result)
+            if task.id in self._result_ttls:
+                # Before the future, so a task added with the key right after gets the cached result.
+                await self._cache_result(task.id, result)
+            if future is not None:
+                future.set_result(result)
+            return result
         finally:
-            self._backend.remove_task_from_running(coro)
-            if self._backend.any_waiting_task:
-                coro2_data: dict[str, FutureFuncType | Any] | None = (
-                    self._backend.pop_task_from_waiting_queue()
-                )
-                if coro2_data:
-                    __fn = coro2_data["fn"]
-                    self._start_task(__fn(*coro2_data["args"], **coro2_data["kwargs"]))
+            metrics.running -= 1
+            max_concurrency = self._queues[task.queue_name].max_concurrency
+            if max_concurrency is not None and metrics.running == max_concurrency - 1:
+                self._set_capped(task.queue_name, False)
+            # Cancelled by the timeout after it's finished anyway.
+            self._timed_out.discard(task.id)
+            self._remove_deadline(task.id)
+            self._backend.remove_task_from_running(task)
+            if not interrupted and not retrying:
+                self._result_ttls.pop(task.id, None)
+                self._timeouts.pop(task.id, None)
+            try:
+                if interrupted:
+                    await self._backend.requeue_task(task)
+                elif not retrying:
+                    await self._backend.acknowledge_task(task.id)
+                await self._start_waiting_tasks()
+            finally:
+                # The last one, so the runner isn't idle until the backend is done with the task. It's removed even
+                # if the backend fails, otherwise the runner never gets idle.
+                self._running_tasks.pop(task.id, None)
+                self._task_finished.set()
+                self._set_idle_if_done()
+
+    async def _retry_task(self, task: TaskRecord, future: asyncio.Future | None) -> None:
+        """
+        Schedule the failed task to be retried after the exponential backoff. The future is kept, so the handle gets
+        the outcome of the last attempt. The backend acknowledges and schedules the task at once, so it's never lost.
+        """
+        queue = self._queues[task.queue_name]
+        delay = queue.retry_backoff * 2**task.attempts
+        task.attempts += 1
+        if future is not None:
+            self._futures[task.id] = future
+        run_at = time.time() + delay
+        await self._backend.requeue_task(task, run_at)
+        metrics = self._metrics[task.queue_name]
+        metrics.retried += 1
+        self._task_waiting(task)
+        self._move_due_tasks_at(run_at)
+        logger.debug("Retrying task %s in %s seconds, attempt: %s", task.id, delay, task.attempts)
+
+    def _set_idle_if_done(self) -> None:
+        """
+        The runner is idle when nothing is running, scheduled, throttled or held by a pipeline.
+        """
+        if (
+            not self._running_tasks
+            and not self._held
+            and not self._releasing
+            and self._throttle_timer is None
+            and self._schedule_timer is None
+        ):
+            self._idle.set()
+
+    def _set_timer(
+        self, timer: asyncio.TimerHandle | None, delay: float, callback: Any
+    ) -> asyncio.TimerHandle:
+        """
+        Call the callback after the delay. There is a single timer per purpose, the current one is kept if it's due
+        earlier, otherwise it's replaced.
+        """
+        loop = asyncio.get_running_loop()
+        if timer is not None:
+            if timer.when() <= loop.time() + delay:
+                return timer
+            timer.cancel()
+        self._idle.clear()
+        return loop.call_later(delay, callback)
+
+    def _start_after_throttle(self, delay: float) -> None:
+        """
+        Start the waiting tasks again when the throttled queue gets a token.
+        """
+        if self._closing:
+            return
+        self._throttle_timer = self._set_timer(
+            self._throttle_timer, delay, self._throttle_expired
+        )
+
+    def _move_due_tasks_at(self, run_at: float) -> None:
+        """
+        Move the scheduled tasks to the waiting queue at run_at, a unix timestamp.
+        """
+        if self._closing:
+            return
+        self._schedule_timer = self._set_timer(
+            self._schedule_timer, max(run_at - time.time(), 0), self._schedule_expired
+        )
+
+    def _schedule_expired(self) -> None:
+        self._schedule_timer = None
+        self._create_background_task(self._move_due_tasks())
+
+    async def _move_due_tasks(self) -> None:
+        """
+        Move the due tasks to the waiting queue in bulk and start them. The timer is set again for the next one.
+        """
+        next_run_at = await self._backend.move_due_tasks()
+        if next_run_at is not None:
+            self._move_due_tasks_at(next_run_at)
+        await self._start_waiting_tasks()
+        self._set_idle_if_done()
+
+    def _throttle_expired(self) -> None:
+        self._throttle_timer = None
+        self._create_background_task(self._start_throttled_tasks())
+
+    async def _start_throttled_tasks(self) -> None:
+        await self._start_waiting_tasks()
+        self._set_idle_if_done()
+
+    async def _start_waiting_tasks(self) -> None:
+        """
+        Start the waiting tasks while there is free capacity. The tasks being popped are counted too, so the runner
+        doesn't go over the concurrency while the backend is popping.
+        The queue is chosen by the scheduler. The queues at their own concurrency limit are paused, the pops are
+        serialized if any queue has a limit, so a queue doesn't go over it while another pop is awaited.
+        If only the throttled queues have tasks, they are started by the throttle timer, so the throttled tasks don't
+        hold the concurrency.
+        Nothing is started while the runner is being cleaned up.
+        """
+        while (
+            not self._closing
+            and self._backend.running_task_count + self._popping
+            < await self._backend.get_concurrency()
+        ):
+            self._popping += 1
+            try:
+                if self._pop_lock is None:
+                    next_task = await self._pop_and_start_task()
+                else:
+                    async with self._pop_lock:
+                        next_task = await self._pop_and_start_task()
+            finally:
+                self._popping -= 1
+            if next_task is None:
+                if self._backend.throttled_for is not None:
+                    self._start_after_throttle(self._backend.throttled_for)
+                return
+            self._wake_up_putter(next_task.queue_name)
+
+    async def _pop_and_start_task(self) -> TaskRecord | None:
+        """
+        Pop the next waiting task and start it. None if there is no task to start.
+        """
+        if self._closing:
+            return None
+        next_task = await self._pop_next_task()
+        if next_task is not None:
+            self._scheduler.task_popped(next_task.queue_name)
+            self._task_not_waiting(next_task.id, next_task.queue_name)
+            self._start_task(next_task)
+        return next_task
+
+    async def serve(self, wait_timeout: float = 1.0) -> None:
+        """
+        Consume the waiting queue until the runner is cleaned up. The tasks added by any process sharing the backend
+        are run up to the concurrency, so the workers can be scaled apart from the processes adding the tasks.
+        While there is free capacity, it blocks on the backend until a task is added (BLPOP for RedisBackend).
+        :param wait_timeout: Maximum seconds to block on the backend before checking the waiting queue again.
+        """
+        await self._ensure_setup()
+        self._serving = asyncio.current_task()
+        logger.info("Serving the queues: %s", ", ".join(self._queues))
+        try:
+            while True:
+                await self._start_waiting_tasks()
+                if (
+                    self._backend.running_task_count
+                    >= await self._backend.get_concurrency()
+                ):
+                    self._task_finished.clear()
+                    await self._task_finished.wait()
+                elif self._throttle_timer is not None:
+                    # The waiting tasks are throttled, don't spin on them until the next token.
+                    await asyncio.sleep(
+                        min(
+                            max(self._throttle_timer.when() - asyncio.get_running_loop().time(), 0),
+                            wait_timeout,
+                        )
+                    )
+                else:
+                    await self._backend.wait_for_task(wait_timeout)
+                    if self._schedule_timer is None:
+                        # The tasks scheduled by the other processes.
+                        await self._move_due_tasks()
+        except asyncio.CancelledError:
+            # Cleanup unsets it before cancelling, it's the way to stop serving. Any other cancellation is raised.
+            if self._serving is not None:
+                raise
+        finally:
+            self._serving = None
 
     async def run_until_exit(self):
         """
-        This is to keep the runner alive until manual exit. It'll keep running until the running_task_count is -1.
+        This is to keep the runner alive until manual exit. It'll keep running until the runner is cleaned up.
         """
-        while self._backend.running_task_count != -1:
-            await asyncio.sleep(0.1)
+        await self._exit.wait()
 
     async def run_until_finished(self):
         """
         This is to keep the runner alive until all the tasks are finished.
         """
-        while self._backend.running_task_count > 0:
-            await asyncio.sleep(0.1)
+        await self._idle.wait()
+
+    async def join(self, timeout: float | None = None):
+        """
+        Wait until all the running and waiting tasks are finished.
+        :param timeout: Maximum seconds to wait. Raises TimeoutError if the tasks are not finished by then.
+        """
+        await asyncio.wait_for(self._idle.wait(), timeout)
 
-    async def cleanup(self):
+    async def cleanup(self, drain: bool = False, timeout: float | None = None):
         """
-        Cleanup the runner. It'll remove all the running and waiting tasks.
+        Cleanup the runner along with the backend. The runner doesn't accept or start any task after that.
+        Without drain, the running tasks are cancelled and the backend removes the waiting tasks. A durable
+        InMemoryBackend keeps the waiting and the cancelled tasks in its journal anyway, they run on the next start.
+        With drain, the running tasks are let finish for up to timeout seconds and the rest of them are cancelled.
+        The cancelled and the waiting tasks are handed back to the backend, so another process (or the next start of
+        a durable InMemoryBackend) runs them. Nothing is lost and no task runs twice on a rolling restart.
+        The handles of the tasks not finished are cancelled.
+        :param drain: Let the running tasks finish and keep the waiting tasks in the backend.
+        :param timeout: Maximum seconds to wait for the running tasks while draining. None waits until they finish.
         """
-        # TODO: Keep the persistant tasks during clean up
-        await self._backend.cleanup()
+        self._closing = True
+        serving = self._serving
+        if serving is not None and serving is not asyncio.current_task():
+            self._serving = None
+            serving.cancel()
+            await asyncio.gather(serving, return_exceptions=True)
+        for timer in (self._throttle_timer, self._schedule_timer):
+            if timer is not None:
+                timer.cancel()
+        self._throttle_timer = self._schedule_timer = None
+        running = list(self._running_tasks.values())
+        if drain and running:
+            logger.info("Draining %s running tasks", len(running))
+            _, running = await asyncio.wait(running, timeout=timeout)
+            if running:
+                logger.warning("Cancelling %s tasks not finished in %s seconds", len(running), timeout)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        # The timeouts are kept while draining.
+        if self._timeout_timer is not None:
+            self._timeout_timer.cancel()
+            self._timeout_timer = None
+        self._deadlines.clear()
+        self._deadline_entries.clear()
+        self._dead_deadlines = 0
+        if not drain:
+            for task in self._background_tasks:
+                task.cancel()
+        # The cancelled waiting tasks are removed from the backend while draining.
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self._backend.cleanup(drain=drain)
+        self._held.clear()
+        self._releasing = 0
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._exit.set()
 
         logger.debug("Runner cleaned up along with backend.")
+
+
+def load_runner(path: str) -> CoroRunner:
+    """
+    Import the runner by its path, module:attribute.
+    """
+    module_name, _, attr = path.partition(":")
+    if not attr:
+        raise ValueError(f"Runner path must be module:attribute, got {path}")
+    runner = getattr(import_module(module_name), attr)
+    if not isinstance(runner, CoroRunner):
+        raise TypeError(f"{path} is not a CoroRunner")
+    return runner
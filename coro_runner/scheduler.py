@@ -0,0 +1,161 @@
+import abc
+from collections import deque
+from typing import Iterable, Iterator
+
+from .schema import Queue
+
+
+class BaseScheduler(abc.ABC):
+    """
+    Decides which queue the next waiting task is popped from. The runner asks for the candidate queues in order and
+    the backend pops from the first non-empty one, then the runner tells the scheduler which queue it was.
+    """
+
+    def __init__(self) -> None:
+        # Queue names by score, the highest score first.
+        self.queue_names: list[str] = []
+
+    def setup(self, queues: Iterable[Queue]) -> None:
+        self.queue_names = [
+            queue.name
+            for queue in sorted(queues, key=lambda queue: queue.score, reverse=True)
+        ]
+
+    @abc.abstractmethod
+    def candidates(self) -> Iterable[str] | None:
+        """
+        Queue names to pop the next task from, in order. None means the backend's own priority order, it's the fastest.
+        """
+
+    def task_popped(self, queue_name: str) -> None:
+        """
+        A task of the queue is popped to be started.
+        """
+
+    def queue_filled(self, queue_name: str, filled: bool) -> None:
+        """
+        The queue got its first waiting task or its next token, or it lost the last one or ran out of tokens. Only the
+        backends keeping the queues in the process tell it, every queue is taken as filled otherwise.
+        """
+
+    def queue_capped(self, queue_name: str, capped: bool) -> None:
+        """
+        The queue reached its max_concurrency or got below it. A capped queue must not be a candidate.
+        """
+
+
+class PriorityScheduler(BaseScheduler):
+    """
+    Strict priority by the queue score. A queue is served only when all the higher score queues are empty.
+    It's the default. The backend keeps the non-empty queues in a heap, so the selection is O(log n).
+    """
+
+    def candidates(self) -> Iterable[str] | None:
+        return None
+
+
+class DeficitRoundRobinScheduler(BaseScheduler):
+    """
+    Deficit round robin weighted by the queue score. Every ready queue gets a turn and can start tasks worth its
+    quantum in its turn, so a flood into a high score queue doesn't starve the low score queues.
+    The quantum is the score relative to the lowest positive score, at least 1. e.g. the scores 10 and 0.1 start 100
+    tasks and 1 task per round. The unused quantum is carried to the next turn, unless the queue leaves the round
+    because it's empty or at its max_concurrency.
+    The round is a deque of the ready queues in score order, then in the order they get ready again. The head is
+    the queue of the turn, so the selection is O(1). A queue leaving the round is dropped when it reaches the head.
+    The backends not knowing their queue sizes (e.g. RedisBackend) keep every queue in the round, they skip the
+    empty ones while popping.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._quantum: dict[str, float] = dict()
+        self._deficit: dict[str, float] = dict()
+        # The round, the head has the turn. Names of the queues in it, including the ones to be dropped.
+        self._round: deque[str] = deque()
+        self._in_round: set[str] = set()
+        # Names of the queues out of the round.
+        self._empty: set[str] = set()
+        self._capped: set[str] = set()
+        # The queue which got the quantum of the current turn.
+        self._turn: str | None = None
+
+    def setup(self, queues: Iterable[Queue]) -> None:
+        queues = list(queues)
+        super().setup(queues)
+        scores = {queue.name: queue.score for queue in queues}
+        unit = min((score for score in scores.values() if score > 0), default=1.0)
+        self._quantum = {name: max(scores[name] / unit, 1.0) for name in self.queue_names}
+        self._deficit = {name: 0.0 for name in self.queue_names}
+        self._round = deque(self.queue_names)
+        self._in_round = set(self.queue_names)
+        self._empty = set()
+        self._capped = set()
+        self._turn = None
+
+    def candidates(self) -> Iterable[str] | None:
+        head = self.__head()
+        if head is None:
+            return ()
+        return self.__rotation(head)
+
+    def __rotation(self, head: str) -> Iterator[str]:
+        """
+        The head, then the rest of the round. The rest is copied only if the backend skips the head.
+        """
+        yield head
+        for name in list(self._round)[1:]:
+            if self.__is_ready(name):
+                yield name
+
+    def task_popped(self, queue_name: str) -> None:
+        if queue_name not in self._in_round:
+            return
+        # The queues before it in this round are skipped by the backend, they lose their deficit.
+        while self._round[0] != queue_name:
+            self._deficit[self._round[0]] = 0.0
+            self._round.rotate(-1)
+        if self._turn != queue_name:
+            self._turn = queue_name
+            self._deficit[queue_name] += self._quantum[queue_name]
+        self._deficit[queue_name] -= 1
+        if self._deficit[queue_name] < 1 or not self.__is_ready(queue_name):
+            self._round.rotate(-1)
+            self._turn = None
+
+    def queue_filled(self, queue_name: str, filled: bool) -> None:
+        self.__set(self._empty, queue_name, not filled)
+
+    def queue_capped(self, queue_name: str, capped: bool) -> None:
+        self.__set(self._capped, queue_name, capped)
+
+    def __set(self, names: set[str], queue_name: str, value: bool) -> None:
+        if value:
+            names.add(queue_name)
+            return
+        names.discard(queue_name)
+        if queue_name not in self._in_round and self.__is_ready(queue_name):
+            self._round.append(queue_name)
+            self._in_round.add(queue_name)
+
+    def __is_ready(self, queue_name: str) -> bool:
+        return queue_name not in self._empty and queue_name not in self._capped
+
+    def __head(self) -> str | None:
+        """
+        The queue of the turn. The queues out of the round are dropped from the head, it gets its quantum once per
+        turn.
+        """
+        while self._round and not self.__is_ready(self._round[0]):
+            name = self._round.popleft()
+            self._in_round.discard(name)
+            self._deficit[name] = 0.0
+            if self._turn == name:
+                self._turn = None
+        if not self._round:
+            return None
+        head = self._round[0]
+        if self._turn != head:
+            self._turn = head
+            self._deficit[head] += self._quantum[head]
+        return head
@@ -1,13 +1,56 @@
 from dataclasses import dataclass, field
-from datetime import datetime
+import os
 
-from .enums import TaskStatusEnum
+from .enums import ExecutorTypeEnum, OverflowPolicyEnum
+from .types import FutureFuncType, SyncFuncType
 
 
 @dataclass
 class Queue:
+    """
+    A waiting queue. The higher score means the higher priority.
+    max_size bounds the number of waiting tasks of the queue, the overflow policy decides what happens to the new task
+    when the queue is full. None means unbounded.
+    executor makes the queue an executor lane. Plain functions of the queue run in a thread or process pool of
+    max_workers, so they don't block the event loop.
+    A failed task is retried up to max_retries times. The n-th retry waits retry_backoff * 2 ** (n - 1) seconds.
+    If dead_letter is set, a task failed after all the retries is moved to the dead letter queue of the queue.
+    max_concurrency caps the running tasks of the queue within the runner's concurrency. None means no cap, except
+    for the executor lanes. They are capped by the size of their pool, so the tasks queued in the pool don't hold the
+    runner's concurrency.
+    rate_limit throttles the starts of the queue's tasks to that many per second, with bursts up to burst tasks.
+    The throttled tasks stay in the waiting queue, they don't hold the concurrency. None means no limit.
+    timeout is the default seconds a task of the queue may run. A task running longer is cancelled and fails with
+    TimeoutError. None means no timeout.
+    """
+
     name: str
     score: float
+    max_size: int | None = None
+    overflow: OverflowPolicyEnum = OverflowPolicyEnum.RAISE
+    executor: ExecutorTypeEnum | None = None
+    max_workers: int | None = None
+    max_retries: int = 0
+    retry_backoff: float = 1.0
+    dead_letter: bool = False
+    max_concurrency: int | None = None
+    rate_limit: float | None = None
+    burst: int = 1
+    timeout: float | None = None
+
+    def __post_init__(self) -> None:
+        if self.rate_limit is not None and self.rate_limit <= 0:
+            raise ValueError(f"Rate limit must be positive, got {self.rate_limit}")
+        if self.burst < 1:
+            raise ValueError(f"Burst must be at least 1, got {self.burst}")
+        if self.timeout is not None and self.timeout <= 0:
+            raise ValueError(f"Timeout must be positive, got {self.timeout}")
+        if self.executor is not None and self.max_concurrency is None:
+            # The default pool sizes of ThreadPoolExecutor and ProcessPoolExecutor.
+            cpus = os.cpu_count() or 1
+            self.max_concurrency = self.max_workers or (
+                min(32, cpus + 4) if self.executor is ExecutorTypeEnum.THREAD else cpus
+            )
 
 
 @dataclass
@@ -15,22 +58,34 @@ class QueueConfig:
     queues: list[Queue]
 
 
-@dataclass
-class TaskModel:
+@dataclass(slots=True, eq=False)
+class TaskRecord:
     """
-    Task details. It'll be used to store the task details in the db.
+    A task of the runner. It's used by the runner and all the backends, from the waiting queue to the running set.
+    It's slotted to keep the memory footprint small for the big backlogs.
     """
 
-    name: str
-    queue: str
-    received: datetime
-    status: TaskStatusEnum = TaskStatusEnum.PENDING
-    args: list = field(default_factory=lambda: [])
-    kwargs: dict = field(default_factory=lambda: {})
-    result: str | None = None
-    started: datetime | None = None
-    finished: datetime | None = None
-    errors: str | None = None
+    id: str
+    fn: FutureFuncType | SyncFuncType
+    args: list
+    kwargs: dict
+    queue_name: str
+    # Unix timestamp of adding the task.
+    created_at: float = 0.0
+    # Number of the failed runs, it's increased on every retry.
+    attempts: int = 0
+
+
+@dataclass(slots=True)
+class Step:
+    """
+    A task of a pipeline (CoroRunner.chain, group and chord). The results of its inputs are passed in front of args.
+    """
+
+    coro: FutureFuncType | SyncFuncType | str
+    args: list = field(default_factory=list)
+    kwargs: dict = field(default_factory=dict)
+    queue_name: str | None = None
 
 
 @dataclass
@@ -40,3 +95,5 @@ class RedisConfig:
     db: int
     username: str | None = None
     password: str | None = None
+    # Maximum connections of the connection pool. None means unlimited.
+    max_connections: int | None = None
@@ -0,0 +1,385 @@
+import asyncio
+from concurrent.futures import Future
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import queue
+import signal
+import threading
+from typing import Any, Callable
+from uuid import uuid4
+import zlib
+
+from .enums import TaskStatusEnum
+from .exceptions import RunnerClosedError, ShardDiedError
+from .logging import logger
+from .runner import CoroRunner, load_runner
+from .types import FutureFuncType, SyncFuncType
+
+# Seconds a shard blocks on its own inbox before looking at the other inboxes again.
+STEAL_INTERVAL = 0.05
+
+LoopFactory = Callable[[], asyncio.AbstractEventLoop]
+
+
+def uvloop_factory() -> LoopFactory | None:
+    """
+    Loop factory of uvloop if it's installed, otherwise None for the default asyncio loop.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    return uvloop.new_event_loop
+
+
+class ShardedRunner:
+    """
+    Runs the tasks on many shards, every shard is a process with its own event loop and its own copy of the runner.
+    So a single process tops out on all the cores instead of one.
+    The runner is imported by its path (module:attribute) in every shard, like the worker command, so the module
+    defines the backend, the queues and registers the tasks. The functions are sent to the shards by their names.
+    Routing: A task is put to the inbox of a shard by the hash of its key, the queue name by default. So the tasks of
+    a queue go to the same shard.
+    Work stealing: A shard takes a task only when its runner has a free slot. It takes from its own inbox first, then
+    from the other inboxes, so an idle shard takes over the backlog of a busy one.
+    The results and the exceptions are sent back pickled. The tasks are not persisted by the shards, see the Redis
+    workers for that.
+    Liveness: A shard reports every task it takes. If a shard dies, the futures of the tasks it took fail with
+    ShardDiedError. So do the ones in its inbox not taken yet, the died process may have left the inbox locked. If all
+    the shards die, every future fails.
+    """
+
+    def __init__(
+        self,
+        runner: str,
+        shards: int | None = None,
+        loop_factory: LoopFactory | None = None,
+    ) -> None:
+        """
+        :param runner: Import path of the runner, module:attribute.
+        :param shards: Number of the shards. Defaults to the number of the cores.
+        :param loop_factory: Creates the event loop of every shard, e.g. uvloop_factory(). It must be importable.
+        """
+        self._runner_path = runner
+        # The local copy only names the task functions.
+        self._runner: CoroRunner = load_runner(runner)
+        self._shards = shards or os.cpu_count() or 1
+        if self._shards < 1:
+            raise ValueError(f"Shards must be at least 1, got {self._shards}")
+        self._loop_factory = loop_factory
+        self._context = multiprocessing.get_context("spawn")
+        self._inboxes: list[multiprocessing.Queue] = []
+        # The results are written synchronously, so a shard's messages are in the pipe before it can die.
+        self._results: multiprocessing.SimpleQueue | None = None
+        self._processes: list[multiprocessing.Process] = []
+        # It's set to stop the shards. The drain timeout is shared along with it, NaN means no timeout.
+        self._stopping = self._context.Event()
+        self._drain_timeout = self._context.Value("d", math.nan)
+        # Task id -> Future of the tasks sent to the shards. They are resolved by the result reader thread, so the
+        # map is guarded by the lock.
+        self._futures: dict[str, Future] = dict()
+        # Task id -> Index of the shard which took the task, or of the inbox it's sent to until it's taken. Indexes
+        # of the died shards.
+        self._owners: dict[str, int] = dict()
+        self._died: set[int] = set()
+        self._lock = threading.Lock()
+        self._reader: threading.Thread | None = None
+        self._watcher: threading.Thread | None = None
+
+    async def __aenter__(self) -> "ShardedRunner":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        await self.stop()
+
+    @property
+    def shards(self) -> int:
+        return self._shards
+
+    async def start(self) -> None:
+        """
+        Start the shard processes. It returns before the shards import the runner, the tasks wait in the inboxes.
+        """
+        if self._processes:
+            raise RuntimeError("Sharded runner is already started")
+        self._died = set()
+        self._inboxes = [self._context.Queue() for _ in range(self._shards)]
+        self._results = self._context.SimpleQueue()
+        self._processes = [
+            self._context.Process(
+                target=_run_shard,
+                args=(
+                    index,
+                    self._runner_path,
+                    self._inboxes,
+                    self._results,
+                    self._stopping,
+                    self._drain_timeout,
+                    self._loop_factory,
+                ),
+                name=f"coro_runner_shard_{index}",
+                daemon=True,
+            )
+            for index in range(self._shards)
+        ]
+        for process in self._processes:
+            process.start()
+        self._reader = threading.Thread(
+            target=self._read_results, name="coro_runner_shard_results", daemon=True
+        )
+        self._reader.start()
+        self._watcher = threading.Thread(
+            target=self._watch_shards, name="coro_runner_shard_watcher", daemon=True
+        )
+        self._watcher.start()
+        logger.info("Started %s shards of %s", self._shards, self._runner_path)
+
+    async def add_task(
+        self,
+        coro: FutureFuncType | SyncFuncType | str,
+        args: list = [],
+        kwargs: dict = {},
+        queue_name: str | None = None,
+        key: str | None = None,
+    ) -> asyncio.Future:
+        """
+        Send a task to a shard.
+        :param coro: The coroutine to be run or its registered name.
+        :param key: The tasks of the same key go to the same shard unless they are stolen. Defaults to the queue name.
+        :return: Future of the result. It raises the exception of the task if it's failed, ShardDiedError if the shard
+        running it died.
+        """
+        if not self._processes or self._stopping.is_set():
+            raise RunnerClosedError("Sharded runner is not running")
+        name = coro if isinstance(coro, str) else self._runner.registry.name_of(coro)
+        task_id = uuid4().hex
+        future: Future = Future()
+        with self._lock:
+            if len(self._died) == self._shards:
+                raise ShardDiedError("All the shards died")
+            route = key if key is not None else (queue_name or "")
+            shard = zlib.crc32(route.encode()) % self._shards
+            # The inbox of a died shard may be locked, the next shard alive gets its tasks.
+            while shard in self._died:
+                shard = (shard + 1) % self._shards
+            self._futures[task_id] = future
+            self._owners[task_id] = shard
+        self._inboxes[shard].put((task_id, name, args, kwargs, queue_name))
+        return asyncio.wrap_future(future)
+
+    async def join(self) -> None:
+        """
+        Wait until all the tasks sent to the shards are done. The tasks of a died shard are done by failing.
+        """
+        while True:
+            with self._lock:
+                futures = list(self._futures.values())
+            if not futures:
+                return
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+
+    async def stop(self, timeout: float | None = None) -> None:
+        """
+        Stop the shards. Every shard drains its runner: the running tasks are let finish for up to timeout seconds
+        and the rest of them are cancelled. The futures of the tasks not finished are cancelled.
+        """
+        if not self._processes:
+            return
+        self._drain_timeout.value = math.nan if timeout is None else timeout
+        self._stopping.set()
+        for process in self._processes:
+            await asyncio.to_thread(process.join)
+        await asyncio.to_thread(self._watcher.join)
+        self._results.put(None)
+        await asyncio.to_thread(self._reader.join)
+        with self._lock:
+            futures, self._futures = self._futures, dict()
+            self._owners.clear()
+        for future in futures.values():
+            future.cancel()
+        for inbox in (*self._inboxes, self._results):
+            inbox.close()
+        self._processes = []
+        self._inboxes = []
+        self._results = self._reader = self._watcher = None
+        logger.info("Stopped the shards of %s", self._runner_path)
+
+    def _read_results(self) -> None:
+        """
+        Resolve the futures by the results of the shards until the None sentinel of stop.
+        """
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            task_id, status, value = pickle.loads(message)
+            if task_id is None:
+                # The shard of the index died, it's put after the last message of the shard.
+                self._shard_died(value)
+                continue
+            with self._lock:
+                if status is TaskStatusEnum.RUNNING:
+                    # Taken by the shard of the index.
+                    self._owners[task_id] = value
+                    continue
+                future = self._futures.pop(task_id, None)
+                self._owners.pop(task_id, None)
+            if future is None or future.done():
+                continue
+            if status is TaskStatusEnum.FINISHED:
+                future.set_result(value)
+            elif status is TaskStatusEnum.FAILED:
+                future.set_exception(value)
+            else:
+                future.cancel()
+
+    def _watch_shards(self) -> None:
+        """
+        Tell the result reader about the shards dying before stop. The shards write the results synchronously, so
+        the message is after all the ones of the died shard.
+        """
+        sentinels = {process.sentinel: index for index, process in enumerate(self._processes)}
+        while sentinels:
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                index = sentinels.pop(sentinel)
+                if not self._stopping.is_set():
+                    self._results.put(pickle.dumps((None, TaskStatusEnum.FAILED, index)))
+
+    def _shard_died(self, index: int) -> None:
+        """
+        Fail the futures of the tasks taken by the died shard or waiting in its inbox. If all the shards are dead,
+        the tasks in the inboxes are never taken, so every future fails.
+        """
+        logger.error("Shard %s died with exit code %s", index, self._processes[index].exitcode)
+        with self._lock:
+            self._died.add(index)
+            if len(self._died) == self._shards:
+                lost = list(self._futures)
+            else:
+                lost = [task_id for task_id, owner in self._owners.items() if owner == index]
+            futures = [self._futures.pop(task_id) for task_id in lost if task_id in self._futures]
+            for task_id in lost:
+                self._owners.pop(task_id, None)
+        for future in futures:
+            if not future.done():
+                future.set_exception(ShardDiedError(f"Shard {index} of the task died"))
+
+
+def _run_shard(
+    index: int,
+    runner_path: str,
+    inboxes: list[multiprocessing.Queue],
+    results: multiprocessing.SimpleQueue,
+    stopping: Any,
+    drain_timeout: Any,
+    loop_factory: LoopFactory | None,
+) -> None:
+    """
+    Entry point of a shard process.
+    """
+    # The parent stops the shards, so a Ctrl-C in the terminal doesn't kill them halfway.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    runner = load_runner(runner_path)
+    with asyncio.Runner(loop_factory=loop_factory) as loop_runner:
+        loop_runner.run(
+            _serve_shard(
+                index,
+                runner,
+                inboxes[index:] + inboxes[:index],
+                results,
+                stopping,
+                drain_timeout,
+            )
+        )
+
+
+async def _serve_shard(
+    index: int,
+    runner: CoroRunner,
+    inboxes: list[multiprocessing.Queue],
+    results: multiprocessing.SimpleQueue,
+    stopping: Any,
+    drain_timeout: Any,
+) -> None:
+    """
+    Take the tasks from the inboxes, the own one first, while the runner has a free slot and send back the results.
+    """
+    slots = asyncio.Semaphore(runner.concurrency)
+    reporters: set[asyncio.Task] = set()
+    while not stopping.is_set():
+        await slots.acquire()
+        message = await asyncio.to_thread(
+            _take_task, index, inboxes, results, STEAL_INTERVAL
+        )
+        if message is None:
+            slots.release()
+            continue
+        task_id, name, args, kwargs, queue_name = message
+        try:
+            handle = await runner.add_task(name, args, kwargs, queue_name)
+        except Exception as err:
+            slots.release()
+            results.put(_dump_result(task_id, TaskStatusEnum.FAILED, err))
+            continue
+        reporter = asyncio.create_task(_report(task_id, handle, results, slots))
+        reporters.add(reporter)
+        reporter.add_done_callback(reporters.discard)
+    timeout = drain_timeout.value
+    await runner.cleanup(drain=True, timeout=None if math.isnan(timeout) else timeout)
+    await asyncio.gather(*reporters, return_exceptions=True)
+
+
+def _take_task(
+    index: int,
+    inboxes: list[multiprocessing.Queue],
+    results: multiprocessing.SimpleQueue,
+    timeout: float,
+) -> tuple | None:
+    """
+    Take a task from the own inbox (the first one), otherwise steal one from the other inboxes. If all of them are
+    empty, wait on the own inbox for up to timeout seconds.
+    The taken task is reported before it runs, so the parent knows the tasks of a died shard.
+    """
+    for inbox in inboxes:
+        try:
+            message = inbox.get_nowait()
+            break
+        except queue.Empty:
+            continue
+    else:
+        try:
+            message = inboxes[0].get(timeout=timeout)
+        except queue.Empty:
+            return None
+    results.put(_dump_result(message[0], TaskStatusEnum.RUNNING, index))
+    return message
+
+
+async def _report(
+    task_id: str, handle: Any, results: multiprocessing.SimpleQueue, slots: asyncio.Semaphore
+) -> None:
+    try:
+        outcome = (TaskStatusEnum.FINISHED, await handle)
+    except asyncio.CancelledError:
+        outcome = (TaskStatusEnum.CANCELLED, None)
+    except Exception as err:
+        outcome = (TaskStatusEnum.FAILED, err)
+    finally:
+        slots.release()
+    results.put(_dump_result(task_id, *outcome))
+
+
+def _dump_result(task_id: str, status: TaskStatusEnum, value: Any) -> bytes:
+    """
+    Pickle the result here, so a result which can't be pickled fails the task instead of the shard.
+    """
+    try:
+        return pickle.dumps((task_id, status, value))
+    except Exception as err:
+        return pickle.dumps(
+            (task_id, TaskStatusEnum.FAILED, RuntimeError(f"Result can't be pickled: {err}"))
+        )
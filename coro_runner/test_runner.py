@@ -1,13 +1,28 @@
 import asyncio
 import logging
 import os
+import shutil
+import time
+from datetime import datetime, timedelta
 from random import random
+from uuid import uuid4
 
 import pytest
 
-from coro_runner import CoroRunner
+from coro_runner import (
+    CoroRunner,
+    OverflowPolicyEnum,
+    QueueFullError,
+    RunnerClosedError,
+    ShardDiedError,
+    ShardedRunner,
+)
 from coro_runner.backend import InMemoryBackend, RedisBackend
-from coro_runner.schema import Queue, QueueConfig, RedisConfig
+from coro_runner.backend.journal import RECORD_ADD, RECORD_HEADER, Journal
+from coro_runner.enums import ExecutorTypeEnum, TaskStatusEnum
+from coro_runner.schema import Queue, QueueConfig, RedisConfig, Step, TaskRecord
+from coro_runner.scheduler import DeficitRoundRobinScheduler
+from coro_runner.utils import prepare_queue
 
 REDIS_HOST: str = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT: int = int(os.environ.get("REDIS_PORT", 6379))
@@ -23,6 +38,20 @@ rg_queue = Queue(name="Regular", score=1)
 hp_queue = Queue(name="HighPriority", score=10)
 
 
+@pytest.fixture(params=[InMemoryBackend, RedisBackend])
+def backend(request):
+    """
+    A fresh backend of every kind, the tests using it run for both of them.
+    """
+    if request.param is RedisBackend:
+        return RedisBackend(conf=RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB))
+    return InMemoryBackend()
+
+
+def make_task(fn, queue_name: str) -> TaskRecord:
+    return TaskRecord(id=uuid4().hex, fn=fn, args=[], kwargs={}, queue_name=queue_name)
+
+
 async def regular_coro():
     current_task: asyncio.Task | None = asyncio.current_task()
     logger.info(
@@ -53,7 +82,7 @@ async def test_in_memory_coro_runner():
         backend=InMemoryBackend(),
     )
     for _ in range(5):
-        runner.add_task(regular_coro)
+        await runner.add_task(regular_coro)
 
     await runner.run_until_finished()
     await runner.cleanup()
@@ -70,7 +99,7 @@ async def test_redis_backend_coro_runner():
         ),
     )
     for _ in range(5):
-        runner.add_task(regular_coro)
+        await runner.add_task(regular_coro)
 
     await runner.run_until_finished()
     await runner.cleanup()
@@ -87,12 +116,1072 @@ async def test_priority_check_coroutines():
     )
     logger.debug("Adding regular tasks")
     for _ in range(5):
-        runner.add_task(regular_coro, queue_name=rg_queue.name)
+        await runner.add_task(regular_coro, queue_name=rg_queue.name)
 
     logger.debug("Adding priority tasks")
     for _ in range(5):
-        runner.add_task(high_priority_coro, queue_name=hp_queue.name)
+        await runner.add_task(high_priority_coro, queue_name=hp_queue.name)
 
     await runner.run_until_finished()
     await runner.cleanup()
     assert runner._backend.running_task_count == 0
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_queue_priority():
+    backend = RedisBackend(
+        conf=RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    )
+    await backend.set_waiting(
+        prepare_queue([rg_queue, hp_queue], default_name="default"),
+    )
+    await backend.add_task_to_waiting_queue(make_task(regular_coro, rg_queue.name))
+    await backend.add_task_to_waiting_queue(
+        make_task(high_priority_coro, hp_queue.name)
+    )
+    assert await backend.get_waiting_task_count() == 2
+    wakeup_key = backend.get_cache_key("wakeup")
+    assert await backend.r_client.llen(wakeup_key) == 2
+
+    assert (await backend.pop_task_from_waiting_queue()).fn is high_priority_coro
+    assert (await backend.pop_task_from_waiting_queue()).fn is regular_coro
+    assert await backend.r_client.llen(wakeup_key) == 2
+    assert await backend.pop_task_from_waiting_queue() is None
+    # The tokens of the popped tasks are removed, an idle worker blocks instead of waking up for nothing.
+    assert await backend.r_client.llen(wakeup_key) == 0
+    assert await backend.get_waiting_task_count() == 0
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_shared_pop():
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    backends = [RedisBackend(conf=conf), RedisBackend(conf=conf)]
+    for backend in backends:
+        await backend.set_waiting(prepare_queue([], default_name="default"))
+    await backends[0].add_tasks_to_waiting_queue(
+        [make_task(regular_coro, "default") for _ in range(4)]
+    )
+
+    popped = [await backends[i % 2].pop_task_from_waiting_queue() for i in range(5)]
+    assert popped[-1] is None
+    assert len({task.id for task in popped[:-1]}) == 4
+    inflight_key = backends[1].get_inflight_key()
+    assert await backends[1].r_client.hlen(inflight_key) == 2
+
+    await backends[1].acknowledge_task(popped[1].id)
+    assert await backends[1].r_client.hlen(inflight_key) == 1
+    for backend in backends:
+        await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_in_memory_backend_queue_priority():
+    backend = InMemoryBackend()
+    await backend.set_waiting(
+        prepare_queue([rg_queue, hp_queue], default_name="default"),
+    )
+    await backend.add_task_to_waiting_queue(make_task(regular_coro, "default"))
+    await backend.add_task_to_waiting_queue(make_task(regular_coro, rg_queue.name))
+    await backend.add_task_to_waiting_queue(
+        make_task(high_priority_coro, hp_queue.name)
+    )
+    await backend.add_task_to_waiting_queue(make_task(regular_coro, rg_queue.name))
+    assert backend.waiting_task_count == 4
+
+    popped_from = []
+    while backend.any_waiting_task:
+        task = await backend.pop_task_from_waiting_queue()
+        popped_from.append(task.fn)
+    assert popped_from == [
+        high_priority_coro,
+        regular_coro,
+        regular_coro,
+        regular_coro,
+    ]
+    assert backend.waiting_task_count == 0
+    assert await backend.pop_task_from_waiting_queue() is None
+
+
+@pytest.mark.asyncio
+async def test_join_with_timeout():
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend())
+    await runner.join(timeout=0.01)
+
+    for _ in range(2):
+        await runner.add_task(asyncio.sleep, args=[0.2])
+    with pytest.raises(TimeoutError):
+        await runner.join(timeout=0.05)
+    await runner.join(timeout=1)
+    assert runner._backend.running_task_count == 0
+    assert runner._backend.any_waiting_task is False
+
+    exit_waiter = asyncio.create_task(runner.run_until_exit())
+    await runner.cleanup()
+    await asyncio.wait_for(exit_waiter, timeout=1)
+
+
+async def double(value: int) -> int:
+    await asyncio.sleep(random() / 100)
+    return value * 2
+
+
+@pytest.mark.asyncio
+async def test_add_tasks_in_bulk():
+    bounded = Queue(name="bounded", score=1, max_size=1)
+    runner = CoroRunner(
+        concurrency=2,
+        queue_conf=QueueConfig(queues=[rg_queue, hp_queue, bounded]),
+        backend=InMemoryBackend(),
+    )
+    await runner.add_tasks(
+        [(double, [i], {}, rg_queue.name) for i in range(5)]
+        + [(double, [i], {}, None) for i in range(5)]
+    )
+    assert runner._backend.running_task_count == 2
+    assert runner._backend.waiting_task_count == 8
+    with pytest.raises(ValueError):
+        await runner.add_tasks([(double, [1], {}, "unknown")])
+    # Nothing of a batch having an unknown queue is added.
+    with pytest.raises(ValueError):
+        await runner.add_tasks([(double, [1], {}, None), (double, [2], {}, "unknown")])
+    assert runner.metrics_snapshot()["queues"]["default"]["enqueued"] == 5
+    assert runner._backend.waiting_task_count == 8
+
+    # A batch failing partway on a full queue keeps the tasks added before it.
+    with pytest.raises(QueueFullError):
+        await runner.add_tasks(
+            [(double, [1], {}, None), (double, [2], {}, bounded.name)]
+            + [(double, [3], {}, bounded.name), (double, [4], {}, None)]
+        )
+    assert runner._backend.waiting_task_count == 10
+    assert await runner._backend.get_queue_size(bounded.name) == 1
+    assert runner.metrics_snapshot()["queues"]["default"]["waiting"] == 6
+
+    await runner.join(timeout=5)
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_map_results(backend):
+    runner = CoroRunner(concurrency=3, backend=backend)
+    results = [result async for result in runner.map(double, range(20))]
+    assert sorted(results) == [i * 2 for i in range(20)]
+    await runner.join(timeout=1)
+    await runner.cleanup()
+
+
+async def failing_coro():
+    raise RuntimeError("Failed")
+
+
+@pytest.mark.asyncio
+async def test_task_handles(backend):
+    runner = CoroRunner(concurrency=1, backend=backend)
+    running = await runner.add_task(asyncio.sleep, args=[10])
+    waiting = await runner.add_task(double, args=[2])
+    failing = await runner.add_task(failing_coro)
+    succeeding = await runner.add_task(double, args=[3])
+    await asyncio.sleep(0)
+    assert running.status is TaskStatusEnum.RUNNING
+    assert waiting.status is TaskStatusEnum.PENDING
+
+    assert waiting.cancel() is True
+    assert waiting.status is TaskStatusEnum.CANCELLED
+    assert running.cancel() is True
+    assert await succeeding == 6
+    assert running.status is TaskStatusEnum.CANCELLED
+    assert succeeding.status is TaskStatusEnum.FINISHED
+    assert failing.status is TaskStatusEnum.FAILED
+    with pytest.raises(RuntimeError):
+        await failing
+    assert succeeding.cancel() is False
+
+    await runner.join(timeout=1)
+    assert await runner._backend.get_waiting_task_count() == 0
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_bounded_queue_overflow_policies():
+    queues = [
+        Queue(name="raise", score=1, max_size=1),
+        Queue(
+            name="drop_oldest",
+            score=1,
+            max_size=1,
+            overflow=OverflowPolicyEnum.DROP_OLDEST,
+        ),
+        Queue(
+            name="drop_newest",
+            score=1,
+            max_size=1,
+            overflow=OverflowPolicyEnum.DROP_NEWEST,
+        ),
+    ]
+    runner = CoroRunner(
+        concurrency=1,
+        queue_conf=QueueConfig(queues=queues),
+        backend=InMemoryBackend(),
+    )
+    await runner.add_task(asyncio.sleep, args=[0.1])
+
+    await runner.add_task(double, args=[1], queue_name="raise")
+    with pytest.raises(QueueFullError):
+        await runner.add_task(double, args=[2], queue_name="raise")
+
+    oldest = await runner.add_task(double, args=[1], queue_name="drop_oldest")
+    newest = await runner.add_task(double, args=[2], queue_name="drop_oldest")
+    assert oldest.status is TaskStatusEnum.CANCELLED
+
+    kept = await runner.add_task(double, args=[1], queue_name="drop_newest")
+    dropped = await runner.add_task(double, args=[2], queue_name="drop_newest")
+    assert dropped.status is TaskStatusEnum.CANCELLED
+
+    assert await newest == 4
+    assert await kept == 2
+    await runner.join(timeout=1)
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_bounded_queue_producer_waits():
+    queue = Queue(name="bounded", score=1, max_size=2, overflow=OverflowPolicyEnum.WAIT)
+    runner = CoroRunner(
+        concurrency=2,
+        queue_conf=QueueConfig(queues=[queue]),
+        backend=InMemoryBackend(),
+    )
+    handles = [
+        await runner.add_task(double, args=[i], queue_name=queue.name)
+        for i in range(10)
+    ]
+    assert await runner._backend.get_queue_size(queue.name) <= 2
+    assert sorted([await handle for handle in handles]) == [i * 2 for i in range(10)]
+    await runner.cleanup()
+
+
+def blocking_sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+def cpu_bound_sum(value: int) -> int:
+    return sum(range(value))
+
+
+@pytest.mark.asyncio
+async def test_executor_lanes():
+    thread_queue = Queue(
+        name="blocking", score=1, executor=ExecutorTypeEnum.THREAD, max_workers=4
+    )
+    process_queue = Queue(
+        name="cpu_bound", score=1, executor=ExecutorTypeEnum.PROCESS, max_workers=2
+    )
+    runner = CoroRunner(
+        concurrency=10,
+        queue_conf=QueueConfig(queues=[thread_queue, process_queue]),
+        backend=InMemoryBackend(),
+    )
+    started = time.monotonic()
+    blocking = [
+        await runner.add_task(blocking_sleep, args=[0.2], queue_name=thread_queue.name)
+        for _ in range(4)
+    ]
+    cpu_bound = await runner.add_task(
+        cpu_bound_sum, args=[1000], queue_name=process_queue.name
+    )
+    # The event loop is not blocked by the blocking tasks.
+    on_loop = await runner.add_task(double, args=[1])
+    assert await on_loop == 2
+    assert time.monotonic() - started < 0.1
+    # The lane runs up to its pool size, the rest of its tasks wait in the queue without holding the concurrency.
+    queued = await runner.add_task(blocking_sleep, args=[0.1], queue_name=thread_queue.name)
+    assert queued.status is TaskStatusEnum.PENDING
+    assert runner.metrics_snapshot()["queues"][thread_queue.name]["running"] == 4
+
+    assert [await handle for handle in blocking] == [0.2] * 4
+    assert await queued == 0.1
+    assert time.monotonic() - started < 0.5
+    assert await cpu_bound == sum(range(1000))
+    # A plain function can't be awaited out of the executor lanes.
+    with pytest.raises(ValueError, match="blocking_sleep is not a coroutine function"):
+        await runner.add_task(blocking_sleep, args=[0.1])
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_metrics_and_hooks():
+    runner = CoroRunner(
+        concurrency=1,
+        queue_conf=QueueConfig(queues=[rg_queue]),
+        backend=InMemoryBackend(),
+    )
+    events: list[tuple[str, str]] = []
+    runner.on_enqueue(lambda task: events.append(("enqueue", task.id)))
+    runner.on_start(lambda task: events.append(("start", task.id)))
+    runner.on_finish(lambda task, result: events.append(("finish", task.id)))
+    runner.on_error(lambda task, err: events.append(("error", task.id)))
+
+    succeeding = await runner.add_task(double, args=[1], queue_name=rg_queue.name)
+    failing = await runner.add_task(failing_coro, queue_name=rg_queue.name)
+    snapshot = runner.metrics_snapshot()
+    assert snapshot["running"] == 1
+    assert snapshot["waiting"] == 1
+    await runner.join(timeout=1)
+
+    assert events == [
+        ("enqueue", succeeding.id),
+        ("enqueue", failing.id),
+        ("start", succeeding.id),
+        ("finish", succeeding.id),
+        ("start", failing.id),
+        ("error", failing.id),
+    ]
+    snapshot = runner.metrics_snapshot()
+    queue_metrics = snapshot["queues"][rg_queue.name]
+    assert queue_metrics["enqueued"] == 2
+    assert queue_metrics["finished"] == 1
+    assert queue_metrics["failed"] == 1
+    assert queue_metrics["wait_time"]["count"] == 2
+    assert queue_metrics["run_time"]["buckets"]["+Inf"] == 2
+    assert snapshot["running"] == 0
+    assert snapshot["waiting"] == 0
+    await runner.cleanup()
+
+
+async def hang() -> None:
+    await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_task_timeouts():
+    slow_queue = Queue(name="Slow", score=1, timeout=0.1)
+    runner = CoroRunner(
+        concurrency=1,
+        queue_conf=QueueConfig(queues=[slow_queue]),
+        backend=InMemoryBackend(),
+    )
+    started_at = time.monotonic()
+    by_queue = await runner.add_task(hang, queue_name=slow_queue.name)
+    by_task = await runner.add_task(hang, timeout=0.05)
+    in_time = await runner.add_task(double, args=[2], queue_name=slow_queue.name, timeout=1)
+    await runner.join(timeout=1)
+    # The slots are freed by the timeouts, not by the tasks.
+    assert time.monotonic() - started_at < 0.5
+    for handle in (by_queue, by_task):
+        assert handle.status is TaskStatusEnum.FAILED
+        with pytest.raises(TimeoutError):
+            await handle
+    assert await in_time == 4
+    snapshot = runner.metrics_snapshot()["queues"]
+    assert snapshot[slow_queue.name]["timed_out"] == 1
+    assert snapshot[slow_queue.name]["failed"] == 1
+    assert snapshot["default"]["timed_out"] == 1
+    with pytest.raises(ValueError):
+        await runner.add_task(hang, timeout=0)
+    # The deadlines of the finished tasks don't wait for their timeout in the heap.
+    await runner.set_concurrency(10)
+    await runner.add_tasks([(double, [i], {}, slow_queue.name) for i in range(100)])
+    await runner.join(timeout=1)
+    assert len(runner._deadlines) <= 1
+    assert not runner._deadline_entries
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_set_concurrency():
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend())
+    handles = await runner.add_tasks([(asyncio.sleep, [0.2], {}, None)] * 4)
+    await asyncio.sleep(0)
+    assert runner._backend.running_task_count == 1
+
+    await runner.set_concurrency(3)
+    assert runner._backend.running_task_count == 3
+    assert runner._backend.waiting_task_count == 1
+    with pytest.raises(ValueError):
+        await runner.set_concurrency(0)
+
+    await runner.set_concurrency(1)
+    await asyncio.gather(*handles)
+    await runner.join(timeout=1)
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_concurrency_is_shared():
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    backends = [RedisBackend(conf=conf), RedisBackend(conf=conf)]
+    await backends[0].set_concurrency(2)
+    assert await backends[1].get_concurrency() == 2
+
+    await backends[0].set_concurrency(5)
+    for _ in range(50):
+        if await backends[1].get_concurrency() == 5:
+            break
+        await asyncio.sleep(0.01)
+    assert await backends[1].get_concurrency() == 5
+    for backend in backends:
+        await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_task_registry():
+    backend = RedisBackend(
+        conf=RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    )
+    runner = CoroRunner(concurrency=1, backend=backend)
+
+    @runner.register(name="triple")
+    async def triple(value):
+        return value * 3
+
+    gate = asyncio.Event()
+    running = await runner.add_task(gate.wait)
+    by_name = await runner.add_task("triple", args=[2])
+    by_function = await runner.add_task(triple, kwargs={"value": 3})
+    imported = await runner.add_task(double, args=[4])
+    payload = await backend.r_client.lindex(backend.get_queue_key("default"), 0)
+    assert b"triple" in payload and b"test_runner" not in payload
+    with pytest.raises(ValueError):
+        await runner.add_task(lambda: None)
+
+    gate.set()
+    assert [await by_name, await by_function, await imported] == [6, 9, 8]
+    await running
+    await runner.join(timeout=1)
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_serve_consumes_tasks_added_by_other_processes():
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    worker = CoroRunner(concurrency=2, backend=RedisBackend(conf=conf))
+    results = []
+
+    @worker.register(name="collect")
+    async def collect():
+        await asyncio.sleep(0.01)
+        results.append(asyncio.current_task().get_name())
+
+    serving = asyncio.create_task(worker.serve(wait_timeout=0.5))
+    await asyncio.sleep(0.1)
+    # The producer only adds the tasks to redis, it never runs them.
+    producer = RedisBackend(conf=conf)
+    producer.registry.register(collect, name="collect")
+    await producer.set_waiting(prepare_queue([], default_name="default"))
+    await producer.add_tasks_to_waiting_queue(
+        [make_task(collect, "default") for _ in range(5)]
+    )
+    await producer.add_task_to_waiting_queue(make_task(collect, "default"))
+
+    for _ in range(100):
+        if len(results) == 6:
+            break
+        await asyncio.sleep(0.01)
+    assert len(results) == 6
+    await worker.join(timeout=1)
+    await worker.cleanup()
+    assert serving.done() and serving.exception() is None
+    await producer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_retries_and_dead_letter():
+    queue = Queue(
+        name="flaky", score=1, max_retries=2, retry_backoff=0.01, dead_letter=True
+    )
+    backend = InMemoryBackend()
+    runner = CoroRunner(
+        concurrency=2, queue_conf=QueueConfig(queues=[queue]), backend=backend
+    )
+    calls = []
+
+    async def succeed_on_third_call():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError("Failed")
+        return len(calls)
+
+    succeeding = await runner.add_task(succeed_on_third_call, queue_name=queue.name)
+    failing = await runner.add_task(failing_coro, queue_name=queue.name)
+    assert await succeeding == 3
+    with pytest.raises(RuntimeError):
+        await failing
+    await runner.join(timeout=1)
+
+    dead = await backend.get_dead_letter_tasks(queue.name)
+    assert [task.id for task in dead] == [failing.id]
+    assert dead[0].attempts == 2
+    queue_metrics = runner.metrics_snapshot()["queues"][queue.name]
+    assert queue_metrics["retried"] == 4
+    assert queue_metrics["dead"] == 1
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_requeues_expired_leases():
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    queue = Queue(name="api:v2", score=1)
+    dead_worker = RedisBackend(conf=conf, lease_timeout=0.2)
+    # The lease member is parsed by the separators, not by the length of the worker id.
+    dead_worker._worker_id = "dead-worker"
+    worker = RedisBackend(conf=conf)
+    for backend in (dead_worker, worker):
+        await backend.set_waiting(prepare_queue([queue], default_name="default"))
+    await worker.add_tasks_to_waiting_queue(
+        [make_task(regular_coro, queue.name) for _ in range(2)]
+    )
+
+    popped = await dead_worker.pop_task_from_waiting_queue()
+    # The worker dies without acknowledging the task, so its lease is never renewed.
+    await dead_worker._RedisBackend__close()
+    assert await worker.requeue_expired_tasks() == 0
+    await asyncio.sleep(0.3)
+    assert await worker.requeue_expired_tasks() == 1
+
+    # The requeued task is at the front of the queue.
+    assert (await worker.pop_task_from_waiting_queue()).id == popped.id
+    lease = worker._inflight_ids[popped.id]
+    await worker.acknowledge_task(popped.id)
+    assert await worker.r_client.zscore(worker.get_cache_key("leases"), lease) is None
+    await worker.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_queue_max_concurrency():
+    api_queue = Queue(name="api", score=10, max_concurrency=1)
+    runner = CoroRunner(
+        concurrency=3,
+        queue_conf=QueueConfig(queues=[api_queue]),
+        backend=InMemoryBackend(),
+    )
+    handles = [
+        await runner.add_task(asyncio.sleep, args=[0.05], queue_name=api_queue.name)
+        for _ in range(3)
+    ]
+    other = await runner.add_task(double, args=[2])
+    await asyncio.sleep(0)
+    assert runner._metrics[api_queue.name].running == 1
+    assert await other == 4
+
+    max_running = 0
+    while not all(handle.done() for handle in handles):
+        max_running = max(max_running, runner._metrics[api_queue.name].running)
+        await asyncio.sleep(0.01)
+    assert max_running == 1
+    await runner.join(timeout=1)
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_deficit_round_robin_scheduler(backend):
+    high = Queue(name="high", score=2)
+    low = Queue(name="low", score=1)
+    runner = CoroRunner(
+        concurrency=1,
+        queue_conf=QueueConfig(queues=[high, low]),
+        backend=backend,
+        scheduler=DeficitRoundRobinScheduler(),
+    )
+    started = []
+
+    @runner.register(name="record")
+    async def record(queue_name):
+        started.append(queue_name)
+
+    gate = asyncio.Event()
+    await runner.add_task(gate.wait)
+    await runner.add_tasks(
+        [(record, [high.name], {}, high.name)] * 4
+        + [(record, [low.name], {}, low.name)] * 2
+    )
+    gate.set()
+    await runner.join(timeout=1)
+    # The high score queue gets twice the turns, but the low score queue isn't starved.
+    assert started == ["high", "high", "low", "high", "high", "low"]
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_deficit_round_robin_with_max_concurrency(backend):
+    high = Queue(name="high", score=2, max_concurrency=1)
+    low = Queue(name="low", score=1)
+    runner = CoroRunner(
+        concurrency=2,
+        queue_conf=QueueConfig(queues=[high, low]),
+        backend=backend,
+        scheduler=DeficitRoundRobinScheduler(),
+    )
+    gate = asyncio.Event()
+    max_running = 0
+
+    @runner.register(name="blocked")
+    async def blocked():
+        nonlocal max_running
+        max_running = max(max_running, runner._metrics[high.name].running)
+        await gate.wait()
+
+    await runner.add_tasks(
+        [(blocked, [], {}, high.name)] * 3 + [(double, [1], {}, low.name)] * 3
+    )
+    # The capped queue leaves the round, the other queue gets the rest of the concurrency.
+    for _ in range(50):
+        if runner._metrics[low.name].finished == 3:
+            break
+        await asyncio.sleep(0.01)
+    assert runner._metrics[low.name].finished == 3
+    assert runner._metrics[high.name].running == 1
+    gate.set()
+    await runner.join(timeout=1)
+    assert runner._metrics[high.name].finished == 3
+    assert max_running == 1
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_queue_rate_limit(backend):
+    limited = Queue(name="limited", score=1, rate_limit=20, burst=2)
+    runner = CoroRunner(
+        concurrency=10, queue_conf=QueueConfig(queues=[limited]), backend=backend
+    )
+    started: dict[str, list[float]] = {"limited": [], "default": []}
+
+    @runner.register(name="record")
+    async def record(queue_name):
+        started[queue_name].append(time.monotonic())
+
+    await runner.add_tasks([(record, [limited.name], {}, limited.name)] * 6)
+    await runner.add_task(record, args=["default"])
+    await runner.join(timeout=2)
+    # The burst is started right away, the rest one token at a time.
+    assert len(started["limited"]) == 6
+    assert started["limited"][1] - started["limited"][0] < 0.04
+    assert started["limited"][-1] - started["limited"][0] >= 0.15
+    # The throttled tasks wait in the queue, they don't hold the concurrency.
+    assert started["default"][0] < started["limited"][2]
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_throttled_queue_is_out_of_the_heap():
+    limited = Queue(name="limited", score=10, rate_limit=20, burst=1)
+    backend = InMemoryBackend()
+    await backend.set_waiting(prepare_queue([limited, rg_queue], default_name="default"))
+    for _ in range(2):
+        await backend.add_task_to_waiting_queue(make_task(regular_coro, limited.name))
+        await backend.add_task_to_waiting_queue(make_task(regular_coro, rg_queue.name))
+
+    assert (await backend.pop_task_from_waiting_queue()).queue_name == limited.name
+    # No token left, the queue is throttled and the lower score queue is served.
+    assert (await backend.pop_task_from_waiting_queue()).queue_name == rg_queue.name
+    assert backend._throttled_ranks == {backend._queue_ranks[limited.name]}
+    assert (await backend.pop_task_from_waiting_queue()).queue_name == rg_queue.name
+    assert await backend.pop_task_from_waiting_queue() is None
+    assert 0 < backend.throttled_for <= 0.05
+    await asyncio.sleep(backend.throttled_for)
+    assert (await backend.pop_task_from_waiting_queue()).queue_name == limited.name
+    assert not backend._throttled_ranks
+    await backend.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_rate_limit_is_shared():
+    limited = Queue(name="limited", score=1, rate_limit=10)
+    runners = [
+        CoroRunner(
+            concurrency=5,
+            queue_conf=QueueConfig(queues=[limited]),
+            backend=RedisBackend(
+                conf=RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+            ),
+        )
+        for _ in range(2)
+    ]
+    started: list[float] = []
+
+    async def record():
+        started.append(time.monotonic())
+
+    for runner in runners:
+        runner.register(record, name="record")
+    await asyncio.gather(
+        *(
+            runner.add_tasks([(record, [], {}, limited.name)] * 2)
+            for runner in runners
+        )
+    )
+    await asyncio.gather(*(runner.join(timeout=2) for runner in runners))
+    # Both processes take the tokens of the same bucket, so 4 tasks take 3 refills.
+    assert len(started) == 4
+    assert max(started) - min(started) >= 0.25
+    for runner in runners:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_delayed_tasks(backend):
+    runner = CoroRunner(concurrency=1, backend=backend)
+    started = []
+
+    @runner.register(name="record")
+    async def record(name):
+        started.append(name)
+
+    later = await runner.add_task(record, args=["later"], delay=0.2)
+    await runner.add_task(
+        record, args=["eta"], eta=datetime.now() + timedelta(seconds=0.1)
+    )
+    cancelled = await runner.add_task(record, args=["cancelled"], delay=0.1)
+    cancelled.cancel()
+    # The delayed tasks don't hold the concurrency.
+    await runner.add_task(record, args=["now"])
+    await runner.join(timeout=2)
+    assert started == ["now", "eta", "later"]
+    assert later.done()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_dedup_and_result_cache(backend):
+    runner = CoroRunner(concurrency=2, backend=backend)
+    calls = []
+
+    @runner.register(name="fetch")
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value * 2
+
+    key = uuid4().hex
+    first = await runner.add_task(fetch, args=[1], dedup_key=key, cache_ttl=10)
+    duplicate = await runner.add_task(fetch, args=[1], dedup_key=key, cache_ttl=10)
+    assert duplicate is first
+    assert await first == 2
+    cached = await runner.add_task(fetch, args=[1], dedup_key=key, cache_ttl=10)
+    assert cached.status is TaskStatusEnum.FINISHED
+    assert await cached == 2
+    assert calls == [1]
+
+    # Without the cache, only the pending and running tasks are deduplicated.
+    assert await (await runner.add_task(fetch, args=[2], dedup_key="uncached")) == 4
+    assert await (await runner.add_task(fetch, args=[2], dedup_key="uncached")) == 4
+    assert calls == [1, 2, 2]
+
+    queue_metrics = runner.metrics_snapshot()["queues"]["default"]
+    assert queue_metrics["deduplicated"] == 1
+    assert queue_metrics["cache_hits"] == 1
+    await runner.cleanup()
+
+
+journaled_calls: list[int] = []
+
+
+async def journaled(value: int) -> None:
+    await asyncio.sleep(0.05)
+    journaled_calls.append(value)
+
+
+@pytest.mark.asyncio
+async def test_in_memory_backend_journal(tmp_path):
+    journal_path = str(tmp_path / "tasks.log")
+    journaled_calls.clear()
+    backend = InMemoryBackend(journal_path=journal_path)
+    backend.registry.register(journaled, name="journaled")
+    await backend.set_concurrency(1)
+    await backend.set_waiting(prepare_queue([], default_name="default"))
+    tasks = [
+        TaskRecord(id=uuid4().hex, fn=journaled, args=[value], kwargs={}, queue_name="default")
+        for value in range(1, 6)
+    ]
+    await backend.add_tasks_to_waiting_queue(tasks[:2])
+    await backend.add_task_to_waiting_queue(tasks[2])
+    await backend.add_task_to_scheduled(tasks[3], time.time() + 0.1)
+    await backend.add_task_to_waiting_queue(tasks[4])
+    assert await backend.remove_task_from_waiting_queue("default", tasks[2].id)
+    # Popped, but not acknowledged like a task running at the time of a crash.
+    assert (await backend.pop_task_from_waiting_queue()).id == tasks[0].id
+    popped = await backend.pop_task_from_waiting_queue()
+    await backend.acknowledge_task(popped.id)
+    await backend.cleanup()
+
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[6])
+    await runner.join()
+    # The recovered tasks were not counted by this runner.
+    assert runner.metrics_snapshot()["waiting"] == 0
+    await runner.cleanup()
+    assert journaled_calls == [1, 5, 6, 4]
+
+    # Everything is done, nothing runs again.
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[7])
+    await runner.join()
+    await runner.cleanup()
+    assert journaled_calls == [1, 5, 6, 4, 7]
+
+    # A task started right away is logged too. The copy of the log taken while it's running is the disk of a crash.
+    crashed_path = str(tmp_path / "crashed.log")
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[8])
+    shutil.copy(journal_path, crashed_path)
+    await runner.join()
+    await runner.cleanup()
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=crashed_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[9])
+    await runner.join()
+    await runner.cleanup()
+    assert journaled_calls == [1, 5, 6, 4, 7, 8, 8, 9]
+
+    # Cleaned up without drain, the running task is cancelled and the waiting one is not run, both are kept.
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[10])
+    await runner.add_task(journaled, args=[11])
+    await runner.cleanup()
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[12])
+    await runner.join()
+    await runner.cleanup()
+    assert journaled_calls == [1, 5, 6, 4, 7, 8, 8, 9, 11, 10, 12]
+
+
+@pytest.mark.asyncio
+async def test_journal_with_a_renamed_task(tmp_path):
+    journal_path = str(tmp_path / "tasks.log")
+    journaled_calls.clear()
+    backend = InMemoryBackend(journal_path=journal_path)
+    backend.registry.register(journaled, name="old_name")
+    await backend.set_concurrency(1)
+    await backend.set_waiting(prepare_queue([], default_name="default"))
+    await backend.add_task_to_waiting_queue(
+        TaskRecord(id=uuid4().hex, fn=journaled, args=[1], kwargs={}, queue_name="default")
+    )
+    await backend.cleanup()
+
+    # The task of the old name is dropped, the runner keeps working.
+    runner = CoroRunner(concurrency=1, backend=InMemoryBackend(journal_path=journal_path))
+    runner.register(journaled, name="journaled")
+    await runner.add_task(journaled, args=[2])
+    await runner.join()
+    await runner.cleanup()
+    assert journaled_calls == [2]
+    journal = Journal(journal_path)
+    assert journal.open() == []
+    await journal.close()
+
+
+@pytest.mark.asyncio
+async def test_journal_compaction_and_torn_tail(tmp_path):
+    path = str(tmp_path / "tasks.log")
+    journal = Journal(path, compact_min_records=10)
+    assert journal.open() == []
+    task_ids = [uuid4().hex for _ in range(20)]
+    for task_id in task_ids:
+        await journal.add("default", None, task_id.encode() + b"task")
+    for task_id in task_ids[:-2]:
+        journal.done(task_id)
+    await journal.add("default", 1.5, task_ids[-1].encode() + b"retried")
+    await journal.close()
+    # Compacted to the pending tasks, the last record is the scheduled one.
+    with open(path, "rb") as file:
+        data = file.read()
+    assert data.count(b"task") + data.count(b"retried") < 5
+
+    # A record torn by a crash while writing.
+    with open(path, "ab") as file:
+        file.write(RECORD_HEADER.pack(RECORD_ADD, 100, 0) + b"torn")
+    journal = Journal(path, compact_min_records=10)
+    assert journal.open() == [
+        ("default", None, task_ids[-2].encode() + b"task"),
+        ("default", 1.5, task_ids[-1].encode() + b"retried"),
+    ]
+    await journal.close()
+    assert os.path.getsize(path) == len(data)
+
+
+drained_calls: list[int] = []
+
+
+async def drained(value: int, seconds: float) -> int:
+    drained_calls.append(value)
+    # Only the first run is slow, so the task interrupted by the drain is fast on the next worker.
+    if drained_calls.count(value) == 1:
+        await asyncio.sleep(seconds)
+    return value
+
+
+@pytest.mark.asyncio
+async def test_cleanup_drain_hands_back_tasks():
+    drained_calls.clear()
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    runner = CoroRunner(concurrency=2, backend=RedisBackend(conf=conf))
+    runner.register(drained, name="drained")
+    finished = await runner.add_task(drained, args=[1, 0.5])
+    interrupted = await runner.add_task(drained, args=[2, 5])
+    waiting = [await runner.add_task(drained, args=[value, 0]) for value in (3, 4)]
+    await runner.cleanup(drain=True, timeout=1.5)
+    assert await finished == 1
+    assert interrupted.status is TaskStatusEnum.CANCELLED
+    assert [handle.status for handle in waiting] == [TaskStatusEnum.CANCELLED] * 2
+    assert drained_calls == [1, 2]
+    with pytest.raises(RunnerClosedError):
+        await runner.add_task(drained, args=[5, 0])
+
+    # Another worker runs the interrupted and the waiting tasks once.
+    worker = CoroRunner(concurrency=2, backend=RedisBackend(conf=conf))
+    worker.register(drained, name="drained")
+    await worker.add_task(drained, args=[5, 0])
+    await worker.join(timeout=5)
+    assert sorted(drained_calls) == [1, 2, 2, 3, 4, 5]
+    await worker.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_task_not_registered_on_the_worker():
+    async def ghost() -> None:
+        pass
+
+    drained_calls.clear()
+    conf = RedisConfig(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    producer = CoroRunner(concurrency=1, backend=RedisBackend(conf=conf))
+    producer.register(drained, name="drained")
+    producer.register(ghost, name="ghost_only_on_producer")
+    # It holds the only slot of the producer, so the next tasks wait in redis.
+    await producer.add_task(drained, args=[1, 5])
+    await producer.add_task(ghost)
+    await producer.add_task(drained, args=[2, 0])
+
+    worker = CoroRunner(concurrency=1, backend=RedisBackend(conf=conf))
+    worker.register(drained, name="drained")
+    await worker.add_task(drained, args=[3, 0])
+    await worker.join(timeout=5)
+    # The unknown task is moved to the dead letter queue, the one behind it runs.
+    assert sorted(drained_calls) == [1, 2, 3]
+    redis = worker._backend.r_client
+    assert await redis.llen(worker._backend.get_dead_letter_key("default")) == 1
+    assert await redis.zcard(worker._backend.get_cache_key("leases")) == 0
+    await worker.cleanup()
+    await producer.cleanup()
+
+
+def test_runners_dont_share_the_default_backend():
+    assert CoroRunner(concurrency=1)._backend is not CoroRunner(concurrency=1)._backend
+
+
+# Imported by the shards of test_sharded_runner by its path.
+sharded_runner = CoroRunner(concurrency=2)
+
+
+@sharded_runner.register(name="shard_pid")
+async def shard_pid(value: int) -> tuple[int, int]:
+    await asyncio.sleep(0.05)
+    return value, os.getpid()
+
+
+@pytest.mark.asyncio
+async def test_sharded_runner():
+    async with ShardedRunner("coro_runner.test_runner:sharded_runner", shards=2) as runner:
+        # Every task is routed to the same shard by the key, the idle shard steals them.
+        futures = [
+            await runner.add_task(shard_pid, args=[value], key="same") for value in range(20)
+        ]
+        failing = await runner.add_task(failing_coro)
+        results = await asyncio.gather(*futures)
+        assert [value for value, _ in results] == list(range(20))
+        assert len({pid for _, pid in results}) == 2
+        assert os.getpid() not in {pid for _, pid in results}
+        with pytest.raises(RuntimeError):
+            await failing
+        await runner.join()
+    with pytest.raises(RunnerClosedError):
+        await runner.add_task("shard_pid", args=[0])
+
+
+@sharded_runner.register(name="kill_shard")
+async def kill_shard() -> None:
+    os._exit(1)
+
+
+@pytest.mark.asyncio
+async def test_sharded_runner_shard_died():
+    async with ShardedRunner("coro_runner.test_runner:sharded_runner", shards=2) as runner:
+        killing = await runner.add_task(kill_shard)
+        with pytest.raises(ShardDiedError):
+            await asyncio.wait_for(killing, timeout=10)
+        # The other shard keeps running the tasks.
+        value, _ = await (await runner.add_task(shard_pid, args=[1]))
+        assert value == 1
+        killing = await runner.add_task(kill_shard)
+        with pytest.raises(ShardDiedError):
+            await asyncio.wait_for(killing, timeout=10)
+        # Nothing is left to run the tasks.
+        await asyncio.wait_for(runner.join(), timeout=1)
+        with pytest.raises(ShardDiedError):
+            await runner.add_task(shard_pid, args=[0])
+
+
+async def add(*values: int) -> int:
+    return sum(values)
+
+
+async def total(results: list[int], offset: int = 0) -> int:
+    return sum(results) + offset
+
+
+@pytest.mark.asyncio
+async def test_chain_group_and_chord():
+    runner = CoroRunner(concurrency=10, backend=InMemoryBackend())
+
+    # ((1 + 2) + 3) + 4
+    handle = await runner.chain(Step(add, [1, 2]), Step(add, [3]), Step(add, [4]))
+    # The held steps keep the runner busy, so join returns after all of them.
+    await runner.join(timeout=1)
+    assert handle.status is TaskStatusEnum.FINISHED
+    assert not runner._held
+    assert await handle == 10
+    assert runner.metrics_snapshot()["queues"]["default"]["finished"] == 3
+
+    group = await runner.group(Step(double, [value]) for value in range(5))
+    assert len(group) == 5
+    assert await group == [0, 2, 4, 6, 8]
+
+    fan_out = 10_000
+    body = await runner.chord(
+        (Step(add, [value]) for value in range(fan_out)), Step(total, kwargs={"offset": 1})
+    )
+    assert body.status is TaskStatusEnum.PENDING
+    assert await body == sum(range(fan_out)) + 1
+    assert not runner._held
+
+    # A failed step fails the rest without running them.
+    calls = []
+
+    @runner.register(name="record")
+    async def record(value):
+        calls.append(value)
+        return value
+
+    failed = await runner.chain(Step(failing_coro), Step(record), Step(record))
+    with pytest.raises(RuntimeError):
+        await failed
+    failed_chord = await runner.chord([Step(double, [1]), Step(failing_coro)], Step(record))
+    with pytest.raises(RuntimeError):
+        await failed_chord
+    # Cancelling a held step cancels the steps after it.
+    first = await runner.add_task(asyncio.sleep, args=[0.05])
+    cancelled = await runner.chain(Step(asyncio.sleep, [0.05]), Step(record), Step(record))
+    held = next(iter(runner._held.values()))[0]
+    assert held.cancel()
+    await runner.join()
+    assert cancelled.status is TaskStatusEnum.CANCELLED
+    assert await first is None
+    assert calls == []
+    with pytest.raises(ValueError):
+        await runner.chain()
+    await runner.cleanup()
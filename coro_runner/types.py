@@ -2,3 +2,10 @@ from typing import Any, Awaitable, Callable
 
 
 FutureFuncType = Callable[[Any, Any], Awaitable[Any]]
+# Plain function run by an executor lane.
+SyncFuncType = Callable[..., Any]
+# Instrumentation hook of the runner. e.g. CoroRunner.on_start
+HookType = Callable[..., Any]
+
+# (coro or its registered name, args, kwargs, queue_name) of a task submitted in bulk.
+TaskSpec = tuple[FutureFuncType | SyncFuncType | str, list, dict, str | None]
@@ -1,17 +1,14 @@
 from collections import deque
-from datetime import datetime
-from typing import Any
 
-from coro_runner.enums import TaskStatusEnum
 from .logging import logger
-from coro_runner.schema import Queue, TaskModel
+from coro_runner.schema import Queue, TaskRecord
 
 
 def prepare_queue(
     queues: list[Queue], default_name: str
-) -> dict[str, dict[str, deque[dict[str, Any]]]]:
+) -> dict[str, dict[str, deque[TaskRecord]]]:
     """
-    The example queue configuration:
+    Every queue holds the TaskRecord of its waiting tasks and its rate limit. The example queue configuration (the tasks are shown as dict):
     {
         "default": {
             "score": 0,
@@ -37,21 +34,14 @@ def prepare_queue(
                 "kwargs": {}
             }])
     """
-    data = {default_name: {"score": 0, "queue": deque()}}
+    data = {default_name: {"score": 0, "queue": deque(), "rate_limit": None, "burst": 1}}
     for queue in queues:
-        data[queue.name] = {"score": queue.score, "queue": deque()}
+        data[queue.name] = {
+            "score": queue.score,
+            "queue": deque(),
+            "rate_limit": queue.rate_limit,
+            "burst": queue.burst,
+        }
     logger.debug("Preparing the queues: %s", data)
     return data
 
-
-def prepare_task_schema(
-    name: str, queue: str, args: list = [], kwargs: dict = {}
-) -> TaskModel:
-    return TaskModel(
-        name=name,
-        queue=queue,
-        received=datetime.now(),
-        args=args,
-        kwargs=kwargs,
-        status=TaskStatusEnum.PENDING,
-    )
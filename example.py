@@ -55,14 +55,14 @@ async def dummy_email_send(recipient_emails: list[str]):
 @app.get("/random-delay")
 async def fire_random_delay(count: int = 25):
     for _ in range(count):
-        runner.add_task(rand_delay, queue_name="low_priority")
+        await runner.add_task(rand_delay, queue_name="low_priority")
     return {"Task": "Done"}
 
 
 @app.post("/dummy-send-email")
 async def fire_send_email(count: int = 25, emails: list[str] = []):
     for _ in range(count):
-        runner.add_task(
+        await runner.add_task(
             dummy_email_send,
             queue_name="send_mail",
             kwargs={"recipient_emails": emails},
@@ -70,6 +70,11 @@ async def fire_send_email(count: int = 25, emails: list[str] = []):
     return {"Task": "Done"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return runner.metrics_snapshot()
+
+
 async def startup():
     await runner.run_until_exit()
 